@@ -3,6 +3,10 @@ import numpy as np
 import os
 from ModeTonicEstimation import ModeFunctions as mF
 from ModeTonicEstimation import PitchDistribution as pD
+from ModeTonicEstimation import PitchTrack as pT
+from ModeTonicEstimation import ModelFile as mFile
+from ModeTonicEstimation import PitchHistogram as pH
+from ModeTonicEstimation import ModelSet as mS
 
 
 class Bozkurt:
@@ -52,7 +56,8 @@ class Bozkurt:
 		self.chunk_size = chunk_size
 		self.frame_rate = frame_rate
 
-	def train(self, mode_name, pitch_files, tonic_freqs, metric='pcd', save_dir=''):
+	def train(self, mode_name, pitch_files, tonic_freqs, metric='pcd', save_dir='', file_format='json',
+	          histogram=None, save_histogram=False):
 		"""-------------------------------------------------------------------------
 		For the mode trainings, the requirements are a set of recordings with 
 		annotated tonics for each mode under consideration. This function only
@@ -67,50 +72,100 @@ class Bozkurt:
 		mode_name     : Name of the mode to be trained. This is only used for naming
 						the resultant JSON file, in the form "mode_name.json"
 		pitch_files   : List of files with pitch tracks extracted from the recording
-						(i.e. single-column files with frequencies)
+						(i.e. single-column files with frequencies). The pitch
+						tracks can also be given in memory, as arrays. See
+						as_track() of PitchTrack.
 		tonic_freqs   : List of annotated tonic frequencies of recordings
 		metric        : Whether the model should be octave wrapped (Pitch Class
 						Distribution: PCD) or not (Pitch Distribution: PD)
 		save_dir      : Where to save the resultant JSON files.
+		file_format   : The format of the saved model, 'json' or 'binary'. See
+						ModelFile for the binary format.
+		histogram     : A partial model of the mode, i.e. a PitchHistogram object
+						or the JSON file of a saved one. If given, the recordings
+						are added to it, so an existing model is extended without
+						reprocessing the recordings it was trained on.
+		save_histogram: Whether the partial model is also saved in save_dir, as
+						"mode_name.hist", to be extended or merged later.
 		-------------------------------------------------------------------------"""
 
 		# To generate the model pitch distribution of a mode, pitch track of each
 		# recording is iteratively converted to cents, according to their respective
-		# annotated tonics. Then, these are appended to mode_track and a very long
-		# pitch track is generated, as if it is a single very long recording. The 
-		# pitch distribution of this track is the mode's model distribution.
-
-		# Normalize the pitch tracks of the mode wrt the tonic frequency and concatenate
+		# annotated tonics. The model is the pitch distribution of all these tracks,
+		# as if they are a single very long recording. Instead of concatenating the
+		# tracks, each track is counted on the fixed bin grid and the counts are
+		# summed, so the memory stays in the order of the number of bins. Smoothing
+		# and normalization are applied once, on the sum.
+		if histogram is None:
+			histogram = pH.PitchHistogram(step_size=self.step_size)
+		elif not isinstance(histogram, pH.PitchHistogram):
+			histogram = pH.load(histogram)
+
+		# Normalize the pitch tracks of the mode wrt the tonic frequency and count them
+		segment = None
 		for pf, tonic in zip(pitch_files, tonic_freqs):
-			pitch_track = np.loadtxt(pf)
-			if pitch_track.ndim > 1:  # assume the first col is time, the second is pitch and the rest is labels etc
-				pitch_track = pitch_track[:,1]
+			pitch_track = pT.load_pitch(pf)
 
-			if self.chunk_size == 0:  # use the complete pitch track
-				mode_track = mF.hz_to_cent(pitch_track, ref_freq=tonic)
-			else:  # slice and used the start of the pitch track
+			if self.chunk_size > 0:  # slice and use the start of the pitch track
 				time_track = np.arange(0, self.frame_rate * len(pitch_track), self.frame_rate)
-				pitch_track, segs = mF.slice(time_track, pitch_track, mode_name, self.chunk_size)
-				mode_track = mF.hz_to_cent(pitch_track[0], ref_freq=tonic)
+				first_chunk = mF.chunk_bounds(time_track, self.chunk_size)[0]
+				pitch_track = pitch_track[first_chunk['start']:first_chunk['stop']]
+				segment = (int(first_chunk['init']), int(first_chunk['final']))
 
-		seglen = 'all' if self.chunk_size == 0 else (segs[0][1], segs[0][2])
+			histogram.add(mF.hz_to_cent(pitch_track, ref_freq=tonic), source=pT.source_name(pf))
 
-		# generate the pitch distribution
-		pitch_distrib = mF.generate_pd(mode_track, smooth_factor=self.smooth_factor,
-		                               step_size=self.step_size, source=pitch_files, segment=seglen)
-		if metric == 'pcd':  # convert to pitch class distribution, if specified
-			pitch_distrib = mF.generate_pcd(pitch_distrib)
+		return self.train_histogram(mode_name, histogram, metric=metric, save_dir=save_dir,
+		                            file_format=file_format, save_histogram=save_histogram, segment=segment)
+
+	def train_histogram(self, mode_name, histogram, metric='pcd', save_dir='', file_format='json',
+	                    save_histogram=False, segment=None):
+		"""-------------------------------------------------------------------------
+		Generates the model of a mode from its partial model, i.e. the summed
+		histogram of its recordings. This is called by train(); it can also be
+		used directly to finalize the partial models that are trained separately
+		and merged by merge() of PitchHistogram.
+		----------------------------------------------------------------------------
+		mode_name     : Name of the mode. See train().
+		histogram     : PitchHistogram object of the mode
+		metric        : Whether the model should be octave wrapped (Pitch Class
+						Distribution: PCD) or not (Pitch Distribution: PD)
+		save_dir      : Where to save the resultant files.
+		file_format   : The format of the saved model, 'json' or 'binary'.
+		save_histogram: Whether the partial model is also saved, as "mode_name.hist"
+		segment       : The segmentation info to be recorded in the model. train()
+						gives the bounds of the first chunk of the last recording,
+						in seconds, if the recordings are sliced. If None, it is
+						'all' for the complete recordings and '-' (unknown) for
+						the sliced ones, since the bounds of the chunks aren't
+						kept in the histogram.
+		-------------------------------------------------------------------------"""
+		if histogram.step_size != self.step_size:
+			raise ValueError('The step size of the histogram is different from the estimator')
+
+		if segment is None:
+			segment = 'all' if self.chunk_size == 0 else '-'
+
+		# generate the pitch (class) distribution. The pitch class distribution is
+		# generated directly from the counts, without the intermediate PD
+		if metric == 'pcd':
+			pitch_distrib = histogram.to_pcd(smooth_factor=self.smooth_factor, segment=segment)
+		else:
+			pitch_distrib = histogram.to_pd(smooth_factor=self.smooth_factor, segment=segment)
 
 		# save the model to a file, if requested
 		if save_dir:
 			if not os.path.exists(save_dir):
 				os.makedirs(save_dir)
-			pitch_distrib.save(mode_name + '.json', save_dir=save_dir)
+			ext = mFile.BINARY_EXT if file_format == 'binary' else '.json'
+			pitch_distrib.save(mode_name + ext, save_dir=save_dir)
+			if save_histogram:
+				histogram.save(mode_name + '.hist', save_dir=save_dir)
 
 		return pitch_distrib
 
 	def estimate(self, pitch_file, mode_in='./', tonic_freq=None, rank=1,
-	             distance_method="bhat", metric='pcd'):
+	             distance_method="bhat", metric='pcd', tonic_search='peaks', peak_filter=False,
+	             cascade=None, coarse_step=30, prefilter=None):
 		"""-------------------------------------------------------------------------
 		This is the ultimate estimation function. There are three different types
 		of estimations.
@@ -135,13 +190,16 @@ class Bozkurt:
 		available. It can be ignored.
 		----------------------------------------------------------------------------
 		pitch_file:     : File in which the pitch track of the input recording
-						whose tonic and/or mode is to be estimated. 
+						whose tonic and/or mode is to be estimated. The pitch
+						track can also be given in memory, as an array. See
+						as_track() of PitchTrack.
 		mode_in         : The mode input, If it is a filename or distribution object,
 						the mode is treated as known and only tonic will be estimated.
 						If a directory with the json files or dictionary of
 						distributions (per mode) is given, the mode will be estimated.
 						In case of directory, the modes will be taken as the json
-						filenames.
+						filenames. A ModelSet of one model per mode, e.g. attached
+						from a ModelStore, is also a set of candidate modes.
 		tonic_freq      : Annotated tonic of the recording. If it's unknown, we use
 						an arbitrary value, so this can be ignored.
 		rank            : The number of estimations expected from the system. If
@@ -149,198 +207,381 @@ class Bozkurt:
 						or tonic/mode pair. If it is n, it returns a sorted list
 						of tuples of length n, each containing a tonic/mode pair. 
 		distance_method : The choice of distance methods. See distance() in
-						ModeFunctions for more information.
+						ModeFunctions for more information. It can also be a
+						list of methods; then the distribution and the tonic
+						candidates are generated once and compared with the
+						models by all methods in a single pass (see
+						distance_matrices() in ModeFunctions). The result is a
+						dictionary of the result of each method, keyed by the
+						method.
 		metric          : Whether the model should be octave wrapped (Pitch Class
 						Distribution: PCD) or not (Pitch Distribution: PD)
+		tonic_search    : How the tonic candidates are searched. If 'peaks', the
+						peaks of the distribution are the candidates. If
+						'exhaustive_fft', every circular shift of the PCD is a
+						candidate and all of them are scored at once by FFT. See
+						shift_distance_matrix() in ModeFunctions. Only for PCD.
+		peak_filter     : If True, the exhaustive search is restricted to the
+						peaks of the distribution after the scoring.
+		cascade         : The coarse-to-fine search of the tonic candidates. If
+						None, all (tonic, mode) pairs are compared. If 'exact',
+						the pairs are first compared on the coarse grid and only
+						the ones that can be among the rank best are compared on
+						the fine grid; the result is the same. It prunes only the
+						Minkowski distances. If 'approx', only a few of the best
+						pairs on the coarse grid are compared on the fine grid,
+						for any distance. See cascade_distance_matrix() in
+						ModeFunctions. Only for PCD and 'peaks' search.
+		coarse_step     : The step size of the coarse grid of the cascade, in
+						cents. It is rounded to a multiple of the step size.
+		prefilter       : The pruning of the mode candidates by the shift-invariant
+						DFT signatures, before any tonic candidate is compared.
+						If 'exact', the modes that can't have any of the rank
+						best pairs for any shift are skipped; the result is the
+						same. It prunes only the Minkowski distances. If 'approx',
+						only a few of the modes with the closest signatures are
+						compared, for any distance. See
+						prefilter_distance_matrix() in ModeFunctions. Only for
+						PCD and 'peaks' search; it can't be used with cascade.
 		-------------------------------------------------------------------------"""
-
-		# load pitch track 
-		pitch_track = np.loadtxt(pitch_file)
-
-		# assume the first col is time, the second is pitch and the rest is labels etc.
-		pitch_track = pitch_track[:,1] if pitch_track.ndim > 1 else pitch_track
-
-		# parse mode input
-		try:
-			# list of json files per mode
-			if all(os.path.isfile(m) for m in mode_in): 
-				est_mode = True  # do mode estimation
-				mode_names = [os.path.splitext(m)[0] for m in mode_in]
-				models = [pD.load(m) for m in mode_in]
-			elif os.path.isfile(mode_in): # json file
-				est_mode = False # mode already known
-				model = pD.load(mode_in)
-		except TypeError:
-			try:  # models
-				if isinstance(mode_in, pD.PitchDistribution):
-					# mode is loaded
-					est_mode = False  # mode already known
-					model = mode_in
-				elif all(isinstance(m, pD.PitchDistribution) for m in mode_in.values()):
-					# models of all modes are loaded
-					est_mode = True  # do mode estimation
-					mode_names = mode_in.keys()
-					models = [mode_in[m] for m in mode_names]
-			except:
-				ValueError("Unknown mode input!")
-
-		# parse tonic input
-		if tonic_freq:  # tonic is already known;
-			est_tonic = False
-		else:
-			est_tonic = True
-			tonic_freq = 440  # take A4 as the dummy frequency value for cent conversion; it doesnt affect anything
-
-		if not (est_tonic or est_mode):
-			ValueError("Both tonic and mode are known!")
-
-		# slice the pitch track if specified
+		# The recording is estimated as a batch of one. See estimate_many().
+		return self.estimate_many([pitch_file], mode_in=mode_in, tonic_freqs=[tonic_freq], rank=rank,
+		                          distance_method=distance_method, metric=metric, tonic_search=tonic_search,
+		                          peak_filter=peak_filter, cascade=cascade, coarse_step=coarse_step,
+		                          prefilter=prefilter)[0]
+
+	def estimate_many(self, pitch_sources, mode_in='./', tonic_freqs=None, rank=1, distance_method="bhat",
+	                  metric='pcd', tonic_search='peaks', peak_filter=False, batch_size=64, as_generator=False,
+	                  cascade=None, coarse_step=30, prefilter=None):
+		"""-------------------------------------------------------------------------
+		Estimates a batch of recordings with the same models. The models are parsed
+		(and loaded, if files are given) once for all recordings. The recordings are
+		processed in batches of batch_size; for PCD, the tonic candidates (or the
+		distributions, in mode estimation) of all recordings in a batch are stacked
+		into one matrix and compared with all models in a single distance matrix
+		computation. The results are the same as calling estimate() for each
+		recording.
+		----------------------------------------------------------------------------
+		pitch_sources   : List (or iterator) of the pitch track files or arrays of
+						the recordings
+		mode_in         : The mode input. See estimate(). It's the same for all
+						recordings.
+		tonic_freqs     : List of the annotated tonics, parallel to pitch_sources.
+						If None, the tonics of all recordings are estimated; a
+						None entry means the tonic of that recording is estimated.
+		batch_size      : The number of recordings compared with the models at once
+		as_generator    : If True, a generator is returned, which yields the result
+						of each recording as soon as its batch is estimated. Else,
+						the list of the results is returned.
+		The remaining parameters are the same as estimate(). The result of each
+		recording is in the same format as the output of estimate().
+		-------------------------------------------------------------------------"""
+		if tonic_search not in ['peaks', 'exhaustive_fft']:
+			raise ValueError("Unknown tonic search: " + str(tonic_search))
+		if tonic_search == 'exhaustive_fft' and metric != 'pcd':
+			raise ValueError("Exhaustive tonic search is only available for PCD")
+		if cascade not in [None, 'exact', 'approx']:
+			raise ValueError("Unknown cascade: " + str(cascade))
+		if prefilter not in [None, 'exact', 'approx']:
+			raise ValueError("Unknown prefilter: " + str(prefilter))
+		if cascade and prefilter:
+			raise ValueError("The cascade and the prefilter can't be used together")
+
+		# parse the mode input once for all recordings
+		est_mode, mode_names, models = self.parse_mode_input(mode_in)
+
+		results = self._iter_estimates(pitch_sources, est_mode, mode_names, models, tonic_freqs, rank,
+		                               distance_method, metric, tonic_search, peak_filter, cascade, coarse_step,
+		                               prefilter, batch_size)
+		if not isinstance(distance_method, (list, tuple)):
+			results = (res[distance_method] for res in results)
+		return results if as_generator else list(results)
+
+	def parse_mode_input(self, mode_in):
+		"""-------------------------------------------------------------------------
+		Parses the mode input of estimate() and loads the models, if files are
+		given.
+		----------------------------------------------------------------------------
+		mode_in    : The mode input. See estimate().
+		----------------------------------------------------------------------------
+		est_mode   : Whether the mode is to be estimated
+		mode_names : Names of the candidate modes. None if the mode is known.
+		models     : List of the model distributions. It has a single model if
+		             the mode is known.
+		-------------------------------------------------------------------------"""
+		if isinstance(mode_in, pD.PitchDistribution):  # mode is loaded
+			return False, None, [mode_in]
+
+		if isinstance(mode_in, mS.ModelSet):  # shared set of the models of all modes
+			mode_idxs = [mode_in.mode_idxs(m) for m in mode_in.mode_names]
+			if any(len(idxs) != 1 for idxs in mode_idxs):
+				raise ValueError("The model set should have a single model per mode")
+			return True, list(mode_in.mode_names), [mode_in.dist(idxs[0]) for idxs in mode_idxs]
+
+		if isinstance(mode_in, dict):  # models of all modes are loaded
+			if not all(isinstance(m, pD.PitchDistribution) for m in mode_in.values()):
+				raise ValueError("Unknown mode input!")
+			mode_names = list(mode_in.keys())
+			return True, mode_names, [mode_in[m] for m in mode_names]
+
+		if isinstance(mode_in, (list, tuple)):  # list of model files per mode
+			if not all(os.path.isfile(m) for m in mode_in):
+				raise ValueError("Unknown mode input!")
+			return True, [os.path.splitext(m)[0] for m in mode_in], [pD.load(m) for m in mode_in]
+
+		if os.path.isfile(mode_in):  # model file; mode already known
+			return False, None, [pD.load(mode_in)]
+
+		if os.path.isdir(mode_in):  # folder of the model files; the modes are the filenames
+			mode_names = sorted(set(os.path.splitext(f)[0] for f in os.listdir(mode_in)
+			                        if os.path.splitext(f)[1] in ['.json', mFile.BINARY_EXT]))
+			return True, mode_names, [pD.load(mFile.model_path(mode_in, m)) for m in mode_names]
+
+		raise ValueError("Unknown mode input!")
+
+	def _iter_estimates(self, pitch_sources, est_mode, mode_names, models, tonic_freqs, rank,
+	                    distance_method, metric, tonic_search, peak_filter, cascade, coarse_step, prefilter,
+	                    batch_size):
+		# Generator of the results of estimate_many(). The recordings are
+		# collected into batches, so only a batch is kept in the memory. The
+		# model matrix, its signatures and its square roots are generated once
+		# for all batches. Each result is a dictionary, keyed by the distance
+		# methods.
+		distance_methods = list(distance_method) if isinstance(distance_method, (list, tuple)) else [distance_method]
+		model_vals = mF.stack_vals(models) if metric == 'pcd' else None
+		model_signatures = mF.dft_signature(model_vals) if (metric == 'pcd' and prefilter) else None
+		sqrt_models = np.sqrt(model_vals) if (metric == 'pcd' and 'bhat' in distance_methods) else None
+
+		batch = []
+		for i, pitch_source in enumerate(pitch_sources):
+			batch.append((pitch_source, None if tonic_freqs is None else tonic_freqs[i]))
+			if len(batch) == batch_size:
+				for res in self._estimate_batch(batch, est_mode, mode_names, models, model_vals, rank,
+				                                distance_methods, metric, tonic_search, peak_filter,
+				                                cascade, coarse_step, prefilter, model_signatures, sqrt_models):
+					yield res
+				batch = []
+
+		for res in self._estimate_batch(batch, est_mode, mode_names, models, model_vals, rank,
+		                                distance_methods, metric, tonic_search, peak_filter,
+		                                cascade, coarse_step, prefilter, model_signatures, sqrt_models):
+			yield res
+
+	def _estimate_batch(self, batch, est_mode, mode_names, models, model_vals, rank,
+	                    distance_methods, metric, tonic_search, peak_filter, cascade, coarse_step, prefilter,
+	                    model_signatures, sqrt_models):
+		# Estimates a batch of (pitch source, tonic) pairs by each distance method
+		# and returns the list of their results, as dictionaries keyed by the
+		# methods. See estimate_many().
+		items = []
+		for pitch_source, tonic_freq in batch:
+			# load pitch track; if the file is a table, the first col is assumed to be
+			# time, the second is pitch and the rest is labels etc.
+			pitch_track = pT.load_pitch(pitch_source)
+
+			# parse tonic input
+			est_tonic = not tonic_freq
+			tonic_freq = tonic_freq if tonic_freq else 440  # take A4 as the dummy frequency value for cent conversion; it doesnt affect anything
+
+			distrib = self.input_distribution(pitch_track, tonic_freq, metric=metric)
+			if est_tonic:
+				distrib, cand_idxs, tonic_cands = self.tonic_candidates(distrib, tonic_freq, metric=metric,
+				                                                        tonic_search=tonic_search,
+				                                                        peak_filter=peak_filter)
+			else:
+				cand_idxs, tonic_cands = None, None
+			items.append((distrib, est_tonic, cand_idxs, tonic_cands))
+
+		# The PCD trials of all recordings are compared with the models at once:
+		# the shifted candidates in tonic estimation and the distribution itself
+		# in mode estimation. The rows of each recording are split afterwards.
+		# The tonic candidates are searched per recording in the cascade and the
+		# prefilter, since their pruning depends on the best ones of the recording.
+		# The distance matrices of all methods are computed in a single pass.
+		dist_mats = [dict() for item in items]
+		if metric == 'pcd':
+			per_recording = tonic_search == 'exhaustive_fft' or cascade or prefilter
+			stacked = [i for i, (distrib, est_tonic, cand_idxs, tonic_cands) in enumerate(items)
+			           if (est_tonic or est_mode) and not (est_tonic and per_recording)]
+			trials = [mF.shifted_vals(items[i][0], items[i][2]) if items[i][1] else mF.stack_vals(items[i][0].vals)
+			          for i in stacked]
+			if trials:
+				splits = np.cumsum([len(t) for t in trials])[:-1]
+				all_dists = mF.distance_matrices(np.vstack(trials), model_vals, distance_methods,
+				                                 sqrt_models=sqrt_models)
+				for method, method_dists in zip(distance_methods, all_dists):
+					for i, dist_mat in zip(stacked, np.split(method_dists, splits)):
+						dist_mats[i][method] = dist_mat
+
+		results = []
+		for (distrib, est_tonic, cand_idxs, tonic_cands), method_mats in zip(items, dist_mats):
+			if not (est_tonic or est_mode):
+				# Nothing is expected to be estimated.
+				results.append(dict((method, 0) for method in distance_methods))
+				continue
+
+			result = dict()
+			for method in distance_methods:
+				dist_mat = method_mats.get(method)
+				if dist_mat is None:
+					dist_mat = self.distance_matrix(distrib, cand_idxs, models, est_tonic, metric=metric,
+					                                distance_method=method, tonic_search=tonic_search,
+					                                cascade=cascade, coarse_step=coarse_step, prefilter=prefilter,
+					                                model_signatures=model_signatures, k=rank)
+				result[method] = self.rank_estimates(dist_mat, est_tonic, est_mode, tonic_cands, mode_names, rank)
+			results.append(result)
+		return results
+
+	def input_distribution(self, pitch_track, tonic_freq, metric='pcd'):
+		"""-------------------------------------------------------------------------
+		Generates the pitch (class) distribution of an input recording.
+		----------------------------------------------------------------------------
+		pitch_track : The frequency values of the pitch track, in Hz
+		tonic_freq  : The tonic (or the dummy reference) frequency
+		metric      : Whether PCD or PD is generated
+		-------------------------------------------------------------------------"""
+		# slice the pitch track if specified and use the start of the pitch track
 		if self.chunk_size > 0:
 			time_track = np.arange(0, self.frame_rate * len(pitch_track), self.frame_rate)
-			pitch_track, segs = mF.slice(time_track, pitch_track, '', self.chunk_size)
+			pitch_track = mF.slice(time_track, pitch_track, '', self.chunk_size)[0][0]
 
 		# normalize pitch track according to the given tonic frequency
 		cent_track = mF.hz_to_cent(pitch_track, ref_freq=tonic_freq)
 
-		# Pitch distribution of the input recording is generated
-		distrib = mF.generate_pd(cent_track, ref_freq=tonic_freq, smooth_factor=self.smooth_factor,
-		                         step_size=self.step_size)
-
-		# convert to PCD, if specified
-		distrib = mF.generate_pcd(distrib) if (metric == 'pcd') else distrib
+		# Pitch (class) distribution of the input recording is generated
+		if metric == 'pcd':
+			return mF.generate_pcd_from_cents(cent_track, ref_freq=tonic_freq,
+			                                  smooth_factor=self.smooth_factor, step_size=self.step_size)
+		return mF.generate_pd(cent_track, ref_freq=tonic_freq, smooth_factor=self.smooth_factor,
+		                      step_size=self.step_size)
 
-		# Saved mode models are loaded and output variables are initiated
+	def tonic_candidates(self, distrib, tonic_freq, metric='pcd', tonic_search='peaks', peak_filter=False):
+		"""-------------------------------------------------------------------------
+		The preliminary steps for tonic identification. Finds the tonic candidates
+		of the distribution of an input recording.
+		----------------------------------------------------------------------------
+		distrib     : The distribution of the input recording
+		tonic_freq  : The reference frequency of distrib
+		The remaining parameters are the same as estimate().
+		----------------------------------------------------------------------------
+		distrib     : The distribution, shifted to its minimum for PCD
+		cand_idxs   : The indices of the candidates in distrib (PCD) or the shifts
+		              of the candidates w.r.t. the zero cent bin (PD)
+		tonic_cands : The frequencies of the candidates in Hz
+		-------------------------------------------------------------------------"""
+		if metric == 'pcd':
+			# If there happens to be a peak at the last (and first due to the circular
+			# nature of PCD) sample, it is considered as two peaks, one at the end and
+			# one at the beginning. To prevent this, we find the global minima (as it
+			# is easy to compute) of the distribution and make it the new reference
+			# frequency, i.e. shift it to the beginning.
+			shift_factor = distrib.vals.tolist().index(min(distrib.vals))
+			distrib = distrib.shift(shift_factor)
+
+			# update to the new reference frequency after shift
+			tonic_freq = mF.cent_to_hz([distrib.bins[shift_factor]], ref_freq=tonic_freq)[0]
+
+			# Find the peaks of the distribution. These are the tonic candidates.
+			# In exhaustive search, all shifts are the candidates, unless they
+			# are filtered by the peaks.
+			if tonic_search == 'peaks' or peak_filter:
+				peak_idxs, peak_vals = distrib.detect_peaks()
+			else:
+				peak_idxs = np.arange(len(distrib.bins))
+			return distrib, peak_idxs, mF.cent_to_hz(distrib.bins[peak_idxs], tonic_freq)
+
+		# Find the peaks of the distribution. These are the tonic candidates
+		peak_idxs, peak_vals = distrib.detect_peaks()
+
+		# The number of samples to be shifted is the list [peak indices - zero bin]
+		# origin is the bin with value zero and the shifting is done w.r.t. it.
+		origin = np.where(distrib.bins == 0)[0][0]
+		shift_idxs = np.array([(idx - origin) for idx in peak_idxs], dtype=int)
+		return distrib, shift_idxs, mF.cent_to_hz(shift_idxs * self.step_size, tonic_freq)
+
+	def distance_matrix(self, distrib, cand_idxs, models, est_tonic, metric='pcd', distance_method='bhat',
+	                    tonic_search='peaks', cascade=None, coarse_step=30, prefilter=None,
+	                    model_signatures=None, k=1):
+		"""-------------------------------------------------------------------------
+		Compares the distribution of an input recording with the models. In tonic
+		estimation, the rows of the result are the tonic candidates; else there
+		is a single row. The columns are the models. In the cascade search and
+		the prefilter, the pairs that can't be among the k best are left as
+		infinity.
+		----------------------------------------------------------------------------
+		distrib          : The distribution of the input recording
+		cand_idxs        : The tonic candidates. See tonic_candidates().
+		models           : List of the model distributions
+		est_tonic        : Whether the tonic is estimated
+		model_signatures : The DFT signatures of the models for the prefilter. If
+		                   None, they are generated from the models.
+		k                : The number of best pairs needed, i.e. the rank
+		The remaining parameters are the same as estimate().
+		-------------------------------------------------------------------------"""
+		# Since the tonic is known, the distributions aren't shifted and are only
+		# compared to candidate mode models. mode_estimate() of ModeFunctions
+		# handles the different approach required for PCD and PD.
+		if not est_tonic:
+			return mF.mode_estimate(distrib, models, distance_method=distance_method, metric=metric,
+			                        step_size=self.step_size)[np.newaxis, :]
+
+		if metric == 'pcd' and tonic_search == 'exhaustive_fft':
+			# All shifts are scored at once and the candidate rows are picked
+			return mF.shift_distance_matrix(distrib, models, method=distance_method)[cand_idxs]
+		elif metric == 'pcd' and prefilter:
+			# The models are ranked by their shift-invariant signatures first and
+			# only the ones that can have any of the k best pairs are compared.
+			model_vals = mF.stack_vals(models)
+			model_signatures = mF.dft_signature(model_vals) if model_signatures is None else model_signatures
+			return mF.prefilter_distance_matrix(mF.shifted_vals(distrib, cand_idxs), model_vals, k,
+			                                    mF.dft_signature(distrib.vals), model_signatures,
+			                                    method=distance_method, exact=(prefilter == 'exact'))
+		elif metric == 'pcd' and cascade:
+			# The pairs are compared on the coarse grid first. Only the ones that
+			# can be among the k best are compared on the fine grid.
+			return mF.cascade_distance_matrix(mF.shifted_vals(distrib, cand_idxs), mF.stack_vals(models), k,
+			                                  method=distance_method,
+			                                  factor=mF.coarse_factor(coarse_step, self.step_size),
+			                                  exact=(cascade == 'exact'))
+		elif metric == 'pcd':
+			# PCD doesn't require any preliminary steps. Generate the distance matrix.
+			return mF.generate_distance_matrix(distrib, cand_idxs, models, method=distance_method)
+
+		# PD lengths aren't equal. tonic_estimate() of ModeFunctions compares them
+		# on the union of their grids. It can handle only a single column, so the
+		# columns of the matrix are iteratively generated
+		dist_mat = np.zeros((len(cand_idxs), len(models)))
+		for m, model in enumerate(models):
+			dist_mat[:, m] = mF.tonic_estimate(distrib, cand_idxs, model, distance_method=distance_method,
+			                                   metric=metric, step_size=self.step_size)
+		return dist_mat
+
+	def rank_estimates(self, dist_mat, est_tonic, est_mode, tonic_cands, mode_names, rank):
+		"""-------------------------------------------------------------------------
+		Ranks the estimates of a recording from its distance matrix. The output is
+		in the format of estimate(); the unfilled ranks are ('', 0).
+		----------------------------------------------------------------------------
+		dist_mat    : The distance matrix. See distance_matrix().
+		est_tonic   : Whether the tonic is estimated
+		est_mode    : Whether the mode is estimated
+		tonic_cands : The frequencies of the tonic candidates, i.e. the rows
+		mode_names  : Names of the candidate modes, i.e. the columns
+		rank        : The number of estimations expected
+		-------------------------------------------------------------------------"""
 		tonic_ranked = [('', 0) for x in range(rank)]
 		mode_ranked = [('', 0) for x in range(rank)]
 
-		# Preliminary steps for tonic identification
+		# The best rank estimates are found at once, from the best to the worst.
 		if est_tonic:
-			if metric == 'pcd':
-				# If there happens to be a peak at the last (and first due to the circular
-				# nature of PCD) sample, it is considered as two peaks, one at the end and
-				# one at the beginning. To prevent this, we find the global minima (as it
-				# is easy to compute) of the distribution and make it the new reference
-				# frequency, i.e. shift it to the beginning.
-				shift_factor = distrib.vals.tolist().index(min(distrib.vals))
-				distrib = distrib.shift(shift_factor)
-
-				# update to the new reference frequency after shift
-				tonic_freq = mF.cent_to_hz([distrib.bins[shift_factor]], ref_freq=tonic_freq)[0]
-
-				# Find the peaks of the distribution. These are the tonic candidates.
-				peak_idxs, peak_vals = distrib.detect_peaks()
-			elif metric == 'pD':
-				# Find the peaks of the distribution. These are the tonic candidates
-				peak_idxs, peak_vals = distrib.detect_peaks()
-
-				# The number of samples to be shifted is the list [peak indices - zero bin]
-				# origin is the bin with value zero and the shifting is done w.r.t. it.
-				origin = np.where(distrib.bins == 0)[0][0]
-				shift_idxs = [(idx - origin) for idx in peak_idxs]
-
-		# Joint Estimation
-		if (est_tonic and est_mode):
-			if (metric == 'pD'):
-				# Since PD lengths aren't equal, we zero-pad the distributions for comparison
-				# tonic_estimate() of ModeFunctions just does that. It can handle only
-				# a single column, so the columns of the matrix are iteratively generated
-				dist_mat = np.zeros((len(shift_idxs), len(models)))
-				for m, model in enumerate(models):
-					dist_mat[:, m] = mF.tonic_estimate(distrib, shift_idxs, model, distance_method=distance_method,
-					                                   metric=metric, step_size=self.step_size)
-			elif (metric == 'pcd'):
-				# PCD doesn't require any preliminary steps. Generate the distance matrix.
-				# The rows are tonic candidates and columns are mode candidates.
-				dist_mat = mF.generate_distance_matrix(distrib, peak_idxs, models, method=distance_method)
-
-			# Distance matrix is ready now. For each rank, (or each pair of
-			# tonic-mode estimate pair) the loop is iterated. When the first
-			# best estimate is found it's changed to the worst, so in the
-			# next iteration, the estimate would be the second best and so on.
-			for r in range(min(rank, len(peak_idxs))):
-				# The minima of the distance matrix is found. This is when the
-				# distribution is the most similar to a mode distribution, according
-				# to the corresponding tonic estimate. The corresponding tonic
-				# and mode pair is our current estimate.
-				min_row = np.where((dist_mat == np.amin(dist_mat)))[0][0]
-				min_col = np.where((dist_mat == np.amin(dist_mat)))[1][0]
-				# Due to the precaution step of PCD, the reference frequency is
-				# changed. That's why it's treated differently than PD. Here,
-				# the cent value of the tonic estimate is converted back to Hz.
-				if (metric == 'pcd'):
-					tonic_ranked[r] = (mF.cent_to_hz([distrib.bins[peak_idxs[min_row]]],
-					                                 tonic_freq)[0], dist_mat[min_row][min_col])
-				elif (metric == 'pD'):
-					tonic_ranked[r] = (mF.cent_to_hz([shift_idxs[min_row] * self.step_size],
-					                                 tonic_freq)[0], dist_mat[min_row][min_col])
-				# Current mode estimate is recorded.
-				mode_ranked[r] = (mode_names[min_col], dist_mat[min_row][min_col])
-				# The minimum value is replaced with a value larger than maximum,
-				# so we won't return this estimate pair twice.
-				dist_mat[min_row][min_col] = (np.amax(dist_mat) + 1)
-			return mode_ranked, tonic_ranked
+			ranked = mF.top_k(dist_mat, min(rank, len(tonic_cands)), tonic_freqs=tonic_cands[:, np.newaxis])
+		else:
+			ranked = mF.top_k(dist_mat, min(rank, len(mode_names)))
 
-		# Tonic Estimation
-		elif (est_tonic):
-			# This part assigns the special case changes to standard variables,
-			# so that we can treat PD and PCD in the same way, as much as
-			# possible. 
-			peak_idxs = shift_idxs if (metric == 'pD') else peak_idxs
-			tonic_freq = tonic_freq if (metric == 'pcd') else tonic_freq
-
-			# Distance vector is generated. In the mode_estimate() function
-			# of ModeFunctions, PD and PCD are treated differently and it
-			# handles the special cases such as zero-padding. The mode is
-			# already known, so there is only one model to be compared. Each
-			# entry corresponds to one tonic candidate.
-			distance_vector = mF.tonic_estimate(distrib, peak_idxs, model, distance_method=distance_method,
-			                                    metric=metric, step_size=self.step_size)
-
-			# Distance vector is ready now. For each rank, the loop is iterated.
-			# When the first best estimate is found it's changed to be the worst,
-			# so in the next iteration, the estimate would be the second best
-			# and so on
-			for r in range(min(rank, len(peak_idxs))):
-				# Minima is found, corresponding tonic candidate is our current
-				# tonic estimate
-				idx = np.argmin(distance_vector)
-				# Due to the changed reference frequency in PCD's precaution step,
-				# PCD and PD are treated differently here. 
-				# TODO: review here, this might be tedious due to 257th line.
-				if (metric == 'pcd'):
-					tonic_ranked[r] = (mF.cent_to_hz([distrib.bins[peak_idxs[idx]]],
-					                                 tonic_freq)[0], distance_vector[idx])
-				elif (metric == 'pD'):
-					tonic_ranked[r] = (mF.cent_to_hz([shift_idxs[idx] * self.step_size],
-					                                 tonic_freq)[0], distance_vector[idx])
-				# Current minima is replaced with a value larger than maxima,
-				# so that we won't return the same estimate twice.
-				distance_vector[idx] = (np.amax(distance_vector) + 1)
-			return tonic_ranked
-
-		# Mode Estimation
-		elif (est_mode):
-			# Distance vector is generated. Again, mode_estimate() of
-			# ModeFunctions handles the different approach required for
-			# PCD and PD. Since tonic is known, the distributions aren't
-			# shifted and are only compared to candidate mode models.
-			distance_vector = mF.mode_estimate(distrib, models, distance_method=distance_method, metric=metric,
-			                                   step_size=self.step_size)
-
-			# Distance vector is ready now. For each rank, the loop is iterated.
-			# When the first best estimate is found it's changed to be the worst,
-			# so in the next iteration, the estimate would be the second best
-			# and so on
-			for r in range(min(rank, len(mode_names))):
-				# Minima is found, corresponding mode candidate is our current
-				# mode estimate
-				idx = np.argmin(distance_vector)
-				mode_ranked[r] = (mode_names[idx], distance_vector[idx])
-				# Current minima is replaced with a value larger than maxima,
-				# so that we won't return the same estimate twice.
-				distance_vector[idx] = (np.amax(distance_vector) + 1)
-			return mode_ranked
+		for r, res in enumerate(ranked):
+			tonic_ranked[r] = (res['tonic'], res['score'])
+			if est_mode:
+				mode_ranked[r] = (mode_names[res['mode_code']], res['score'])
 
-		else:
-			# Nothing is expected to be estimated.
-			return 0
+		if est_tonic and est_mode:
+			return mode_ranked, tonic_ranked
+		return tonic_ranked if est_tonic else mode_ranked
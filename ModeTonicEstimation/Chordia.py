@@ -2,6 +2,12 @@
 import numpy as np
 from ModeTonicEstimation import ModeFunctions as mf
 from ModeTonicEstimation import PitchDistribution as p_d
+from ModeTonicEstimation import PitchTrack as p_t
+from ModeTonicEstimation import ModelSet as m_s
+from ModeTonicEstimation import ModelFile as m_f
+from ModeTonicEstimation import MetricTree as m_t
+from ModeTonicEstimation import InvertedFile as i_f
+from ModeTonicEstimation import PeakDetection as p_k
 import json
 import os
 import random
@@ -63,7 +69,11 @@ class Chordia:
 		self.threshold = threshold
 		self.frame_rate = frame_rate
 
-	def train(self, mode_name, pt_files, tonic_freqs, metric='pcd', save_dir=''):
+		# The loaded model sets, keyed by the model directory and the mode names.
+		# See load_model_set().
+		self.model_sets = {}
+
+	def train(self, mode_name, pt_files, tonic_freqs, metric='pcd', save_dir='', file_format='json'):
 		"""-------------------------------------------------------------------------
 		For the mode trainings, the requirements are a set of recordings with 
 		annotated tonics for each mode under consideration. This function only
@@ -79,13 +89,19 @@ class Chordia:
 		----------------------------------------------------------------------------
 		mode_name     : Name of the mode to be trained. This is only used for naming
 		                the resultant JSON file, in the form "mode_name.json"
-		pt_files       : List of pitch tracks (i.e. 1-D list of frequencies)
+		pt_files       : List of pitch track files or arrays (i.e. 1-D list of
+		                frequencies or (time, pitch) tables). See as_track() of
+		                PitchTrack.
 		tonic_freqs : List of annotated tonics of recordings
 		metric        : Whether the model should be octave wrapped (Pitch Class
 			            Distribution: PCD) or not (Pitch Distribution: PD)
-		save_dir      : Where to save the resultant JSON files.
+		save_dir      : Where to save the resultant JSON files. The ball tree of
+		                the PCD models is saved next to the model file, as
+		                "mode_name.tree", for the tree search of the nearest
+		                neighbors. See MetricTree.
+		file_format   : The format of the saved model, 'json' or 'binary'. See
+		                ModelFile for the binary format.
 		-------------------------------------------------------------------------"""
-		save_name = mode_name + '.json'
 		pitch_distrib_list = []
 
 		# Each pitch track is iterated over and its pitch distribution is generated
@@ -94,26 +110,11 @@ class Chordia:
 		# so we assume that the tonic doesn't change throughout a recording.
 
 		for pf, tonic in zip(pt_files, tonic_freqs):
-			pitch_track = np.loadtxt(pf)
-			if pitch_track.ndim > 1:  # assume the first col is time, the second is pitch and the rest is labels etc
-				pitch_track = pitch_track[:,1]
-			time_track = np.arange(0, (self.frame_rate*len(pitch_track)), self.frame_rate)
-
-			# Current pitch track is sliced into chunks.
-			if self.chunk_size == 0: # no slicing
-				pts = [pitch_track]
-				chunk_data = [pf + '_all']
-			else:
-				pts, chunk_data = mf.slice(time_track, pitch_track, pf, self.chunk_size,
-				                           self.threshold, self.overlap)
+			pitch_track = p_t.load_pitch(pf)
 
-			# Each chunk is converted to cents
-			pts = [mf.hz_to_cent(k, ref_freq=tonic) for k in pts]
-
-			# This is a wrapper function. It iteratively generates the distribution
-			# for each chunk and return it as a list. After this point, we only
-			# need to save it. God bless modular programming!
-			temp_list = self.train_chunks(pts, chunk_data, tonic, metric)
+			# The distributions of all chunks of the current pitch track are
+			# generated at once. See chunk_dists().
+			temp_list = self.chunk_dists(pitch_track, tonic, metric=metric, source=p_t.source_name(pf))
 
 			# The list is composed of lists of PitchDistributions. So,
 			# each list in temp_list corresponds to a recording and each
@@ -129,20 +130,36 @@ class Chordia:
 			if not os.path.exists(save_dir):
 				os.makedirs(save_dir)
 
-			# Dump the list of dictionaries in a JSON file.
-			dist_json = [{'bins':d.bins.tolist(), 'vals':d.vals.tolist(),
-			              'kernel_width':d.kernel_width, 'source':d.source,
-			              'ref_freq':d.ref_freq, 'segmentation':d.segmentation,
-			              'overlap':d.overlap} for d in pitch_distrib_list]
+			# The chunk distributions are stacked into a single matrix in the
+			# binary format.
+			if file_format == 'binary':
+				model_fname = os.path.join(save_dir, mode_name + m_f.BINARY_EXT)
+				m_s.from_dists([pitch_distrib_list], [mode_name]).save(model_fname)
+			else:
+				# Dump the list of dictionaries in a JSON file.
+				dist_json = [{'bins':d.bins.tolist(), 'vals':d.vals.tolist(),
+				              'kernel_width':d.kernel_width, 'source':d.source,
+				              'ref_freq':d.ref_freq, 'segmentation':d.segmentation,
+				              'overlap':d.overlap} for d in pitch_distrib_list]
+
+				model_fname = os.path.join(save_dir, mode_name + '.json')
+				with open(model_fname, 'w') as f:
+					json.dump(dist_json, f, indent=2)
 
-			with open(os.path.join(save_dir, mode_name + '.json'), 'w') as f:
-				json.dump(dist_json, f, indent=2)
+			# The tree is built from the saved values, so it is the same as the
+			# tree of the loaded models.
+			if metric == 'pcd' and pitch_distrib_list:
+				m_t.build(m_f.read_any(model_fname, mmap=False)[1]).save(
+					m_t.tree_path(model_fname), stamp=m_s.file_stamp(model_fname))
 
 		return pitch_distrib_list
 
 	def estimate(self, pitch_file, mode_names=[], mode_name='', mode_dir='./', est_mode=True,
 		         distance_method="euclidean", metric='pcd', tonic_freq=None,
-		         k_param=1, equalSamplePerMode = False):
+		         k_param=1, equalSamplePerMode = False, tonic_search='peaks', peak_filter=False,
+		         cascade=None, coarse_step=30, prefilter=None, neighbor_search='brute',
+		         num_probes=i_f.NUM_PROBES, projection_dim=i_f.PROJECTION_DIM, batched=False,
+		         memory_budget=mf.SCAN_MEMORY_BUDGET):
 		"""-------------------------------------------------------------------------
 		In the estimation phase, the input pitch track is sliced into chunk and each
 		chunk is compared with each candidate mode's each sample model, i.e. with 
@@ -171,9 +188,13 @@ class Chordia:
 		available. It can be ignored.
 		----------------------------------------------------------------------------
 		pitch_file      : File in which the pitch track of the input recording
-						whose tonic and/or mode is to be estimated.
+						whose tonic and/or mode is to be estimated. The pitch
+						track can also be given in memory, as an array. See
+						as_track() of PitchTrack.
 		mode_dir        : The directory where the mode models are stored. This is to
-						load the annotated mode or the candidate mode.
+						load the annotated mode or the candidate mode. It can
+						also be a ModelSet of the modes, e.g. attached from a
+						ModelStore. See load_model_set().
 		mode_names      : Names of the candidate modes. These are used when loading
 						the mode models. If the mode isn't estimated, this parameter
 						isn't used and can be ignored.
@@ -183,47 +204,75 @@ class Chordia:
 						False, tonic_freq is treated as the annotated tonic.
 		est_mode        : Whether mode is to be estimated or not. If this flag is
 						False, mode_name is treated as the annotated mode.
-		k_param         : The k parameter of K Nearest Neighbors. 
+		k_param         : The k parameter of K Nearest Neighbors. It can also be a
+						list of k values; then the neighbors are searched
+						once, for the largest k, and the k nearest of them are
+						voted for each k. The result is a dictionary of the
+						result of each k, keyed by k (inside the dictionary of
+						the methods, if distance_method is a list).
 		distance_method : The choice of distance methods. See distance() in
-						ModeFunctions for more information.
+						ModeFunctions for more information. It can also be a
+						list of methods; then the chunk distributions and the
+						models are shared by all methods and the result is a
+						dictionary of the result of each method, keyed by the
+						method. If the neighbors can be searched in a batch
+						(see batched), they are, and the tonic candidates are
+						compared by all methods in a single pass. Otherwise,
+						i.e. with equalSamplePerMode, the cascade, the
+						prefilter, 'exhaustive_fft' search or a neighbor
+						search other than 'brute', each chunk is shifted and
+						its tonic candidates are found once for all methods
+						(see tonic_candidates()), but each method compares
+						them with the models separately.
 		metric          : Whether the model should be octave wrapped (Pitch Class
 						Distribution: PCD) or not (Pitch Distribution: PD)
 		tonic_freq        : Annotated tonic of the recording. If it's unknown, we use
 						an arbitrary value, so this can be ignored.
+		tonic_search    : How the tonic candidates of the chunks are searched,
+						'peaks' or 'exhaustive_fft'. See chunk_estimate().
+		peak_filter     : Whether the exhaustive search is restricted to the peaks.
+		cascade         : The coarse-to-fine search of the nearest neighbors of
+						the chunks, None, 'exact' or 'approx'. See
+						chunk_estimate().
+		coarse_step     : The step size of the coarse grid of the cascade, in
+						cents.
+		prefilter       : The pruning of the chunk models by the shift-invariant
+						DFT signatures, None, 'exact' or 'approx'. See
+						chunk_estimate().
+		neighbor_search : How the nearest chunk models are searched, 'brute',
+						'tree', 'ivf' or 'scan'. See chunk_estimate().
+		num_probes      : The number of lists probed per tonic candidate in the
+						'ivf' search
+		projection_dim  : The projection dimension of the inverted file of the
+						'ivf' search
+		batched         : If True, the nearest neighbors of all chunks are
+						searched at once by batch_neighbors(), instead of
+						calling chunk_estimate() for each chunk. The result is
+						the same. Only for PCD, 'peaks' search, brute force
+						neighbor search without the cascade or the prefilter
+						and without equalSamplePerMode; the other cases are
+						estimated chunk by chunk.
+		memory_budget   : The approximate number of bytes of a block of the
+						'scan' search
 		-------------------------------------------------------------------------"""
-		# load pitch track
-		pitch_track = np.loadtxt(pitch_file)
-
-		# assume the first col is time, the second is pitch and the rest is labels etc.
-		pitch_track = pitch_track[:,1] if pitch_track.ndim > 1 else pitch_track
-
-		# Pitch track is sliced into chunks.
-		time_track = np.arange(0, (self.frame_rate*len(pitch_track)), self.frame_rate)
-
-		if self.chunk_size == 0: # no slicing
-			pts = [pitch_track]
-			chunk_data = ['input_all']
-		else:
-			pts, chunk_data = mf.slice(time_track, pitch_track, 'input', self.chunk_size,
-				                 self.threshold, self.overlap)
+		if tonic_search not in ['peaks', 'exhaustive_fft']:
+			raise ValueError("Unknown tonic search: " + str(tonic_search))
+		if tonic_search == 'exhaustive_fft' and metric != 'pcd':
+			raise ValueError("Exhaustive tonic search is only available for PCD")
+		if cascade not in [None, 'exact', 'approx']:
+			raise ValueError("Unknown cascade: " + str(cascade))
+		if prefilter not in [None, 'exact', 'approx']:
+			raise ValueError("Unknown prefilter: " + str(prefilter))
+		if cascade and prefilter:
+			raise ValueError("The cascade and the prefilter can't be used together")
+		if neighbor_search not in ['brute', 'tree', 'ivf', 'scan']:
+			raise ValueError("Unknown neighbor search: " + str(neighbor_search))
+		if neighbor_search != 'brute' and (cascade or prefilter):
+			raise ValueError("The neighbor search indexes can't be used with the cascade or the prefilter")
 
-
-		# Here's a neat trick. In order to return an estimation about the entire
-		# recording based on our observations on individual chunks, we look at the
-		# nearest neighbors of  union of all chunks. We are returning min_cnt
-		# many number of closest neighbors from each chunk. To make sure that we
-		# capture all of the nearest neighbors, we return a little more than
-		# required and then treat the union of these nearest neighbors as if it's
-		# the distance matrix of the entire recording.Then, we find the nearest
-		# neighbors from the union of these from each chunk. This is quite an
-		# overshoot, we only need min_cnt >= k_param. 
-
-		### TODO: shrink this value as much as possible.
-		min_cnt = len(pts) * k_param
-
-		#Initializations
-		tonic_list = 0
-		mode_list = ''
+		# load pitch track; if the file is a table, the first col is assumed to be
+		# time, the second is pitch and the rest is labels etc.
+		pitch_track = p_t.load_pitch(pitch_file)
 
 		# parse tonic input
 		if tonic_freq:  # tonic is already known;
@@ -237,162 +286,64 @@ class Chordia:
 			print "Both tonic and mode are known!"
 			return -1
 
-		if(est_tonic and est_mode):
-			neighbors = [ [mode_list, tonic_list] for i in range(len(chunk_data)) ]
-		elif(est_tonic):
-			neighbors = [ tonic_list for i in range(len(chunk_data)) ]
-		elif(est_mode):
-			neighbors = [ mode_list for i in range(len(chunk_data)) ]
-
-		# chunk_estimate() generates the distributions of each chunk iteratively,
-		# then compares it with all candidates and returns min_cnt closest neighbors
-		# of each chunk to neighbors list.
-		for p in range(len(pts)):
-			neighbors[p] = self.chunk_estimate(pts[p], mode_names=mode_names,
-			                                   mode_name=mode_name, mode_dir=mode_dir,
-				                               est_tonic=est_tonic, est_mode=est_mode,
-				                               distance_method=distance_method,
-				                               metric=metric, ref_freq=tonic_freq,
-				                               min_cnt=min_cnt,
-				                               equalSamplePerMode = equalSamplePerMode)
-		
-		### TODO: Clean up the spaghetti decision making part. The procedures
-		### are quite repetitive. Wrap them up with a separate function.
-
-		# Temporary variables used during the desicion making part.
-		candidate_distances, candidate_ests, candidate_sources, kn_distances, kn_ests, \
-		kn_sources, idx_counts, elem_counts, res_distances, res_sources = ([] for i in range(10))
-
-		# Joint estimation decision making. 
-		if(est_mode and est_tonic):
-			# Flattens the returned candidates and related data about them and
-			# stores them into candidate_* variables. candidate_distances stores
-			# the distance values, candidate_ests stores the mode/tonic pairs
-			# candidate_sources stores the sources of the nearest neighbors.
-			for i in xrange(len(pts)):
-				for j in neighbors[i][1]:
-					candidate_distances.append(j)
-				for l in xrange(len(neighbors[i][0][1])):
-					candidate_ests.append((neighbors[i][0][1][l], neighbors[i][0][0][l][0]))
-					candidate_sources.append(neighbors[i][0][0][l][1])
-
-			# Finds the nearest neighbors and fills all related data about
-			# them to kn_* variables. Each of these variables have length k.
-			# kn_distances stores the distance values, kn_ests stores
-			# mode/tonic pairs, kn_sources store the name/id of the distribution
-			# that gave rise to the corresponding distances.
-			for k in xrange(k_param):
-				idx = np.argmin(candidate_distances)
-				kn_distances.append(candidate_distances[idx])
-				kn_ests.append(candidate_ests[idx])
-				kn_sources.append(candidate_sources[idx])
-				candidate_distances[idx] = (np.amax(candidate_distances) + 1)
-			
-			# Counts the occurences of each candidate mode/tonic pair in
-			# the K nearest neighbors. The result is our estimation. 
-			for c in set(kn_ests):
-				idx_counts.append(kn_ests.count(c))
-				elem_counts.append(c)
-			joint_estimation = elem_counts[np.argmax(idx_counts)]
-
-			# We have concluded our estimation. Here, we retrieve the 
-			# relevant data to this estimation; the sources and coresponding
-			# distances.
-			for m in xrange(len(kn_ests)):
-				if (kn_ests[m] == joint_estimation):
-					res_sources.append(kn_sources[m])
-					res_distances.append(kn_distances[m])
-			result = [joint_estimation, res_sources, res_distances]
-
-		# Mode estimation decision making
-		elif(est_mode):
-			# Flattens the returned candidates and related data about them and
-			# stores them into candidate_* variables. candidate_distances stores
-			# the distance values, candidate_ests stores the candidate modes
-			# candidate_sources stores the sources of the nearest neighbors.
-			for i in xrange(len(pts)):
-				for j in neighbors[i][1]:
-					candidate_distances.append(j)
-				for l in xrange(len(neighbors[i][0])):
-					candidate_ests.append(neighbors[i][0][l][0])
-					candidate_sources.append(neighbors[i][0][l][1])
-
-			# Finds the nearest neighbors and fills all related data about
-			# them to kn_* variables. Each of these variables have length k.
-			# kn_distances stores the distance values, kn_ests stores
-			# mode names, kn_sources store the name/id of the distributions
-			# that gave rise to the corresponding distances.
-			for k in xrange(k_param):
-				idx = np.argmin(candidate_distances)
-				kn_distances.append(candidate_distances[idx])
-				kn_ests.append(candidate_ests[idx])
-				kn_sources.append(candidate_sources[idx])
-				candidate_distances[idx] = (np.amax(candidate_distances) + 1)
-
-			# Counts the occurences of each candidate mode name in
-			# the K nearest neighbors. The result is our estimation. 
-			for c in set(kn_ests):
-				idx_counts.append(kn_ests.count(c))
-				elem_counts.append(c)
-			mode_estimation = elem_counts[np.argmax(idx_counts)]
-
-			# We have concluded our estimation. Here, we retrieve the 
-			# relevant data to this estimation; the sources and coresponding
-			# distances.
-			for m in xrange(len(kn_ests)):
-				if (kn_ests[m] == mode_estimation):
-					res_sources.append(kn_sources[m])
-					res_distances.append(kn_distances[m])
-			result = [mode_estimation, res_sources, res_distances]
-
-
-		# Tonic estimation decision making
-		elif(est_tonic):
-			# Flattens the returned candidates and related data about them and
-			# stores them into candidate_* variables. candidate_distances stores
-			# the distance values, candidate_ests stores the candidate peak 
-			# frequencies, candidate_sources stores the sources of the nearest
-			# neighbors.
-			for i in xrange(len(pts)):
-				for j in neighbors[i][1]:
-					candidate_distances.append(j)
-				for l in xrange(len(neighbors[i][0])):
-					candidate_ests.append(neighbors[i][0][l][0])
-					candidate_sources.append(neighbors[i][0][l][1])
-
-			# Finds the nearest neighbors and fills all related data about
-			# them to kn_* variables. Each of these variables have length k.
-			# kn_distances stores the distance values, kn_ests stores
-			# peak frequencies, kn_sources store the name/id of the
-			# distributions that gave rise to the corresponding distances.
-			for k in xrange(k_param):
-				idx = np.argmin(candidate_distances)
-				kn_distances.append(candidate_distances[idx])
-				kn_ests.append(candidate_ests[idx])
-				kn_sources.append(candidate_sources[idx])
-				candidate_distances[idx] = (np.amax(candidate_distances) + 1)
-
-			# Counts the occurences of each candidate tonic frequency in
-			# the K nearest neighbors. The result is our estimation. 
-			for c in set(kn_ests):
-				idx_counts.append(kn_ests.count(c))
-				elem_counts.append(c)
-			tonic_estimation = elem_counts[np.argmax(idx_counts)]
-
-			# We have concluded our estimation. Here, we retrieve the 
-			# relevant data to this estimation; the sources and coresponding
-			# distances.
-			for m in xrange(len(kn_ests)):
-				if (kn_ests[m] == tonic_estimation):
-					res_sources.append(kn_sources[m])
-					res_distances.append(kn_distances[m])
-			result = [tonic_estimation, res_sources, res_distances]
-
-		return result
+		# Pitch track is sliced into chunks and their distributions are generated
+		# at once.
+		chunk_dists = self.chunk_dists(pitch_track, tonic_freq, metric=metric, source='input')
+
+		# The neighbors of the largest k include the neighbors of all smaller
+		# ones, since the nearest neighbors are ranked from the closest.
+		k_params = list(k_param) if isinstance(k_param, (list, tuple)) else [k_param]
+		max_k = max(k_params)
+
+		# The models are retrieved once for all chunks. They are only reloaded
+		# from the files if these are changed since the last call.
+		candidate_set = self.load_model_set(mode_names, dist_dir=mode_dir) if mode_names else None
+		annotated_set = self.load_model_set([mode_name], dist_dir=mode_dir) if (mode_name!='') else None
+
+		# The chunk distributions, their tonic candidates and the models are
+		# shared by all distance methods. If the neighbors are searched in a
+		# batch, the candidates are also compared by all methods in a single pass.
+		methods = list(distance_method) if isinstance(distance_method, (list, tuple)) else [distance_method]
+
+		# The batched search finds the k_param nearest neighbors of the recording
+		# directly, so the union of the neighbors of the chunks isn't needed
+		if ((batched or len(methods) > 1) and metric=='pcd' and tonic_search=='peaks' and
+		    neighbor_search=='brute' and not (cascade or prefilter or equalSamplePerMode)):
+			method_neighbors = self.batch_neighbors(
+				chunk_dists, max_k, candidate_set=candidate_set, annotated_set=annotated_set,
+				est_tonic=est_tonic, est_mode=est_mode, distance_method=methods, ref_freq=tonic_freq)
+		else:
+			method_neighbors = self.chunk_neighbors(
+				chunk_dists, max_k, mode_names=mode_names, mode_name=mode_name, mode_dir=mode_dir,
+				candidate_set=candidate_set, annotated_set=annotated_set, est_tonic=est_tonic,
+				est_mode=est_mode, distance_method=methods, metric=metric, ref_freq=tonic_freq,
+				equalSamplePerMode=equalSamplePerMode, tonic_search=tonic_search, peak_filter=peak_filter,
+				cascade=cascade, coarse_step=coarse_step, prefilter=prefilter, neighbor_search=neighbor_search,
+				num_probes=num_probes, projection_dim=projection_dim, memory_budget=memory_budget)
+
+		# The k nearest neighbors of each k are the first k of the neighbors
+		results = dict()
+		for method in methods:
+			kn_distances, kn_ests, kn_sources = method_neighbors[method]
+			k_results = dict((k, self._vote(kn_distances[:k], kn_ests[:k], kn_sources[:k])) for k in k_params)
+			results[method] = k_results if isinstance(k_param, (list, tuple)) else k_results[k_param]
+		return results if isinstance(distance_method, (list, tuple)) else results[distance_method]
+
+	def _vote(self, kn_distances, kn_ests, kn_sources):
+		# Counts the occurences of each estimate in the K nearest neighbors. The
+		# result is our estimation. The sources and the distances of the
+		# neighbors that agree with the estimation are returned with it.
+		estimation = mf.vote(kn_ests)
+		return [estimation, [src for src, est in zip(kn_sources, kn_ests) if est == estimation],
+		        [d for d, est in zip(kn_distances, kn_ests) if est == estimation]]
 
 	def chunk_estimate(self, pitch_track, mode_names=[], mode_name='', mode_dir='./',
 		                 est_tonic=True, est_mode=True, distance_method="euclidean",
-		                 metric='pcd', ref_freq=440, min_cnt=3, equalSamplePerMode = False):
+		                 metric='pcd', ref_freq=440, min_cnt=3, equalSamplePerMode = False,
+		                 tonic_search='peaks', peak_filter=False, candidate_set=None, annotated_set=None,
+		                 dist=None, cascade=None, coarse_step=30, prefilter=None, neighbor_search='brute',
+		                 num_probes=i_f.NUM_PROBES, projection_dim=i_f.PROJECTION_DIM,
+		                 memory_budget=mf.SCAN_MEMORY_BUDGET, candidates=None):
 		"""-------------------------------------------------------------------------
 		This function is called by the wrapper estimate() function only. It gets a 
 		pitch track chunk, generates its pitch distribution and compares it with the
@@ -402,9 +353,10 @@ class Chordia:
 		----------------------------------------------------------------------------
 		pitch_track     : Pitch track chunk of the input recording whose tonic and/or
 		                  mode is to be estimated. This is only a 1-D list of frequency
-		                  values.
+		                  values. It isn't used if dist is given.
 		mode_dir        : The directory where the mode models are stored. This is to
-		                  load the annotated mode or the candidate mode.
+		                  load the annotated mode or the candidate mode. It can
+		                  also be a ModelSet of the modes. See load_model_set().
 		mode_names      : Names of the candidate modes. These are used when loading
 		                  the mode models. If the mode isn't estimated, this parameter
 		                  isn't used and can be ignored.
@@ -423,60 +375,153 @@ class Chordia:
 		min_cnt         : The number of nearest neighbors of the current chunk to be
 		                  returned. The details of this parameter and its implications
 		                  are explained in the first lines of estimate().
+		tonic_search    : How the tonic candidates are searched. If 'peaks', the
+		                  peaks of the distribution are the candidates. If
+		                  'exhaustive_fft', every circular shift of the PCD is a
+		                  candidate and all of them are scored at once by FFT. See
+		                  shift_distance_matrix() in ModeFunctions. Only for PCD.
+		peak_filter     : If True, the exhaustive search is restricted to the
+		                  peaks of the distribution after the scoring.
+		candidate_set   : ModelSet of the candidate modes. If None, it is retrieved
+		                  by load_model_set() from mode_names and mode_dir.
+		annotated_set   : ModelSet of the annotated mode. If None, it is retrieved
+		                  by load_model_set() from mode_name and mode_dir.
+		dist            : The distribution of the chunk, if it is already generated
+		                  e.g. by chunk_dists(). Else, it is generated from
+		                  pitch_track.
+		cascade         : The coarse-to-fine search of the tonic candidates. If
+		                  None, all (tonic candidate, model) pairs are compared. If
+		                  'exact', the pairs are compared on the coarse grid first
+		                  and only the ones that can be among the min_cnt nearest
+		                  neighbors are compared on the fine grid; the neighbors
+		                  are the same. It prunes only the Minkowski distances. If
+		                  'approx', only a few of the best pairs on the coarse grid
+		                  are compared on the fine grid, for any distance. See
+		                  cascade_distance_matrix() in ModeFunctions. Only for PCD
+		                  and 'peaks' search.
+		coarse_step     : The step size of the coarse grid of the cascade, in
+		                  cents. It is rounded to a multiple of the step size.
+		prefilter       : The pruning of the chunk models by the shift-invariant
+		                  DFT signatures, before any tonic candidate is compared.
+		                  If 'exact', the models that can't be among the min_cnt
+		                  nearest neighbors for any shift are skipped; the
+		                  neighbors are the same. It prunes only the Minkowski
+		                  distances. If 'approx', only a few of the models with the
+		                  closest signatures are compared, for any distance. The
+		                  signatures are kept in the ModelSet. See
+		                  prefilter_distance_matrix() in ModeFunctions. Only for
+		                  PCD and 'peaks' search.
+		neighbor_search : How the nearest chunk models are searched. If 'brute',
+		                  all models are compared. If 'tree', the ball trees of
+		                  the models are searched for the min_cnt nearest
+		                  neighbors of all tonic candidates; the neighbors are the
+		                  same. The trees are saved by train() and kept in the
+		                  ModelSet. See knn_distance_matrix() in MetricTree. Only
+		                  for PCD, 'peaks' search, the true metrics (manhattan,
+		                  euclidean and l3) and without equalSamplePerMode; the
+		                  other cases are compared by brute force. If 'ivf', each
+		                  tonic candidate is only compared with the models in the
+		                  num_probes lists of an inverted file whose centroids are
+		                  the closest to it, for any distance. This is
+		                  approximate; the neighbors may differ from the brute
+		                  force search. The inverted files are built in memory
+		                  and kept in the ModelSet. See knn_distance_matrix() in
+		                  InvertedFile. Only for PCD, 'peaks' search and without
+		                  equalSamplePerMode. If 'scan', the models are compared
+		                  in blocks of memory_budget bytes and only the min_cnt
+		                  nearest neighbors so far are kept, instead of the whole
+		                  distance matrix; the neighbors are the same. This is
+		                  for the model sets that don't fit in the memory: the
+		                  values of a single binary model file, e.g. published
+		                  by publish_files() of ModelStore, are memory-mapped and
+		                  read a block at a time. See scan_top_k() in
+		                  ModeFunctions. Only for PCD, 'peaks' search and without
+		                  equalSamplePerMode.
+		num_probes      : The number of lists probed per tonic candidate in the
+		                  'ivf' search. More probes find more of the actual
+		                  neighbors and compare more models.
+		projection_dim  : The number of principal axes the models are projected
+		                  on, for the lists of the 'ivf' search
+		memory_budget   : The approximate number of bytes of a block of models,
+		                  with its intermediates, in the 'scan' search
+		candidates      : The tonic candidates of dist, if they are already found
+		                  by tonic_candidates(), e.g. once for all distance
+		                  methods. Else, they are found here.
 		-------------------------------------------------------------------------"""
 		# Preliminaries before the estimations
 		# Cent-to-Hz covnersion is done and pitch distributions are generated
-		cent_track = mf.hz_to_cent(pitch_track, ref_freq)
-		dist = mf.generate_pd(cent_track, ref_freq=ref_freq,
-			                  smooth_factor=self.smooth_factor, step_size=self.step_size)
-		dist = mf.generate_pcd(dist) if (metric=='pcd') else dist
-		# The model mode distribution(s) are loaded. If the mode is annotated and tonic
+		if dist is None:
+			cent_track = mf.hz_to_cent(pitch_track, ref_freq)
+			if(metric=='pcd'):
+				dist = mf.generate_pcd_from_cents(cent_track, ref_freq=ref_freq,
+				                                  smooth_factor=self.smooth_factor, step_size=self.step_size)
+			else:
+				dist = mf.generate_pd(cent_track, ref_freq=ref_freq,
+				                      smooth_factor=self.smooth_factor, step_size=self.step_size)
+		# The model mode distribution(s) are retrieved. If the mode is annotated and tonic
 		# is to be estimated, only the model of annotated mode is retrieved.
-		mode_collections = [self.load_collection(mode, dist_dir=mode_dir) for mode in mode_names]
+		if candidate_set is None and mode_names:
+			candidate_set = self.load_model_set(mode_names, dist_dir=mode_dir)
+		if annotated_set is None and mode_name != '':
+			annotated_set = self.load_model_set([mode_name], dist_dir=mode_dir)
 
-		if equalSamplePerMode:
-			minSamp = min([len(n) for n in mode_collections])
-			for i, m in enumerate(mode_collections):
-				mode_collections[i] = random.sample(m, minSamp)
+		# The trees index all the models, so the subsampled models are compared
+		# by brute force
+		use_tree = (neighbor_search=='tree' and metric=='pcd' and distance_method in m_t.METRICS and
+		            not equalSamplePerMode)
+		use_ivf = neighbor_search=='ivf' and metric=='pcd' and not equalSamplePerMode
+		use_scan = (neighbor_search=='scan' and metric=='pcd' and (tonic_search=='peaks' or not est_tonic) and
+		            not equalSamplePerMode)
 
-		# cum_lens (cummulative lengths) keeps track of number of chunks retrieved from
-		# each mode. So that we are able to find out which mode the best performed chunk
-		# belongs to.
-		cum_lens = np.cumsum([len(col) for col in mode_collections])
+		# These searches read the models a block of rows at a time, so the models
+		# are kept as they are loaded, e.g. memory-mapped, rather than read into
+		# a single matrix. See models() of ModelSet.
+		use_rows = (use_tree or use_ivf or use_scan) and not (est_tonic and tonic_search=='exhaustive_fft')
 
-		# load mode distribution
-		mode_dists = [d for col in mode_collections for d in col]
-		mode_dist = self.load_collection(mode_name, dist_dir=mode_dir) if (mode_name!='') else None
+		if candidate_set is not None:
+			if equalSamplePerMode:
+				mode_idxs = [candidate_set.mode_idxs(m) for m in candidate_set.mode_names]
+				minSamp = min([len(n) for n in mode_idxs])
+				model_idxs = np.concatenate([random.sample(list(m), minSamp) for m in mode_idxs])
+			else:
+				model_idxs = np.arange(len(candidate_set))
+
+			# mode_codes keeps track of which mode each chunk model belongs to. So that
+			# we are able to find out which mode the best performed chunk belongs to.
+			mode_codes = candidate_set.mode_codes[model_idxs]
+			mode_sources = candidate_set.sources[model_idxs]
+
+			# PCD models are compared as the rows of the model matrix, which isn't
+			# copied unless it is subsampled. PD models are used as distributions.
+			if(use_rows):
+				mode_dists = candidate_set.models()
+			elif(metric=='pcd'):
+				mode_dists = candidate_set.vals[model_idxs] if equalSamplePerMode else candidate_set.vals
+			else:
+				mode_dists = candidate_set.dists(model_idxs)
 
-		#Initializations of possible output parameters
-		tonic_list = [0 for x in range(min_cnt)]
-		mode_list = ['' for x in range(min_cnt)]
-		min_distance_list = np.zeros(min_cnt)
+			# The signatures are generated once per model set
+			if(metric=='pcd' and prefilter):
+				mode_signatures = candidate_set.signatures()
+				mode_signatures = mode_signatures[model_idxs] if equalSamplePerMode else mode_signatures
+
+		# load mode distribution
+		if annotated_set is not None:
+			mode_dist_sources = annotated_set.sources
+			if(use_rows):
+				mode_dist = annotated_set.models()
+			else:
+				mode_dist = annotated_set.vals if (metric=='pcd') else annotated_set.dists()
 
-		# If tonic will be estimated, there are certain common preliminary steps, 
+		# If tonic will be estimated, there are certain common preliminary steps,
 		# regardless of the process being a joint estimation of a tonic estimation.
+		# These don't depend on the distance method. See tonic_candidates().
 		if(est_tonic):
-			if(metric=='pcd'):
-				# This is a precaution step, just to be on the safe side. If there
-				# happens to be a peak at the last (and first due to the circular nature
-				# of PCD) sample, it is considered as two peaks, one at the end and
-				# one at the beginning. To prevent this, we find the global minima
-				# of the distribution and shift it to the beginning, i.e. make it the
-				# new reference frequency. This new reference could have been any other
-				# as long as there is no peak there, but minima is fairly easy to find.
-				shift_factor = dist.vals.tolist().index(min(dist.vals))
-				dist = dist.shift(shift_factor)
-				# anti-freq is the new reference frequency after shift, as mentioned
-				# above.
-				anti_freq = mf.cent_to_hz([dist.bins[shift_factor]], ref_freq=ref_freq)[0]
-				# Peaks of the distribution are found and recorded. These will be treated
-				# as tonic candidates.
-				peak_idxs, peak_vals = dist.detect_peaks()
-			elif(metric=='pd'):
-				# Since PD isn't circular, the precaution in PCD is unnecessary here.
-				# Peaks of the distribution are found and recorded. These will be treated
-				# as tonic candidates.
-				peak_idxs, peak_vals = dist.detect_peaks()
+			if candidates is None:
+				candidates = self.tonic_candidates(dist, ref_freq, metric=metric, tonic_search=tonic_search,
+				                                   peak_filter=peak_filter)
+			dist, peak_idxs, anti_freq, trials = candidates
+			if(metric=='pd'):
 				# The number of samples to be shifted is the list [peak indices - zero bin]
 				# origin is the bin with value zero and the shifting is done w.r.t. it.
 				origin =  np.where(dist.bins==0)[0][0]
@@ -488,10 +533,39 @@ class Chordia:
 		### TODO: The first steps of joint estimation are very similar for both Bozkurt and
 		### Chordia. We might squeeze them into a single function in ModeFunctions.
 		if(est_tonic and est_mode):
-			if(metric=='pcd'):
+			if(metric=='pcd' and tonic_search=='exhaustive_fft'):
+				# All shifts are scored at once and the candidate rows are picked
+				dist_mat = mf.shift_distance_matrix(dist, mode_dists, method=distance_method)[peak_idxs]
+			elif(use_tree):
+				# The trees of the models are searched for the min_cnt nearest
+				# neighbors of all shifts at once. The other entries are infinite.
+				dist_mat = m_t.knn_distance_matrix(trials, mode_dists,
+				                                   candidate_set.trees(), min_cnt, method=distance_method)
+			elif(use_ivf):
+				# Each shift is only compared with the models in its closest lists
+				dist_mat = i_f.knn_distance_matrix(trials, mode_dists,
+				                                   candidate_set.inverted_file(projection_dim), min_cnt,
+				                                   method=distance_method, num_probes=num_probes)
+			elif(use_scan):
+				# The models are scanned in blocks below, without a distance matrix
+				dist_mat = None
+			elif(metric=='pcd' and prefilter):
+				# The models are ranked by their shift-invariant signatures first. Only the
+				# ones that can be among the min_cnt nearest neighbors are compared.
+				dist_mat = mf.prefilter_distance_matrix(trials, mode_dists, min_cnt,
+				                                        mf.dft_signature(dist.vals), mode_signatures,
+				                                        method=distance_method, exact=(prefilter=='exact'))
+			elif(metric=='pcd' and cascade):
+				# The pairs are compared on the coarse grid first. Only the ones that
+				# can be among the min_cnt nearest neighbors are compared on the fine grid.
+				dist_mat = mf.cascade_distance_matrix(trials, mf.stack_vals(mode_dists),
+				                                      min_cnt, method=distance_method,
+				                                      factor=mf.coarse_factor(coarse_step, self.step_size),
+				                                      exact=(cascade=='exact'))
+			elif(metric=='pcd'):
 				# PCD doesn't require any prelimimary steps. Generates the distance matrix.
 				# The rows are tonic candidates and columns are mode candidates.
-				dist_mat = mf.generate_distance_matrix(dist, peak_idxs, mode_dists, method=distance_method)
+				dist_mat = mf.distance_matrix(trials, mf.stack_vals(mode_dists), method=distance_method)
 			elif(metric=='pd'):
 				# Since PD lengths aren't equal, zero padding is required and
 				# tonic_estimate() of ModeFunctions just does that. It can handle only
@@ -502,36 +576,32 @@ class Chordia:
 						                              distance_method=distance_method,
 						                              metric=metric, step_size=self.step_size)
 
-			# Distance matrix is ready now. Since we need to report min_cnt many
-			# nearest neighbors, the loop is iterated min_cnt times and returns
-			# one neighbor at each iteration, from closest to futher. When first
-			# nearest neighbor is found it's changed to the worst, so in the
-			# next iteration, the nearest would be the second nearest and so on.
-			for r in xrange(min_cnt):
-				# The minima of the distance matrix is found. This is to find
-				# the current nearest neighbor chunk.
-				min_row = np.where((dist_mat == np.amin(dist_mat)))[0][0]
-				min_col = np.where((dist_mat == np.amin(dist_mat)))[1][0]
-				# Due to the precaution step of PCD, the reference frequency is
-				# changed. That's why it's treated differently than PD. Here,
-				# the cent value of the tonic estimate is converted back to Hz.	
-				if(metric=='pcd'):
-					tonic_list[r] = mf.cent_to_hz([dist.bins[peak_idxs[min_row]]],
-						                          anti_freq)[0]
-				elif(metric=='pd'):
-					tonic_list[r] = mf.cent_to_hz([shift_idxs[min_row] * self.step_size],
-						                          ref_freq)[0]
-				# We have found out which chunk is our nearest now. Here, we find out
-				# which mode it belongs to, from cum_lens.
-				mode_list[r] = (mode_names[min(np.where((cum_lens > min_col))[0])],
-					           mode_dists[min_col].source[:-6])
-				# To observe how close these neighbors are, we report their distances.
-				# This doesn't affect the computation at all and it's just for the 
-				# evaluating and understanding the behvaviour of the system. 
-				min_distance_list[r] = dist_mat[min_row][min_col]
-				# The minimum value is replaced with a value larger than maximum,
-				# so we can easily find the second nearest neighbor.
-				dist_mat[min_row][min_col] = (np.amax(dist_mat) + 1)
+			# Distance matrix is ready now. The min_cnt nearest neighbors are
+			# found at once, from closest to further. The rows are the tonic
+			# candidates and the columns are the chunk models. Due to the
+			# precaution step of PCD, the reference frequency is changed. That's
+			# why the tonic candidates are converted back to Hz differently than PD.
+			if(metric=='pcd'):
+				tonic_cands = mf.cent_to_hz(dist.bins[peak_idxs], anti_freq)
+			elif(metric=='pd'):
+				tonic_cands = mf.cent_to_hz(np.array(shift_idxs) * self.step_size, ref_freq)
+
+			if(use_scan):
+				ranked = mf.scan_top_k(trials, mode_dists, min_cnt,
+				                       method=distance_method, mode_codes=mode_codes[np.newaxis, :],
+				                       tonic_freqs=tonic_cands[:, np.newaxis], memory_budget=memory_budget)
+			else:
+				ranked = mf.top_k(dist_mat, min_cnt, mode_codes=mode_codes[np.newaxis, :],
+				                  tonic_freqs=tonic_cands[:, np.newaxis])
+
+			# The mode of each nearest neighbor is found from its mode code. To
+			# observe how close these neighbors are, we report their distances.
+			# This doesn't affect the computation at all and it's just for the
+			# evaluating and understanding the behvaviour of the system.
+			tonic_list = ranked['tonic'].tolist()
+			mode_list = [(candidate_set.mode_names[res['mode_code']], mode_sources[res['col']][:-6])
+			             for res in ranked]
+			min_distance_list = ranked['score']
 			return [[mode_list, tonic_list], min_distance_list.tolist()]
 
 		# Tonic Estimation
@@ -541,6 +611,12 @@ class Chordia:
 			# possible.
 			peak_idxs = shift_idxs if metric=='pd' else peak_idxs
 			anti_freq = ref_freq if metric=='pd' else anti_freq
+			# The cent values of the tonic candidates w.r.t. anti_freq. The PD
+			# candidates are the shifts from the zero cent bin.
+			if metric=='pd':
+				candidate_cents = np.array(shift_idxs) * self.step_size
+			else:
+				candidate_cents = dist.bins[peak_idxs]
 
 			# Distance matrix is generated. In the mode_estimate() function
 			# of ModeFunctions, PD and PCD are treated differently and it
@@ -549,28 +625,47 @@ class Chordia:
 			# set of chunk distributions that belong to the same mode, to
 			# be compared. Each column is a chunk distribution and each
 			# row is a tonic candidate.
-			dist_mat = [mf.tonic_estimate(dist, peak_idxs, d,
-				                          distance_method=distance_method,
-				                          metric=metric, step_size=self.step_size) for d in mode_dist]
-
-			# Distance matrix is ready now. Since we need to report min_cnt many
-			# nearest neighbors, the loop is iterated min_cnt times and returns
-			# one neighbor at each iteration, from closest to futher. When first
-			# nearest neighbor is found it's changed to the worst, so in the
-			# next iteration, the nearest would be the second nearest and so on.
-			for r in xrange(min_cnt):
-				# The minima of the distance matrix is found. This is to find
-				# the current nearest neighbor chunk.
-				min_row = np.where((dist_mat == np.amin(dist_mat)))[0][0]
-				min_col = np.where((dist_mat == np.amin(dist_mat)))[1][0]
-				# The corresponding tonic candidate is found, based on the
-				# current nearest neighbor and it's distance is recorded
-				tonic_list[r] = (mf.cent_to_hz([dist.bins[peak_idxs[min_col]]],
-					                           anti_freq)[0], mode_dist[min_row].source[:-6])
-				min_distance_list[r] = dist_mat[min_row][min_col]
-				# The minimum value is replaced with a value larger than maximum,
-				# so we can easily find the second nearest neighbor.
-				dist_mat[min_row][min_col] = (np.amax(dist_mat) + 1)
+			if(metric=='pcd' and tonic_search=='exhaustive_fft'):
+				dist_mat = mf.shift_distance_matrix(dist, mode_dist, method=distance_method)[peak_idxs].T
+			elif(use_tree):
+				dist_mat = m_t.knn_distance_matrix(trials, mode_dist,
+				                                   annotated_set.trees(), min_cnt, method=distance_method).T
+			elif(use_ivf):
+				dist_mat = i_f.knn_distance_matrix(trials, mode_dist,
+				                                   annotated_set.inverted_file(projection_dim), min_cnt,
+				                                   method=distance_method, num_probes=num_probes).T
+			elif(use_scan):
+				dist_mat = None
+			elif(metric=='pcd' and prefilter):
+				dist_mat = mf.prefilter_distance_matrix(trials, mode_dist, min_cnt,
+				                                        mf.dft_signature(dist.vals), annotated_set.signatures(),
+				                                        method=distance_method, exact=(prefilter=='exact')).T
+			elif(metric=='pcd' and cascade):
+				dist_mat = mf.cascade_distance_matrix(trials, mf.stack_vals(mode_dist),
+				                                      min_cnt, method=distance_method,
+				                                      factor=mf.coarse_factor(coarse_step, self.step_size),
+				                                      exact=(cascade=='exact')).T
+			elif(metric=='pcd'):
+				dist_mat = mf.distance_matrix(trials, mf.stack_vals(mode_dist), method=distance_method).T
+			else:
+				dist_mat = np.array([mf.tonic_estimate(dist, peak_idxs, d,
+				                                       distance_method=distance_method,
+				                                       metric=metric, step_size=self.step_size)
+				                     for d in mode_dist])
+
+			# Distance matrix is ready now. The min_cnt nearest neighbors are
+			# found at once, from closest to further. The rows are the chunk
+			# models and the columns are the tonic candidates. The corresponding
+			# tonic candidate of each neighbor and its distance are recorded.
+			tonic_cands = mf.cent_to_hz(candidate_cents, anti_freq)
+			if(use_scan):
+				ranked = mf.scan_top_k(trials, mode_dist, min_cnt,
+				                       method=distance_method, tonic_freqs=tonic_cands[np.newaxis, :],
+				                       transpose=True, memory_budget=memory_budget)
+			else:
+				ranked = mf.top_k(dist_mat, min_cnt, tonic_freqs=tonic_cands[np.newaxis, :])
+			tonic_list = [(res['tonic'], mode_dist_sources[res['row']][:-6]) for res in ranked]
+			min_distance_list = ranked['score']
 			return [tonic_list, min_distance_list.tolist()]
 
 		# Mode estimation
@@ -580,35 +675,307 @@ class Chordia:
 			# compared to each chunk distribution of each candidate mode.
 			# Again, mode_estimate() of ModeFunctions handles the different
 			# approach required for PCD and PD.
-			distance_vector = mf.mode_estimate(dist, mode_dists,
-				                               distance_method=distance_method,
-				                               metric=metric, step_size=self.step_size)
+			if(use_tree):
+				distance_vector = m_t.knn_distance_matrix(dist.vals, mode_dists, candidate_set.trees(), min_cnt,
+				                                          method=distance_method)[0]
+			elif(use_ivf):
+				distance_vector = i_f.knn_distance_matrix(dist.vals, mode_dists,
+				                                          candidate_set.inverted_file(projection_dim), min_cnt,
+				                                          method=distance_method, num_probes=num_probes)[0]
+			elif(use_scan):
+				distance_vector = None
+			else:
+				distance_vector = mf.mode_estimate(dist, mode_dists,
+					                               distance_method=distance_method,
+					                               metric=metric, step_size=self.step_size)
 			
-			# Distance matrix is ready now. Since we need to report min_cnt many
-			# nearest neighbors, the loop is iterated min_cnt times and returns
-			# one neighbor at each iteration, from closest to futher. When first
-			# nearest neighbor is found it's changed to the worst, so in the
-			# next iteration, the nearest would be the second nearest and so on.
-			for r in xrange(min_cnt):
-				# The minima of the distance matrix is found. This is to find
-				# the current nearest neighbor chunk.
-				idx = np.argmin(distance_vector)
-				# We have found out which chunk is our nearest now. Here, we find out
-				# which mode it belongs to, from cum_lens.
-				mode_list[r] = (mode_names[min(np.where((cum_lens > idx))[0])],
-					                                    mode_dists[idx].source[:-6])
-				# The distance of the current nearest neighbors recorded. The details
-				# of this step is explained in the end of the analogous loop in joint
-				# estimation of thşs function.
-				min_distance_list[r] = distance_vector[idx]
-				# The minimum value is replaced with a value larger than maximum,
-				# so we can easily find the second nearest neighbor.
-				distance_vector[idx] = (np.amax(distance_vector) + 1) 
+			# Distance vector is ready now. The min_cnt nearest neighbors are
+			# found at once, from closest to further, and the modes they belong
+			# to are found from mode_codes.
+			if(use_scan):
+				ranked = mf.scan_top_k(dist.vals, mode_dists, min_cnt, method=distance_method,
+				                       mode_codes=mode_codes, memory_budget=memory_budget)
+			else:
+				ranked = mf.top_k(distance_vector, min_cnt, mode_codes=mode_codes)
+			mode_list = [(candidate_set.mode_names[res['mode_code']], mode_sources[res['col']][:-6])
+			             for res in ranked]
+			min_distance_list = ranked['score']
 			return [mode_list, min_distance_list.tolist()]
 
 		else:
 			return 0
 
+	def tonic_candidates(self, dist, ref_freq, metric='pcd', tonic_search='peaks', peak_filter=False):
+		"""-------------------------------------------------------------------------
+		Finds the tonic candidates of a chunk distribution, as chunk_estimate()
+		compares them with the models. These don't depend on the distance
+		method, so they are found once per chunk and shared by all methods. See
+		chunk_neighbors().
+		----------------------------------------------------------------------------
+		dist         : The distribution of the chunk
+		ref_freq     : The reference frequency of dist
+		metric       : The choice of PCD or PD
+		tonic_search : How the tonic candidates are searched. See chunk_estimate().
+		peak_filter  : Whether the exhaustive search is restricted to the peaks
+		----------------------------------------------------------------------------
+		dist      : The distribution, shifted to its minimum if it is a PCD
+		peak_idxs : The indices of the tonic candidates in the bins of dist
+		anti_freq : The frequency of the zero cent bin of dist
+		trials    : The shifted values of dist at the tonic candidates, one per
+		            row, if they are compared as rows (PCD and 'peaks' search).
+		            See shifted_vals() of ModeFunctions.
+		-------------------------------------------------------------------------"""
+		if(metric=='pcd'):
+			# This is a precaution step, just to be on the safe side. If there
+			# happens to be a peak at the last (and first due to the circular nature
+			# of PCD) sample, it is considered as two peaks, one at the end and
+			# one at the beginning. To prevent this, we find the global minima
+			# of the distribution and shift it to the beginning, i.e. make it the
+			# new reference frequency. This new reference could have been any other
+			# as long as there is no peak there, but minima is fairly easy to find.
+			shift_factor = dist.vals.tolist().index(min(dist.vals))
+			dist = dist.shift(shift_factor)
+			# anti-freq is the new reference frequency after shift, as mentioned
+			# above.
+			anti_freq = mf.cent_to_hz([dist.bins[shift_factor]], ref_freq=ref_freq)[0]
+			# Peaks of the distribution are found and recorded. These will be treated
+			# as tonic candidates. In exhaustive search, all shifts are the candidates,
+			# unless they are filtered by the peaks.
+			if(tonic_search=='peaks' or peak_filter):
+				peak_idxs, peak_vals = dist.detect_peaks()
+			else:
+				peak_idxs = np.arange(len(dist.bins))
+			trials = mf.shifted_vals(dist, peak_idxs) if tonic_search=='peaks' else None
+		else:
+			# Since PD isn't circular, the precaution in PCD is unnecessary here.
+			# Peaks of the distribution are found and recorded. These will be treated
+			# as tonic candidates.
+			peak_idxs, peak_vals = dist.detect_peaks()
+			anti_freq = ref_freq
+			trials = None
+		return dist, peak_idxs, anti_freq, trials
+
+	def chunk_neighbors(self, chunk_dists, k_param, mode_names=[], mode_name='', mode_dir='./',
+	                    candidate_set=None, annotated_set=None, est_tonic=True, est_mode=True,
+	                    distance_method='euclidean', metric='pcd', ref_freq=440, equalSamplePerMode=False,
+	                    tonic_search='peaks', peak_filter=False, cascade=None, coarse_step=30, prefilter=None,
+	                    neighbor_search='brute', num_probes=i_f.NUM_PROBES, projection_dim=i_f.PROJECTION_DIM,
+	                    memory_budget=mf.SCAN_MEMORY_BUDGET):
+		"""-------------------------------------------------------------------------
+		Finds the k_param nearest neighbors of a recording from its chunks, by
+		calling chunk_estimate() for each chunk and ranking the union of their
+		min_cnt nearest neighbors. This is the search of estimate() when the
+		neighbors aren't searched in a batch; the output is the same as
+		batch_neighbors(). The parameters are passed to chunk_estimate().
+		----------------------------------------------------------------------------
+		chunk_dists     : The distributions of the chunks of the recording. See
+		                  chunk_dists().
+		k_param         : The number of nearest neighbors
+		distance_method : The choice of distance methods. If it is a list of
+		                  methods, the output is a dictionary of the output of
+		                  each method, keyed by the method.
+		----------------------------------------------------------------------------
+		kn_distances    : The distances of the nearest neighbors, from the closest
+		kn_ests         : The estimate of each neighbor: a (tonic, mode) pair in
+		                  joint estimation, the mode in mode estimation and the
+		                  tonic in tonic estimation
+		kn_sources      : The sources of the chunk models of the neighbors
+		-------------------------------------------------------------------------"""
+		methods = list(distance_method) if isinstance(distance_method, (list, tuple)) else [distance_method]
+		# Here's a neat trick. In order to return an estimation about the entire
+		# recording based on our observations on individual chunks, we look at the
+		# nearest neighbors of  union of all chunks. We are returning min_cnt
+		# many number of closest neighbors from each chunk. To make sure that we
+		# capture all of the nearest neighbors, we return a little more than
+		# required and then treat the union of these nearest neighbors as if it's
+		# the distance matrix of the entire recording.Then, we find the nearest
+		# neighbors from the union of these from each chunk. This is quite an
+		# overshoot, we only need min_cnt >= k_param. 
+
+		### TODO: shrink this value as much as possible.
+		min_cnt = len(chunk_dists) * k_param
+
+		# chunk_estimate() compares the distribution of each chunk with all
+		# candidates and returns min_cnt closest neighbors of each chunk.
+		# These are flattened into candidate_* variables of each method.
+		# candidate_distances stores the distance values, candidate_ests stores
+		# the mode/tonic pairs, the modes or the tonics and candidate_sources
+		# stores the sources of the nearest neighbors.
+		candidate_distances, candidate_ests, candidate_sources = [dict((m, []) for m in methods) for i in range(3)]
+		for dist in chunk_dists:
+			# The tonic candidates of the chunk are found once for all methods
+			candidates = self.tonic_candidates(dist, ref_freq, metric=metric, tonic_search=tonic_search,
+			                                   peak_filter=peak_filter) if est_tonic else None
+			for method in methods:
+				neighbors, distances = self.chunk_estimate(
+					None, dist=dist, mode_names=mode_names, mode_name=mode_name, mode_dir=mode_dir,
+					candidate_set=candidate_set, annotated_set=annotated_set, est_tonic=est_tonic,
+					est_mode=est_mode, distance_method=method, metric=metric, ref_freq=ref_freq,
+					min_cnt=min_cnt, equalSamplePerMode=equalSamplePerMode, tonic_search=tonic_search,
+					peak_filter=peak_filter, cascade=cascade, coarse_step=coarse_step, prefilter=prefilter,
+					neighbor_search=neighbor_search, num_probes=num_probes, projection_dim=projection_dim,
+					memory_budget=memory_budget, candidates=candidates)
+				if(est_tonic and est_mode):
+					neighbors = [((tonic, mode), source) for (mode, source), tonic in zip(*neighbors)]
+				candidate_distances[method] += distances
+				candidate_ests[method] += [est for est, source in neighbors]
+				candidate_sources[method] += [source for est, source in neighbors]
+
+		# Finds the nearest neighbors of the recording at once, from closest to
+		# further. kn_distances stores the distance values, kn_ests stores the
+		# estimates and kn_sources store the name/id of the distributions that
+		# gave rise to the corresponding distances.
+		method_neighbors = dict()
+		for method in methods:
+			kn_idxs = mf.top_k_idxs(candidate_distances[method], k_param)
+			method_neighbors[method] = ([candidate_distances[method][i] for i in kn_idxs],
+			                            [candidate_ests[method][i] for i in kn_idxs],
+			                            [candidate_sources[method][i] for i in kn_idxs])
+
+		return method_neighbors if isinstance(distance_method, (list, tuple)) else method_neighbors[distance_method]
+
+	def batch_neighbors(self, chunk_dists, k_param, candidate_set=None, annotated_set=None, est_tonic=True,
+		                est_mode=True, distance_method='euclidean', ref_freq=440):
+		"""-------------------------------------------------------------------------
+		Finds the k_param nearest neighbors of a recording among all (chunk, tonic
+		candidate, chunk model) triples at once. The neighbors, their order and
+		their distances are the same as calling chunk_estimate() for each chunk
+		and ranking the union of their neighbors, as estimate() does.
+
+		The tonic candidates of all chunks are stacked into a single matrix and
+		compared with the model matrix in groups of chunks, at most BLOCK_SIZE
+		distances at a time. The k_param best entries of each group are kept by a
+		partial sort and merged. Each distance is independent of the group it
+		is computed in (see distance_matrix() in ModeFunctions), so the
+		distances are the same as chunk_estimate(). Only for PCD and 'peaks'
+		search.
+
+		Several distance methods can be given at once. The tonic candidates are
+		then found once and each group is compared by all methods in a single
+		pass. See distance_matrices() in ModeFunctions.
+		----------------------------------------------------------------------------
+		chunk_dists     : The PCDs of the chunks of the recording. See
+		                  chunk_dists().
+		k_param         : The number of nearest neighbors
+		candidate_set   : ModelSet of the candidate modes, if the mode is estimated
+		annotated_set   : ModelSet of the annotated mode, if the mode is known
+		est_tonic       : Whether tonic is to be estimated or not
+		est_mode        : Whether mode is to be estimated or not
+		distance_method : The choice of distance methods. See distance() in
+		                  ModeFunctions for more information. If it is a list of
+		                  methods, the output is a dictionary of the output of
+		                  each method, keyed by the method.
+		ref_freq        : The reference frequency of the chunk PCDs
+		----------------------------------------------------------------------------
+		kn_distances    : The distances of the nearest neighbors, from the closest
+		kn_ests         : The estimate of each neighbor: a (tonic, mode) pair in
+		                  joint estimation, the mode in mode estimation and the
+		                  tonic in tonic estimation
+		kn_sources      : The sources of the chunk models of the neighbors
+		-------------------------------------------------------------------------"""
+		model_set = candidate_set if est_mode else annotated_set
+		num_models = len(model_set)
+
+		if(est_tonic):
+			# As in chunk_estimate(), each chunk is shifted to its minimum and its
+			# peaks are the tonic candidates. The peaks are detected at once.
+			shift_factors = [d.vals.tolist().index(min(d.vals)) for d in chunk_dists]
+			shifted = [d.shift(sf) for d, sf in zip(chunk_dists, shift_factors)]
+			peak_idxs = [idxs for idxs, vals in p_k.detect_peaks_batch([d.vals for d in shifted])]
+			trials = np.vstack([mf.shifted_vals(d, idxs) for d, idxs in zip(shifted, peak_idxs)])
+			tonics = np.concatenate([mf.cent_to_hz(d.bins[idxs], mf.cent_to_hz([d.bins[sf]], ref_freq)[0])
+			                         for d, sf, idxs in zip(shifted, shift_factors, peak_idxs)])
+			num_trials = np.array([len(idxs) for idxs in peak_idxs], dtype=int)
+		else:
+			trials = mf.stack_vals(chunk_dists)
+			num_trials = np.ones(len(chunk_dists), dtype=int)
+		starts = np.concatenate(([0], np.cumsum(num_trials)))
+
+		# The square roots of the models are taken once for all groups
+		methods = list(distance_method) if isinstance(distance_method, (list, tuple)) else [distance_method]
+		sqrt_models = np.sqrt(model_set.vals) if 'bhat' in methods else None
+		max_rows = max(1, mf.BLOCK_SIZE // max(1, num_models))
+
+		# The chunks are grouped, such that each group is compared at once
+		groups = []
+		first = 0
+		while first < len(chunk_dists):
+			last = first + 1
+			while last < len(chunk_dists) and starts[last + 1] - starts[first] <= max_rows:
+				last += 1
+			groups.append((first, last))
+			first = last
+
+		scores, rows, cols = [dict((m, []) for m in methods) for i in range(3)]
+		for first, last in groups:
+			dist_mats = mf.distance_matrices(trials[starts[first]:starts[last]], model_set.vals, methods,
+			                                 sqrt_models=sqrt_models)
+			for method, dist_mat in zip(methods, dist_mats):
+				# The entries are ordered as chunk_estimate() ranks them, so the
+				# ties are broken in the same way: (tonic candidate, model) for
+				# each chunk, or (model, tonic candidate) if the mode is known.
+				if(est_mode):
+					flat = dist_mat.ravel()
+				else:
+					bounds = starts[first:last + 1] - starts[first]
+					flat = np.concatenate([dist_mat[bounds[c]:bounds[c + 1]].T.ravel()
+					                       for c in range(last - first)])
+
+				# The positions of the best entries are kept in order, so that the
+				# merged entries are still ordered as chunk_estimate() ranks them
+				idxs = np.sort(mf.top_k_idxs(flat, k_param))
+				if(est_mode):
+					group_rows, group_cols = idxs // num_models, idxs % num_models
+				else:
+					offsets = (starts[first:last + 1] - starts[first]) * num_models
+					chunk = np.searchsorted(offsets, idxs, side='right') - 1
+					within = idxs - offsets[chunk]
+					group_rows = starts[first:last][chunk] - starts[first] + within % num_trials[first:last][chunk]
+					group_cols = within // num_trials[first:last][chunk]
+				scores[method].append(flat[idxs])
+				rows[method].append(starts[first] + group_rows)
+				cols[method].append(group_cols)
+
+		neighbors = dict()
+		for method in methods:
+			method_scores = np.concatenate(scores[method])
+			best = mf.top_k_idxs(method_scores, k_param)
+			method_rows, method_cols = np.concatenate(rows[method])[best], np.concatenate(cols[method])[best]
+
+			kn_sources = [src[:-6] for src in model_set.sources[method_cols]]
+			if(est_tonic and est_mode):
+				kn_ests = [(float(tonics[r]), model_set.mode_names[model_set.mode_codes[c]])
+				           for r, c in zip(method_rows, method_cols)]
+			elif(est_mode):
+				kn_ests = [model_set.mode_names[code] for code in model_set.mode_codes[method_cols]]
+			else:
+				kn_ests = [tonics[r] for r in method_rows]
+			neighbors[method] = (method_scores[best].tolist(), kn_ests, kn_sources)
+
+		return neighbors if isinstance(distance_method, (list, tuple)) else neighbors[distance_method]
+
+	def chunk_dists(self, pitch_track, ref_freq, metric='pcd', source=''):
+		"""-------------------------------------------------------------------------
+		Slices a pitch track into chunks, as slice() of ModeFunctions does with the
+		chunk_size, threshold and overlap of the object, and generates the
+		distributions of all chunks at once from the cumulative histograms of the
+		track. See generate_chunk_dists() of ModeFunctions.
+		----------------------------------------------------------------------------
+		pitch_track : The frequency values of the entire pitch track, in Hz
+		ref_freq    : Reference frequency to be used in PD/PCD generation
+		metric      : The choice of PCD or PD
+		source      : The source (i.e. name/id of the recording) of the pitch track
+		-------------------------------------------------------------------------"""
+		time_track = np.arange(0, (self.frame_rate*len(pitch_track)), self.frame_rate)
+		chunk_info = mf.chunk_bounds(time_track, self.chunk_size, self.threshold, self.overlap)
+
+		# The unvoiced samples are kept as NaN, so the track stays aligned with
+		# the timestamps
+		cent_track = mf.hz_to_cent(pitch_track, ref_freq, drop_zeros=False)
+		return mf.generate_chunk_dists(cent_track, chunk_info, ref_freq=ref_freq,
+		                               smooth_factor=self.smooth_factor, step_size=self.step_size,
+		                               metric=metric, source=source, overlap=self.overlap)
+
 	def train_chunks(self, pts, chunk_data, ref_freq, metric='pcd'):
 		"""-------------------------------------------------------------------------
 		Gets the pitch track chunks of a recording, generates its pitch distribution
@@ -634,10 +1001,13 @@ class Chordia:
 			src = chunk_data[idx][0]
 			interval = (chunk_data[idx][1], chunk_data[idx][2])
 			# PitchDistribution of the current chunk is generated
-			dist = mf.generate_pd(pts[idx], ref_freq=ref_freq, smooth_factor=self.smooth_factor,
-			                      step_size=self.step_size, source=src, segment=interval, overlap=self.overlap)
 			if(metric=='pcd'):
-				dist = mf.generate_pcd(dist)
+				dist = mf.generate_pcd_from_cents(pts[idx], ref_freq=ref_freq, smooth_factor=self.smooth_factor,
+				                                  step_size=self.step_size, source=src, segment=interval,
+				                                  overlap=self.overlap)
+			else:
+				dist = mf.generate_pd(pts[idx], ref_freq=ref_freq, smooth_factor=self.smooth_factor,
+				                      step_size=self.step_size, source=src, segment=interval, overlap=self.overlap)
 			# The resultant pitch distributions are filled in the list to be returned
 			dist_list.append(dist)
 		return dist_list
@@ -646,23 +1016,48 @@ class Chordia:
 		"""-------------------------------------------------------------------------
 		Since each mode model consists of a list of PitchDistribution objects, the
 		load() function from that class can't be used directly. This function loads
-		JSON files that contain a list of PitchDistribution objects. This is used
-		for retrieving the mode models in the beginning of estimation process.
+		JSON or binary model files that contain a list of PitchDistribution objects.
+		The format is detected automatically; see ModelFile.
 		----------------------------------------------------------------------------
-		mode_name : Name of the mode to be loaded. The name of the JSON file is
-		            expected to be "mode_name.json" 
-		dist_dir  : Directory where the JSON file is stored.
+		mode_name : Name of the mode to be loaded. The name of the file is
+		            expected to be "mode_name.model" or "mode_name.json"
+		dist_dir  : Directory where the model file is stored, or a ModelSet
+		            that holds the mode, e.g. attached from a ModelStore.
 		-------------------------------------------------------------------------"""
+		if isinstance(dist_dir, m_s.ModelSet):
+			return dist_dir.subset([mode_name]).dists()
+
 		obj_list = []
-		fname = mode_name + '.json'
-		with open(os.path.join(dist_dir, fname)) as f:
-			dist_list = json.load(f)
-
-		# List of dictionaries is is iterated over to initialize a list of
-		# PitchDistribution objects.
-		for d in dist_list:
-			obj_list.append(p_d.PitchDistribution(np.array(d['bins']),
-				            np.array(d['vals']), kernel_width=d['kernel_width'],
+		bins, vals, rows = m_f.read_any(m_f.model_path(dist_dir, mode_name))
+
+		# The rows are iterated over to initialize a list of PitchDistribution
+		# objects, each on its own bins.
+		for i, d in enumerate(rows):
+			start, stop = d['first_bin'], d['first_bin'] + d['num_bins']
+			obj_list.append(p_d.PitchDistribution(bins[start:stop],
+				            vals[i, start:stop], kernel_width=d['kernel_width'],
 				            source=d['source'], ref_freq=d['ref_freq'],
 				            segment=d['segmentation'], overlap=d['overlap']))
-		return obj_list
\ No newline at end of file
+		return obj_list
+
+	def load_model_set(self, mode_names, dist_dir='./'):
+		"""-------------------------------------------------------------------------
+		Returns the ModelSet of the given modes, where all chunk distributions are
+		stacked in a single matrix. The set is loaded from the model files once and
+		kept in the estimator, so the later chunks and estimations reuse it. It is
+		only reloaded if any of its model files is changed after it is loaded.
+		----------------------------------------------------------------------------
+		mode_names : Names of the modes to be loaded. The names of the files are
+		             expected to be "mode_name.model" or "mode_name.json"
+		dist_dir   : Directory where the model files are stored. If it is a
+		             ModelSet, e.g. attached from a ModelStore by each worker of
+		             a process pool, the subset of the modes is returned and
+		             nothing is loaded. See subset() of ModelSet.
+		-------------------------------------------------------------------------"""
+		if isinstance(dist_dir, m_s.ModelSet):
+			return dist_dir.subset(mode_names)
+
+		key = (os.path.abspath(dist_dir), tuple(mode_names))
+		if key not in self.model_sets or self.model_sets[key].is_stale():
+			self.model_sets[key] = m_s.load(mode_names, dist_dir=dist_dir)
+		return self.model_sets[key]
@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+from ModeTonicEstimation import ModeFunctions as mF
+
+# The default number of dimensions of the projection and the default number of
+# lists probed per trial. See build() and knn_distance_matrix().
+PROJECTION_DIM = 16
+NUM_PROBES = 8
+
+
+def _nearest(points, centroids):
+	# Returns the index of the nearest centroid of each point, in blocks of
+	# points, so that the (points x centroids) intermediate never exceeds
+	# BLOCK_SIZE of ModeFunctions. The squared distances are expanded into
+	# matrix products; the order of the centroids is all that is needed.
+	labels = np.empty(len(points), dtype=int)
+	sq_norms = (centroids ** 2).sum(axis=1)
+	block = max(1, mF.BLOCK_SIZE // max(1, len(centroids)))
+	for b in range(0, len(points), block):
+		labels[b:b + block] = np.argmin(sq_norms - 2 * np.dot(points[b:b + block], centroids.T), axis=1)
+	return labels
+
+
+def build(vals, dim=PROJECTION_DIM, num_lists=None, iterations=10, seed=0):
+	"""-------------------------------------------------------------------------
+	Builds an inverted file of the rows of a model matrix. The models are
+	projected on their first dim principal axes and clustered by k-means in
+	the projected space. Each cluster is a list of models; a trial is only
+	compared with the models in the lists whose centroids are the closest to
+	its projection.
+	----------------------------------------------------------------------------
+	vals       : 2-D array of the model values, one model per row, or a
+	             RowStack of them. The models are read a block of rows at a
+	             time, so only their projections are kept in memory.
+	dim        : The number of dimensions of the projection
+	num_lists  : The number of lists. If None, it is the square root of the
+	             number of models.
+	iterations : The number of k-means iterations
+	seed       : The seed of the random initialization of k-means
+	-------------------------------------------------------------------------"""
+	if getattr(vals, 'ndim', None) != 2:
+		vals = np.atleast_2d(np.asarray(vals, dtype=float))
+	num_models, num_bins = vals.shape
+	num_lists = int(round(np.sqrt(num_models))) if num_lists is None else num_lists
+	num_lists = max(1, min(num_lists, num_models))
+	block = max(1, mF.BLOCK_SIZE // max(1, num_bins))
+	blocks = [(b, b + block) for b in range(0, num_models, block)]
+
+	# The principal axes are the eigenvectors of the scatter matrix, in the
+	# order of decreasing eigenvalues. The mean and the scatter matrix are
+	# accumulated over the blocks of models.
+	mean = sum(np.asarray(vals[b:e], dtype=float).sum(axis=0) for b, e in blocks) / num_models
+	scatter = np.zeros((num_bins, num_bins))
+	for b, e in blocks:
+		centered = np.asarray(vals[b:e], dtype=float) - mean
+		scatter += np.dot(centered.T, centered)
+	eig_vals, eig_vecs = np.linalg.eigh(scatter)
+	components = eig_vecs[:, ::-1][:, :min(dim, num_bins)].T
+	projected = np.vstack([np.dot(np.asarray(vals[b:e], dtype=float) - mean, components.T) for b, e in blocks])
+
+	# k-means, initialized by randomly chosen models. An empty list keeps its
+	# centroid.
+	rng = np.random.RandomState(seed)
+	centroids = projected[rng.choice(num_models, num_lists, replace=False)]
+	for i in range(iterations):
+		labels = _nearest(projected, centroids)
+		counts = np.bincount(labels, minlength=num_lists)
+		sums = np.zeros(centroids.shape)
+		np.add.at(sums, labels, projected)
+		filled = counts > 0
+		centroids[filled] = sums[filled] / counts[filled, np.newaxis]
+
+	labels = _nearest(projected, centroids)
+	order = np.argsort(labels, kind='mergesort')
+	bounds = np.searchsorted(labels[order], np.arange(num_lists + 1))
+	return InvertedFile(mean, components, centroids, order, bounds)
+
+
+def knn_distance_matrix(trials, models, index, k, method='euclidean', num_probes=NUM_PROBES):
+	"""-------------------------------------------------------------------------
+	Calculates the approximate candidates of the k best (smallest) entries of
+	the distance matrix of trials and models, by an inverted file of the
+	models. Each trial is compared with the models in the num_probes lists
+	that are the closest to its projection; the rest of the entries are left
+	as infinity. The compared entries are the same as the entries of
+	distance_matrix() of ModeFunctions, but the k best of them may miss some
+	of the actual k best. More probes find more of them and compare more
+	models; num_probes equal to the number of lists is the brute force search.
+	----------------------------------------------------------------------------
+	trials     : 2-D array of distribution values, e.g. the shifted candidates
+	models     : 2-D array of the model values, the rows of index
+	index      : The InvertedFile of models
+	k          : The number of best entries needed. If the probed lists have
+	             fewer entries, all models are compared.
+	method     : The choice of distance method. See distance() of
+	             ModeFunctions. The lists are probed by the euclidean distance
+	             of the projections, for any method.
+	num_probes : The number of lists probed per trial
+	-------------------------------------------------------------------------"""
+	trials = np.atleast_2d(np.asarray(trials, dtype=float))
+	num_probes = min(num_probes, index.num_lists())
+	probes = np.argsort(index.list_distances(trials), axis=1, kind='mergesort')[:, :num_probes]
+	rows = [np.concatenate([index.members(l) for l in trial_probes]) for trial_probes in probes]
+
+	if num_probes == index.num_lists() or sum(len(r) for r in rows) < k:
+		return mF.distance_matrix(trials, models, method=method)
+
+	dist_mat = np.full((len(trials), len(models)), np.inf)
+	for t, trial_rows in enumerate(rows):
+		dist_mat[t, trial_rows] = mF.distance_matrix(trials[t], models[trial_rows], method=method)[0]
+	return dist_mat
+
+
+class InvertedFile:
+
+	def __init__(self, mean, components, centroids, order, bounds):
+		"""------------------------------------------------------------------------
+		An inverted file of a model matrix, for the approximate nearest neighbor
+		search. See build().
+		---------------------------------------------------------------------------
+		mean       : The mean of the models, subtracted before the projection
+		components : 2-D array of the principal axes, one axis per row
+		centroids  : 2-D array of the centroids of the lists, in the projected
+		             space
+		order      : The models, sorted by their lists
+		bounds     : The models of the lth list are order[bounds[l]:bounds[l+1]]
+		------------------------------------------------------------------------"""
+		self.mean = np.asarray(mean, dtype=float)
+		self.components = np.asarray(components, dtype=float)
+		self.centroids = np.asarray(centroids, dtype=float)
+		self.order = np.asarray(order, dtype=int)
+		self.bounds = np.asarray(bounds, dtype=int)
+
+	def num_lists(self):
+		return len(self.centroids)
+
+	def members(self, l):
+		"""-------------------------------------------------------------------------
+		Returns the rows of the models in the lth list.
+		-------------------------------------------------------------------------"""
+		return self.order[self.bounds[l]:self.bounds[l + 1]]
+
+	def project(self, vals):
+		"""-------------------------------------------------------------------------
+		Projects the rows of vals on the principal axes of the models.
+		-------------------------------------------------------------------------"""
+		return np.dot(np.atleast_2d(vals) - self.mean, self.components.T)
+
+	def list_distances(self, vals):
+		"""-------------------------------------------------------------------------
+		Returns the euclidean distances of the projections of the rows of vals
+		from the centroids of the lists, one row per row of vals.
+		-------------------------------------------------------------------------"""
+		return mF.distance_matrix(self.project(vals), self.centroids, method='euclidean')
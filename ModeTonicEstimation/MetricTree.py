@@ -0,0 +1,210 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+import heapq
+import os
+from ModeTonicEstimation import ModeFunctions as mF
+
+# The ball tree of a mode model is saved next to its model file, as
+# "mode_name.tree". It is a NumPy archive of the flat node arrays below and
+# the (size, modification time) of the model file it is built from, so a tree
+# that is older than its model file is never used.
+TREE_EXT = '.tree'
+
+# The distances that the tree can search. These are true metrics, so the
+# triangle inequality bounds the distances to all points in a ball.
+METRICS = ['manhattan', 'euclidean', 'l3']
+
+# The maximum number of models in a leaf. The leaves are compared by
+# distance_matrix() of ModeFunctions at once.
+LEAF_SIZE = 32
+
+
+def tree_path(model_fname):
+	"""-------------------------------------------------------------------------
+	Returns the path of the tree file of a model file, e.g. "mode_name.tree"
+	for "mode_name.json" or "mode_name.model".
+	-------------------------------------------------------------------------"""
+	return os.path.splitext(model_fname)[0] + TREE_EXT
+
+
+def build(vals, leaf_size=LEAF_SIZE):
+	"""-------------------------------------------------------------------------
+	Builds a ball tree of the rows of a model matrix. Each node is a ball,
+	i.e. the mean of its models and its radius: the largest distance of its
+	models from the mean, for each of METRICS. A node is split in two halves
+	along the direction between two distant models, until there are at most
+	leaf_size models in it. The order of the models isn't changed; the models
+	of each node are a range of the permutation perm.
+	----------------------------------------------------------------------------
+	vals      : 2-D array of the model values, one model per row
+	leaf_size : The maximum number of models in a leaf
+	-------------------------------------------------------------------------"""
+	vals = np.atleast_2d(np.asarray(vals, dtype=float))
+	perm = np.arange(len(vals))
+	starts, stops, lefts, rights = [0], [len(vals)], [-1], [-1]
+
+	node = 0
+	while node < len(starts):
+		start, stop = starts[node], stops[node]
+		if stop - start > leaf_size:
+			# The models are sorted by their projections on the line between
+			# the model farthest from the mean and the model farthest from it
+			pts = vals[perm[start:stop]]
+			far = pts[np.argmax(((pts - pts.mean(axis=0)) ** 2).sum(axis=1))]
+			other = pts[np.argmax(((pts - far) ** 2).sum(axis=1))]
+			order = np.argsort(np.dot(pts - far, other - far), kind='mergesort')
+			perm[start:stop] = perm[start:stop][order]
+
+			mid = start + (stop - start) // 2
+			lefts[node], rights[node] = len(starts), len(starts) + 1
+			starts += [start, mid]
+			stops += [mid, stop]
+			lefts += [-1, -1]
+			rights += [-1, -1]
+		node += 1
+
+	starts, stops = np.array(starts, dtype=int), np.array(stops, dtype=int)
+	centers = np.array([vals[perm[s:e]].mean(axis=0) for s, e in zip(starts, stops)]).reshape(-1, vals.shape[1])
+	radii = dict((method, np.array([mF.distance_matrix(c, vals[perm[s:e]], method=method).max()
+	                                for c, s, e in zip(centers, starts, stops)]))
+	             for method in METRICS)
+	return MetricTree(perm, starts, stops, np.array(lefts, dtype=int), np.array(rights, dtype=int), centers, radii)
+
+
+def load(fname, stamp=None, shape=None):
+	"""-------------------------------------------------------------------------
+	Loads a tree file. None is returned if the file doesn't exist, or if it
+	isn't built from the given model file or model matrix.
+	----------------------------------------------------------------------------
+	fname : The name of the tree file
+	stamp : The (size, modification time) of the model file, as recorded by
+	        file_stamp() of ModelSet
+	shape : The shape of the model matrix
+	-------------------------------------------------------------------------"""
+	if not os.path.isfile(fname):
+		return None
+	with np.load(fname) as f:
+		arrs = dict((key, f[key]) for key in f.files)
+
+	if stamp is not None and tuple(arrs['stamp']) != tuple(stamp):
+		return None
+	if shape is not None and tuple(arrs['shape']) != tuple(shape):
+		return None
+	return MetricTree(arrs['perm'], arrs['starts'], arrs['stops'], arrs['lefts'], arrs['rights'],
+	                  arrs['centers'], dict((method, arrs['radius_' + method]) for method in METRICS))
+
+
+def knn_distance_matrix(trials, models, trees, k, method='euclidean'):
+	"""-------------------------------------------------------------------------
+	Calculates the entries of the distance matrix of trials and models that can
+	be among its k best (smallest), by searching the ball trees of the models.
+	The rest of the entries are left as infinity, so top_k() of the result is
+	the same as the top_k() of distance_matrix() of ModeFunctions.
+
+	The balls of all (trial, tree) pairs are visited in the order of their
+	lower bounds, i.e. the distance of the trial from the center minus the
+	radius. Once k entries are scored, the kth best of them is an upper bound
+	of the kth best distance; the balls whose bounds exceed it can't contain
+	any of the k best entries, so they are skipped.
+	----------------------------------------------------------------------------
+	trials : 2-D array of distribution values, e.g. the shifted candidates
+	models : 2-D array of the model values
+	trees  : List of MetricTree objects. The rows of each tree are the rows of
+	         models from its offset on.
+	k      : The number of best entries needed
+	method : 'manhattan', 'euclidean' or 'l3'
+	-------------------------------------------------------------------------"""
+	if method not in METRICS:
+		raise ValueError('The tree search is only available for ' + ', '.join(METRICS))
+	trials = np.atleast_2d(np.asarray(trials, dtype=float))
+	dist_mat = np.full((len(trials), len(models)), np.inf)
+
+	# The heap holds (lower bound, trial, tree, node, center distance) tuples
+	heap = []
+	for i, tree in enumerate(trees):
+		center_dists = mF.distance_matrix(trials, tree.centers[:1], method=method)[:, 0]
+		heap += [(d - tree.radii[method][0], t, i, 0, d) for t, d in enumerate(center_dists)]
+	heapq.heapify(heap)
+
+	best = np.zeros(0)
+	threshold = np.inf
+	while heap:
+		bound, t, i, node, center_dist = heapq.heappop(heap)
+		tree = trees[i]
+		if tree.is_pruned(node, center_dist, threshold, method):
+			continue
+
+		if tree.lefts[node] < 0:
+			rows = tree.offset + tree.perm[tree.starts[node]:tree.stops[node]]
+			dists = mF.distance_matrix(trials[t], models[rows], method=method)[0]
+			dist_mat[t, rows] = dists
+
+			best = np.concatenate((best, dists))
+			if len(best) >= k:
+				best = np.partition(best, k - 1)[:k]
+				threshold = best.max()
+		else:
+			children = [tree.lefts[node], tree.rights[node]]
+			center_dists = mF.distance_matrix(trials[t], tree.centers[children], method=method)[0]
+			for child, d in zip(children, center_dists):
+				if not tree.is_pruned(child, d, threshold, method):
+					heapq.heappush(heap, (d - tree.radii[method][child], t, i, child, d))
+
+	return dist_mat
+
+
+class MetricTree:
+
+	def __init__(self, perm, starts, stops, lefts, rights, centers, radii, offset=0):
+		"""------------------------------------------------------------------------
+		A ball tree of a model matrix, for the exact nearest neighbor search of
+		the Minkowski distances. The nodes are kept in flat arrays; node 0 is the
+		root. See build().
+		---------------------------------------------------------------------------
+		perm    : The permutation of the models, such that the models of each
+		          node are a range of it
+		starts  : The start of the range of each node in perm
+		stops   : The end of the range of each node in perm
+		lefts   : The left child of each node, -1 for the leaves
+		rights  : The right child of each node, -1 for the leaves
+		centers : 2-D array of the centers of the nodes, i.e. the mean of their
+		          models
+		radii   : Dictionary of the radii of the nodes for each of METRICS
+		offset  : The row of the first model of the tree in the model matrix it
+		          is searched with, if the matrix stacks several models
+		------------------------------------------------------------------------"""
+		self.perm = np.asarray(perm, dtype=int)
+		self.starts = np.asarray(starts, dtype=int)
+		self.stops = np.asarray(stops, dtype=int)
+		self.lefts = np.asarray(lefts, dtype=int)
+		self.rights = np.asarray(rights, dtype=int)
+		self.centers = np.asarray(centers, dtype=float)
+		self.radii = dict((method, np.asarray(r, dtype=float)) for method, r in radii.items())
+		self.offset = offset
+
+	def __len__(self):
+		return len(self.perm)
+
+	def is_pruned(self, node, center_dist, threshold, method):
+		"""-------------------------------------------------------------------------
+		Checks whether the ball of a node is farther than the threshold from a
+		trial, given the distance of the trial from its center. A relative slack
+		is allowed, so that a ball isn't pruned due to the floating point
+		rounding.
+		-------------------------------------------------------------------------"""
+		return center_dist > (threshold + self.radii[method][node]) * (1 + mF.BOUND_TOL)
+
+	def save(self, fname, stamp=None):
+		"""-------------------------------------------------------------------------
+		Saves the tree to a file. See load().
+		----------------------------------------------------------------------------
+		fname : The name of the file to be created
+		stamp : The (size, modification time) of the model file the tree is
+		        built from
+		-------------------------------------------------------------------------"""
+		arrs = dict(('radius_' + method, r) for method, r in self.radii.items())
+		with open(fname, 'wb') as f:
+			np.savez(f, perm=self.perm, starts=self.starts, stops=self.stops, lefts=self.lefts,
+			         rights=self.rights, centers=self.centers,
+			         shape=np.array([len(self), self.centers.shape[1]]),
+			         stamp=np.array([-1, -1] if stamp is None else stamp, dtype=float), **arrs)
@@ -1,12 +1,18 @@
 # -*- coding: utf-8 -*-
 import numpy as np
-import math
-from scipy.spatial import distance
-from scipy.integrate import simps
-from scipy.stats import norm
 
 import PitchDistribution as pD
 
+# The convolution is done in the frequency domain, if the kernel is at least
+# _FFT_KERNEL_LEN samples long and the direct convolution would take at least
+# _FFT_MIN_WORK multiplications. np.convolve is faster below these.
+_FFT_KERNEL_LEN = 128
+_FFT_MIN_WORK = 2 ** 18
+
+# The sampled kernels are cached, keyed by (smooth_factor, step_size,
+# kernel_type), since the same kernel is used for all the chunks/recordings.
+_kernel_bank = {}
+
 def generate_pd(cent_track, ref_freq=440, smooth_factor=7.5, step_size=7.5,
 				source='', segment='all', overlap='-'):
 	"""-------------------------------------------------------------------------
@@ -30,57 +36,243 @@ def generate_pd(cent_track, ref_freq=440, smooth_factor=7.5, step_size=7.5,
 	                This is only useful for Chordia Estimation.
 	-------------------------------------------------------------------------"""
 
-	### Some extra interval is added to the beginning and end since the
-	### superposed Gaussian for smooth_factor would introduce some tails in the
-	### ends. These vanish after 3 sigmas(=smmoth_factor).
+	# The samples are counted on the canonical grid, where the bins are the
+	# multiples of step_size and 0 is always a bin. Each sample's bin is found
+	# by rounding, so the histogram is generated in a single pass, without
+	# searching the bin edges. NaN, -infinity and +infinity are filtered out.
+	first_bin, counts = histogram_counts(cent_track, step_size=step_size)
 
-	### The limits are also quantized to be a multiple of chosen step-size
-	### smooth_factor = standard deviation fo the gaussian kernel
+	# Normalizes the histogram as a density, smoothens it if requested and
+	# initializes the PitchDistribution object
+	return histogram_to_pd(first_bin, counts, ref_freq=ref_freq, smooth_factor=smooth_factor,
+	                       step_size=step_size, source=source, segment=segment, overlap=overlap)
 
-	### TODO: filter out the NaN, -infinity and +infinity from the pitch track
 
-	# Finds the endpoints of the histogram edges. Histogram bins will be
-	# generated as the midpoints of these edges. 
-	min_edge = min(cent_track) - (step_size / 2.0)
-	max_edge = max(cent_track) + (step_size / 2.0)
-	pd_edges = np.concatenate([np.arange(-step_size/2.0, min_edge, -step_size)[::-1],
-	                           np.arange(step_size/2.0, max_edge, step_size)])
+def gaussian_kernel(smooth_factor, step_size):
+	"""-------------------------------------------------------------------------
+	Samples the Gaussian kernel of the kernel density estimation on the bin
+	grid, up to 5 standard deviations on both sides.
+	----------------------------------------------------------------------------
+	smooth_factor:  The standard deviation of the gaussian kernel
+	step_size:      The step size of the bins
+	-------------------------------------------------------------------------"""
+	xn = np.concatenate([np.arange(0, - 5 * smooth_factor, -step_size)[::-1],
+	    np.arange(step_size, 5 * smooth_factor, step_size)])
+	return np.exp(-0.5 * (xn / float(smooth_factor)) ** 2) / (smooth_factor * np.sqrt(2 * np.pi))
 
-	# An exceptional case is when min_bin and max_bin are both positive
-	# In this case, pd_edges would be in the range of [step_size/2, max_bin].
-	# If so, a -step_size is inserted to the head, to make sure 0 would be
-	# in pd_bins. The same procedure is repeated for the case when both
-	# are negative. Then, step_size is inserted to the tail.
-	pd_edges = pd_edges if -step_size/2.0 in pd_edges else np.insert(pd_edges, 0, -step_size/2.0)
-	pd_edges = pd_edges if step_size/2.0 in pd_edges else np.append(pd_edges, step_size/2.0)
 
-	# Generates the histogram and bins (i.e. the midpoints of edges)
-	pd_vals, pd_edges = np.histogram(cent_track, bins=pd_edges, density=True)
-	pd_bins = np.convolve(pd_edges, [0.5,0.5])[1:-1]
+KERNEL_TYPES = {'gaussian': gaussian_kernel}
 
-	if smooth_factor > 0: # kernel density estimation (approximated)
-		# smooth the histogram
-		normal_dist = norm(loc = 0, scale = smooth_factor)
-		xn = np.concatenate([np.arange(0, - 5 * smooth_factor, -step_size)[::-1], 
-		    np.arange(step_size, 5 * smooth_factor, step_size)])
-		sampled_norm = normal_dist.pdf(xn)
 
-		extra_num_bins = len(sampled_norm)/2 # convolution generates tails
-		pd_vals = np.convolve(pd_vals, sampled_norm)[extra_num_bins:-extra_num_bins]
+def kernel(smooth_factor, step_size, kernel_type='gaussian'):
+	"""-------------------------------------------------------------------------
+	Returns the sampled kernel from the kernel bank. The kernel is sampled on
+	the first request and cached; the cached array is read-only.
+	----------------------------------------------------------------------------
+	smooth_factor:  The width (standard deviation) of the kernel
+	step_size:      The step size of the bins
+	kernel_type:    The name of the kernel, one of KERNEL_TYPES
+	-------------------------------------------------------------------------"""
+	key = (float(smooth_factor), float(step_size), kernel_type)
+	try:
+		return _kernel_bank[key]
+	except KeyError:
+		pass
+
+	if kernel_type not in KERNEL_TYPES:
+		raise ValueError('Unknown kernel type: ' + str(kernel_type))
+	sampled = KERNEL_TYPES[kernel_type](smooth_factor, step_size)
+	sampled.flags.writeable = False
+	_kernel_bank[key] = sampled
+	return sampled
 
-		# normalize the area under the curve
-		area = simps(pd_vals, dx=step_size)
-		pd_vals = pd_vals/area
 
-	# Sanity check. If the histogram bins and vals lengths are different, we
-	# are in trouble. This is an important assumption of higher level functions.
-	if(len(pd_bins) != len(pd_vals)):
-		raise ValueError('Lengths of bins and Vals are different')
+def _use_fft(num_vals, num_taps):
+	return num_taps >= _FFT_KERNEL_LEN and num_vals * num_taps >= _FFT_MIN_WORK
+
+
+def convolve(vals, sampled_kernel):
+	"""-------------------------------------------------------------------------
+	The full linear convolution of the values with the kernel, as np.convolve.
+	The long convolutions are computed by FFT; the round-off of the FFT might
+	produce tiny negative values where the result should be zero, so these are
+	clipped.
+	-------------------------------------------------------------------------"""
+	if not _use_fft(len(vals), len(sampled_kernel)):
+		return np.convolve(vals, sampled_kernel)
+
+	conv_len = len(vals) + len(sampled_kernel) - 1
+	fft_len = 1 << (conv_len - 1).bit_length()
+	conv = np.fft.irfft(np.fft.rfft(vals, fft_len) * np.fft.rfft(sampled_kernel, fft_len), fft_len)[:conv_len]
+	return np.maximum(conv, 0)
+
+
+def smooth(pd_vals, smooth_factor=7.5, step_size=7.5, kernel_type='gaussian'):
+	"""-------------------------------------------------------------------------
+	Smoothens the values of a histogram by convolving them with a sampled
+	kernel (approximated kernel density estimation) and normalizes the area
+	under the result to 1. The area is computed as the sum of the values times
+	the step size, which agrees with the Simpson's rule on the fine grids.
+	----------------------------------------------------------------------------
+	pd_vals:        The histogram values
+	smooth_factor:  The standard deviation of the gaussian kernel
+	step_size:      The step size of the histogram bins
+	kernel_type:    The kernel of the density estimation. See kernel().
+	-------------------------------------------------------------------------"""
+	sampled_kernel = kernel(smooth_factor, step_size, kernel_type)
+
+	extra_num_bins = len(sampled_kernel) // 2 # convolution generates tails
+	pd_vals = convolve(pd_vals, sampled_kernel)[extra_num_bins:len(pd_vals) + extra_num_bins]
+
+	# normalize the area under the curve
+	return pd_vals / (pd_vals.sum() * step_size)
+
+
+def histogram_counts(cent_track, step_size=7.5):
+	"""-------------------------------------------------------------------------
+	Counts the samples of a pitch track on the canonical bin grid, where the
+	kth bin is centred at k * step_size cents and the bin of zero cents is
+	always included. The bin of a sample is found by rounding, instead of a
+	search over bin edges. NaN and infinite values are ignored. Since all
+	histograms share the same grid, they can be summed by aligning their first
+	bin indices.
+	----------------------------------------------------------------------------
+	cent_track:     1-D array of frequency values in cents.
+	step_size:      The step size of the bins.
+	----------------------------------------------------------------------------
+	first_bin:      The index of the first bin, i.e. the first bin is at
+	                first_bin * step_size cents.
+	counts:         The number of samples in each bin, starting from first_bin
+	-------------------------------------------------------------------------"""
+	cent_track = np.asarray(cent_track, dtype=float)
+	cent_track = cent_track[np.isfinite(cent_track)]
+
+	# The kth bin spans [(k - 0.5), (k + 0.5)) * step_size.
+	bin_idxs = np.floor(cent_track / step_size + 0.5).astype(int)
+	first_bin = min(bin_idxs.min(), 0) if len(bin_idxs) else 0
+	last_bin = max(bin_idxs.max(), 0) if len(bin_idxs) else 0
+
+	counts = np.bincount(bin_idxs - first_bin, minlength=last_bin - first_bin + 1)
+	return first_bin, counts
+
+
+def histogram_to_pd(first_bin, counts, ref_freq=440, smooth_factor=7.5, step_size=7.5,
+                    source='', segment='all', overlap='-'):
+	"""-------------------------------------------------------------------------
+	Generates the Pitch Distribution from the sample counts on the canonical
+	bin grid (see histogram_counts()). The counts are normalized as a density
+	and smoothened as in generate_pd().
+	----------------------------------------------------------------------------
+	first_bin:      The index of the first bin of counts
+	counts:         The number of samples in each bin
+	The remaining parameters are the same as generate_pd().
+	-------------------------------------------------------------------------"""
+	counts = np.asarray(counts)
+	if counts.sum() == 0:
+		raise ValueError('The histogram is empty')
+
+	pd_bins = (first_bin + np.arange(len(counts))) * float(step_size)
+	pd_vals = counts / float(step_size) / counts.sum()
+
+	if smooth_factor > 0: # kernel density estimation (approximated)
+		pd_vals = smooth(pd_vals, smooth_factor=smooth_factor, step_size=step_size)
 
-	# Initializes the PitchDistribution object and returns it.
 	return pD.PitchDistribution(pd_bins, pd_vals, kernel_width=smooth_factor, source=source, ref_freq=ref_freq,
 	                             segment=segment, overlap=overlap)
 
+
+def smooth_circular(pcd_vals, smooth_factor=7.5, step_size=7.5, kernel_type='gaussian'):
+	"""-------------------------------------------------------------------------
+	The circular counterpart of smooth() for pitch class histograms. The
+	convolution wraps around the octave, so the tails of the kernel at one end
+	are added to the other end instead of being cut off. The sum of the values
+	is preserved by the wrap-around, so the area is normalized by the sum.
+	----------------------------------------------------------------------------
+	pcd_vals:       The pitch class histogram values
+	smooth_factor:  The standard deviation of the gaussian kernel
+	step_size:      The step size of the histogram bins
+	kernel_type:    The kernel of the density estimation. See kernel().
+	-------------------------------------------------------------------------"""
+	sampled_kernel = kernel(smooth_factor, step_size, kernel_type)
+	extra_num_bins = len(sampled_kernel) // 2
+	num_bins = len(pcd_vals)
+
+	if _use_fft(num_bins, len(sampled_kernel)):
+		# The kernel is wrapped onto the octave and the circular convolution
+		# is computed by FFT, with the size of an octave.
+		wrapped_kernel = np.bincount(np.arange(-extra_num_bins, len(sampled_kernel) - extra_num_bins) % num_bins,
+		                             weights=sampled_kernel, minlength=num_bins)
+		pcd_vals = np.fft.irfft(np.fft.rfft(pcd_vals) * np.fft.rfft(wrapped_kernel), num_bins)
+		pcd_vals = np.maximum(pcd_vals, 0)
+	else:
+		# The values are extended circularly by the half length of the kernel
+		# from both sides; the kernel might be longer than an octave, hence the
+		# modulo.
+		wrapped = np.take(pcd_vals, np.arange(-extra_num_bins, num_bins + extra_num_bins), mode='wrap')
+		pcd_vals = np.convolve(wrapped, sampled_kernel, mode='valid')
+
+	# normalize the area under the curve
+	return pcd_vals / (pcd_vals.sum() * step_size)
+
+
+def pitch_class_counts(cent_track, step_size=7.5):
+	"""-------------------------------------------------------------------------
+	Counts the samples of a pitch track directly on the pitch class grid, i.e.
+	the bins of histogram_counts() wrapped to a single octave. NaN and infinite
+	values are ignored.
+	----------------------------------------------------------------------------
+	cent_track:     1-D array of frequency values in cents.
+	step_size:      The step size of the bins.
+	-------------------------------------------------------------------------"""
+	cent_track = np.asarray(cent_track, dtype=float)
+	cent_track = cent_track[np.isfinite(cent_track)]
+
+	num_bins = len(np.arange(0, 1200, step_size))
+	bin_idxs = np.floor(cent_track / step_size + 0.5).astype(int) % num_bins
+	return np.bincount(bin_idxs, minlength=num_bins)
+
+
+def histogram_to_pcd(first_bin, counts, ref_freq=440, smooth_factor=7.5, step_size=7.5,
+                     source='', segment='all', overlap='-'):
+	"""-------------------------------------------------------------------------
+	Generates the Pitch Class Distribution from the sample counts on the
+	canonical bin grid (see histogram_counts()), without generating the Pitch
+	Distribution first. The counts are wrapped to a single octave, normalized as
+	a density and smoothened circularly (see smooth_circular()).
+	----------------------------------------------------------------------------
+	first_bin:      The index of the first bin of counts
+	counts:         The number of samples in each bin
+	The remaining parameters are the same as generate_pd().
+	-------------------------------------------------------------------------"""
+	counts = np.asarray(counts)
+	if counts.sum() == 0:
+		raise ValueError('The histogram is empty')
+
+	pcd_bins = np.arange(0, 1200, step_size)
+	bin_idxs = (first_bin + np.arange(len(counts))) % len(pcd_bins)
+	pcd_vals = np.bincount(bin_idxs, weights=counts, minlength=len(pcd_bins)) / float(step_size) / counts.sum()
+
+	if smooth_factor > 0: # kernel density estimation (approximated)
+		pcd_vals = smooth_circular(pcd_vals, smooth_factor=smooth_factor, step_size=step_size)
+
+	return pD.PitchDistribution(pcd_bins, pcd_vals, kernel_width=smooth_factor, source=source,
+	                             ref_freq=ref_freq, segment=segment, overlap=overlap)
+
+
+def generate_pcd_from_cents(cent_track, ref_freq=440, smooth_factor=7.5, step_size=7.5,
+                            source='', segment='all', overlap='-'):
+	"""-------------------------------------------------------------------------
+	Given the pitch track in the unit of cents, generates its Pitch Class
+	Distribution directly, without the intermediate Pitch Distribution. The
+	samples are counted on the pitch class grid and the histogram is smoothened
+	with a wrap-around convolution. The parameters are the same as
+	generate_pd().
+	-------------------------------------------------------------------------"""
+	return histogram_to_pcd(0, pitch_class_counts(cent_track, step_size=step_size), ref_freq=ref_freq,
+	                        smooth_factor=smooth_factor, step_size=step_size, source=source,
+	                        segment=segment, overlap=overlap)
+
+
 def generate_pcd(pd):
 	"""-------------------------------------------------------------------------
 	Given the pitch distribution of a recording, generates its pitch class
@@ -91,31 +283,38 @@ def generate_pcd(pd):
 
 	# Initializations
 	pcd_bins = np.arange(0, 1200, pd.step_size)
-	pcd_vals = np.zeros(len(pcd_bins))
 
-	# Octave wrapping
-	for k in range(len(pd.bins)):
-		idx = int((pd.bins[k] % 1200) / pd.step_size)
-		idx = idx if idx != 160 else 0
-		pcd_vals[idx] += pd.vals[k]
+	# Octave wrapping. The bins are multiples of the step size, so the pitch
+	# class of each bin is found by rounding and the values of the same pitch
+	# class are summed at once.
+	idxs = np.round((np.asarray(pd.bins) % 1200) / pd.step_size).astype(int) % len(pcd_bins)
+	pcd_vals = np.bincount(idxs, weights=pd.vals, minlength=len(pcd_bins))
 
 	# Initializes the PitchDistribution object and returns it.
 	return pD.PitchDistribution(pcd_bins, pcd_vals, kernel_width=pd.kernel_width, source=pd.source,
 	                             ref_freq=pd.ref_freq, segment=pd.segmentation, overlap=pd.overlap)
 
 
-def hz_to_cent(hz_track, ref_freq):
+def hz_to_cent(hz_track, ref_freq, drop_zeros=True):
 	"""-------------------------------------------------------------------------
 	Converts an array of Hertz values into cents.
 	----------------------------------------------------------------------------
-	hz_track : The 1-D array of Hertz values
+	hz_track   : The 1-D array of Hertz values
 	ref_freq	: Reference frequency for cent conversion
+	drop_zeros : If False, the 0 Hz values are converted to NaN instead of being
+	             removed, so the output stays aligned with the timestamps.
 	-------------------------------------------------------------------------"""
 	hz_track = np.array(hz_track)
 
 	# The 0 Hz values are removed, not only because they are meaningless,
 	# but also logarithm of 0 is problematic.
-	return np.log2(hz_track[hz_track>0] / ref_freq) * 1200.0
+	if drop_zeros:
+		return np.log2(hz_track[hz_track>0] / ref_freq) * 1200.0
+
+	cent_track = np.full(hz_track.shape, np.nan)
+	voiced = hz_track > 0
+	cent_track[voiced] = np.log2(hz_track[voiced] / ref_freq) * 1200.0
+	return cent_track
 
 
 def cent_to_hz(cent_track, ref_freq):
@@ -130,31 +329,225 @@ def cent_to_hz(cent_track, ref_freq):
 	return 2 ** (cent_track / 1200) * ref_freq
 
 
+def stack_vals(dists):
+	"""-------------------------------------------------------------------------
+	Stacks the values of a list of distributions into a 2-D array, where each
+	row is a distribution. If a 2-D array is given, it is returned as it is.
+	The distributions are expected to be defined on the same bins.
+	----------------------------------------------------------------------------
+	dists : List of PitchDistribution objects or a 2-D array of their values
+	-------------------------------------------------------------------------"""
+	if isinstance(dists, np.ndarray):
+		return np.atleast_2d(dists)
+	return np.array([d.vals for d in dists], dtype=float)
+
+
+def shifted_vals(dist, shift_idxs):
+	"""-------------------------------------------------------------------------
+	Generates the values of the shifted versions of a distribution at once. The
+	ith row of the result is equal to dist.shift(shift_idxs[i]).vals. For PCDs
+	the rows are taken from a circulant view of the values; for PDs, they are
+	taken from an offset view of the zero-padded values. In both cases the
+	shifts are read from a single strided view, without building intermediate
+	PitchDistribution objects.
+	----------------------------------------------------------------------------
+	dist       : PitchDistribution object to be shifted
+	shift_idxs : List of the number of samples to shift. See shift() of
+	             PitchDistribution.
+	-------------------------------------------------------------------------"""
+	vals = np.asarray(dist.vals, dtype=float)
+	shift_idxs = np.asarray(shift_idxs, dtype=int).reshape(-1)
+	num_bins = len(vals)
+
+	if dist.is_pcd():
+		# The values are repeated once, so that the row starting at index i of
+		# the (num_bins x num_bins) strided view is the circular shift by i.
+		padded = np.concatenate((vals, vals))
+		starts = shift_idxs % num_bins
+	else:
+		# The values are zero padded from both sides by the largest shifts,
+		# so each shift is a window of the padded array.
+		num_left = max(-shift_idxs.min(), 0) if len(shift_idxs) else 0
+		num_right = max(shift_idxs.max(), 0) if len(shift_idxs) else 0
+		padded = np.concatenate((np.zeros(num_left), vals, np.zeros(num_right)))
+		starts = shift_idxs + num_left
+
+	windows = np.lib.stride_tricks.as_strided(padded, shape=(len(padded) - num_bins + 1, num_bins),
+	                                          strides=(padded.strides[0], padded.strides[0]))
+	return windows[starts]
+
+
 def generate_distance_matrix(dist, peak_idxs, mode_dists, method='euclidean'):
 	"""-------------------------------------------------------------------------
-	Iteratively calculates the distance of the input distribution from each 
-	(mode candidate, tonic candidate) pair. This is a generic function, that is
-	independent of distribution type or any other parameter value.
+	Calculates the distance of the input distribution from each (mode candidate,
+	tonic candidate) pair. This is a generic function, that is independent of
+	distribution type or any other parameter value. The shifted candidates and
+	the mode models are stacked into matrices and the whole matrix is computed
+	by distance_matrix() in a single batch.
 	----------------------------------------------------------------------------
 	dist       : Input distribution that is to be estimated
 	peak_idxs  : List of indices of dist's peaks
-	mode_dists : List of candidate mode distributions
+	mode_dists : List of candidate mode distributions, or a 2-D array of their
+	             values (one mode per row)
 	method     : The distance method to be used. The available distances are
 	             listed in distance() function.
 	-------------------------------------------------------------------------"""
+	return distance_matrix(shifted_vals(dist, peak_idxs), stack_vals(mode_dists), method=method)
+
+
+def shift_distance_matrix(dist, mode_dists, method='euclidean'):
+	"""-------------------------------------------------------------------------
+	Calculates the distance of every circular shift of a PCD from each mode
+	candidate. The ith row of the result is the distance vector of the shift by
+	i samples, i.e. the same as generate_distance_matrix(dist, range(len(bins)),
+	mode_dists). For euclidean and correlation, the score of all the shifts is
+	obtained at once from the circular cross-correlation of the distribution
+	with each model, computed by FFT:
+
+	    corr(i)      = 1 - c(i)
+	    euclidean(i) = sqrt(|dist|^2 + |model|^2 - 2c(i))
+
+	where c(i) = sum_j dist(j + i) * model(j). The other methods are computed
+	over the circulant matrix of shifts by distance_matrix().
+	----------------------------------------------------------------------------
+	dist       : Input PCD that is to be estimated
+	mode_dists : List of candidate mode PCDs, or a 2-D array of their values
+	method     : The distance method to be used. See distance().
+	-------------------------------------------------------------------------"""
+	if not dist.is_pcd():
+		raise ValueError('Exhaustive shift search is only defined for PCDs')
+
+	vals = np.asarray(dist.vals, dtype=float)
+	models = stack_vals(mode_dists)
+	num_bins = len(vals)
+
+	if method not in ['euclidean', 'corr']:
+		return generate_distance_matrix(dist, np.arange(num_bins), models, method=method)
+
+	# Circular cross-correlation of the distribution with each model. The rows
+	# of xcorr are the shifts and the columns are the models.
+	xcorr = np.fft.irfft(np.fft.rfft(vals)[:, np.newaxis] * np.conj(np.fft.rfft(models, axis=1)).T,
+	                     n=num_bins, axis=0)
+
+	if (method == 'corr'):
+		return 1.0 - xcorr
+
+	# Round-off might make tiny squared distances negative, so they are clipped
+	# before the square root.
+	sq_dist = np.dot(vals, vals) + (models ** 2).sum(axis=1)[np.newaxis, :] - 2 * xcorr
+	return np.sqrt(np.maximum(sq_dist, 0))
+
+
+# Maximum number of elements of the (trials x models x bins) intermediate
+# arrays, built by the element-wise distance methods. The batched search of
+# Chordia and InvertedFile bound their intermediates by it as well.
+BLOCK_SIZE = 2 ** 22
+
 
-	result = np.zeros((len(peak_idxs), len(mode_dists)))
+def _blocked_reduce(trials, models, func):
+	# Applies func on (trials x block of models x bins) slices, so that the
+	# broadcast intermediate never exceeds BLOCK_SIZE elements.
+	result = np.empty((trials.shape[0], models.shape[0]))
+	block = max(1, BLOCK_SIZE // max(1, trials.shape[0] * trials.shape[1]))
+	for b in range(0, models.shape[0], block):
+		result[:, b:b + block] = func(trials[:, np.newaxis, :], models[np.newaxis, b:b + block, :])
+	return result
 
-	# Iterates over the peaks, i.e. the tonic candidates
-	for i, cur_peak_idx in enumerate(peak_idxs):
-		trial = dist.shift(cur_peak_idx)
 
-		# Iterates over mode candidates
-		for j, cur_mode_dist in enumerate(mode_dists):
+def distance_matrix(trials, models, method='euclidean'):
+	"""-------------------------------------------------------------------------
+	Calculates the distances between each row of trials and each row of models
+	in a batch. The (i,j)th entry of the result is equal to
+	distance(trials[i], models[j], method). All methods are computed by blocked
+	broadcasting and reduced along the bins of each (trial, model) pair, so an
+	entry doesn't depend on the other rows, e.g. on how the models are split
+	into blocks. Bhattacharyya and correlation aren't computed by matrix
+	products for this reason, since the rounding of a BLAS product depends on
+	the shapes of the matrices.
+	----------------------------------------------------------------------------
+	trials : 2-D array of distribution values, e.g. the shifted candidates
+	models : 2-D array of distribution values, e.g. the mode models
+	method : The choice of distance method. See distance() for the list.
+	-------------------------------------------------------------------------"""
+	trials = np.atleast_2d(np.asarray(trials, dtype=float))
+	models = np.atleast_2d(np.asarray(models, dtype=float))
 
-			# Calls the distance function for each entry of the matrix
-			result[i][j] = distance(trial.vals, cur_mode_dist.vals, method=method)
-	return np.array(result)
+	# The Minkowski distances are computed from the differences rather than
+	# expanding the squares into matrix products, since the expansion loses
+	# precision for near neighbors, which are exactly the ones we look for.
+	if (method == 'euclidean'):
+		return np.sqrt(_blocked_reduce(trials, models, lambda t, m: ((t - m) ** 2).sum(axis=2)))
+
+	elif (method == 'manhattan'):
+		return _blocked_reduce(trials, models, lambda t, m: np.abs(t - m).sum(axis=2))
+
+	elif (method == 'l3'):
+		return _blocked_reduce(trials, models, lambda t, m: (np.abs(t - m) ** 3).sum(axis=2)) ** (1.0 / 3)
+
+	elif (method == 'bhat'):
+		with np.errstate(divide='ignore'):
+			return -np.log(_blocked_reduce(np.sqrt(trials), np.sqrt(models), lambda t, m: (t * m).sum(axis=2)))
+
+	# Since correlation and intersection are actually similarity measures,
+	# we take their inverse to be able to use them as distances. See distance()
+	elif (method == 'intersection'):
+		with np.errstate(divide='ignore'):
+			return trials.shape[1] / _blocked_reduce(trials, models, lambda t, m: np.minimum(t, m).sum(axis=2))
+
+	elif (method == 'corr'):
+		return 1.0 - _blocked_reduce(trials, models, lambda t, m: (t * m).sum(axis=2))
+
+	else:
+		return np.zeros((trials.shape[0], models.shape[0]))
+
+
+def distance_matrices(trials, models, methods, sqrt_models=None):
+	"""-------------------------------------------------------------------------
+	Calculates the distance matrices of trials and models for several distance
+	methods in a single pass. The matrix of each method is the same as
+	distance_matrix(); the intermediates that the methods share are computed
+	once. The absolute differences are reduced to all the requested Minkowski
+	distances in the same blocked broadcast, and the square roots of the
+	models are taken once for Bhattacharyya.
+	----------------------------------------------------------------------------
+	trials      : 2-D array of distribution values, e.g. the shifted candidates
+	models      : 2-D array of distribution values, e.g. the mode models
+	methods     : List of the distance methods. See distance() for the list.
+	sqrt_models : The square roots of the models for Bhattacharyya, if they
+	              are already computed, e.g. to compare several trial matrices
+	              with the same models
+	----------------------------------------------------------------------------
+	dist_mats   : List of the distance matrices, parallel to methods
+	-------------------------------------------------------------------------"""
+	trials = np.atleast_2d(np.asarray(trials, dtype=float))
+	models = np.atleast_2d(np.asarray(models, dtype=float))
+
+	# The sums of the powers of the absolute differences, keyed by the order
+	orders = sorted(set(MINKOWSKI_ORDERS[m] for m in methods if m in MINKOWSKI_ORDERS))
+	sums = dict((p, np.empty((trials.shape[0], models.shape[0]))) for p in orders)
+	if orders:
+		block = max(1, BLOCK_SIZE // max(1, trials.shape[0] * trials.shape[1]))
+		for b in range(0, models.shape[0], block):
+			diff = np.abs(trials[:, np.newaxis, :] - models[np.newaxis, b:b + block, :])
+			for p in orders:
+				sums[p][:, b:b + block] = (diff if p == 1 else diff ** p).sum(axis=2)
+
+	dist_mats = []
+	for method in methods:
+		if (method == 'manhattan'):
+			dist_mats.append(sums[1])
+		elif (method == 'euclidean'):
+			dist_mats.append(np.sqrt(sums[2]))
+		elif (method == 'l3'):
+			dist_mats.append(sums[3] ** (1.0 / 3))
+		elif (method == 'bhat'):
+			sqrt_models = np.sqrt(models) if sqrt_models is None else sqrt_models
+			with np.errstate(divide='ignore'):
+				dist_mats.append(-np.log(_blocked_reduce(np.sqrt(trials), sqrt_models,
+				                                         lambda t, m: (t * m).sum(axis=2))))
+		else:
+			dist_mats.append(distance_matrix(trials, models, method=method))
+	return dist_mats
 
 
 def distance(vals_1, vals_2, method='euclidean'):
@@ -173,63 +566,525 @@ def distance(vals_1, vals_2, method='euclidean'):
 	intersection : Intersection
 	corr         : Correlation
 	-------------------------------------------------------------------------"""
+	# Since correlation and intersection are actually similarity measures,
+	# distance_matrix() takes their inverse to be able to use them as distances.
+	# In other words, max. similarity would give the min. inverse and we are
+	# always looking for minimum distances.
+	return distance_matrix(vals_1, vals_2, method=method)[0, 0]
+
+
+# The structure of the ranked results returned by top_k(). row and col are the
+# indices of the entry in the distance matrix, score is its distance, mode_code
+# and tonic are the mode (index) and the tonic frequency (Hz) it stands for.
+RANK_DTYPE = np.dtype([('row', int), ('col', int), ('score', float), ('mode_code', int), ('tonic', float)])
+
+
+def top_k_idxs(scores, k):
+	"""-------------------------------------------------------------------------
+	Returns the flat indices of the k smallest entries of an array, from the
+	smallest to the largest. The entries are selected by a partial sort; the
+	equal entries are ordered by their flat (row-major) index, so the result is
+	the same as picking the first minimum k times. NaN values are ranked last.
+	----------------------------------------------------------------------------
+	scores : The array of distances
+	k      : The number of entries to return. It's clipped to the size of the
+	         array.
+	-------------------------------------------------------------------------"""
+	flat = np.asarray(scores, dtype=float).ravel()
+	flat = np.where(np.isnan(flat), np.inf, flat)
+	k = max(min(k, len(flat)), 0)
+
+	if k < len(flat):
+		# Only the entries up to the kth smallest value are kept. If the kth value
+		# is tied, the ones with the smaller indices are preferred.
+		kth = flat[np.argpartition(flat, k - 1)[k - 1]] if k else -np.inf
+		less = np.flatnonzero(flat < kth)
+		equal = np.flatnonzero(flat == kth)[:k - len(less)]
+		idxs = np.concatenate((less, equal))
+	else:
+		idxs = np.arange(len(flat))
+
+	return idxs[np.lexsort((idxs, flat[idxs]))]
+
+
+def top_k(dist_mat, k, mode_codes=None, tonic_freqs=None):
+	"""-------------------------------------------------------------------------
+	Ranks the k best (i.e. smallest) entries of a distance matrix. This replaces
+	searching the minimum and replacing it with the maximum k times; the order
+	of the result, including the ties, is the same. See top_k_idxs().
+	----------------------------------------------------------------------------
+	dist_mat    : 2-D array of distances, e.g. tonic candidates x mode models
+	k           : The number of entries to return. It's clipped to the size of
+	              dist_mat.
+	mode_codes  : The mode codes of the entries. It's broadcast to the shape of
+	              dist_mat, e.g. mode_codes[np.newaxis, :] if the columns are
+	              the models. If None, the column index is the mode code.
+	tonic_freqs : The tonic frequencies of the entries, broadcast as mode_codes,
+	              e.g. tonic_freqs[:, np.newaxis] if the rows are the tonic
+	              candidates. If None, the tonic is zero.
+	----------------------------------------------------------------------------
+	ranked      : Structured array of length (at most) k, with the fields in
+	              RANK_DTYPE, from the best to the worst
+	-------------------------------------------------------------------------"""
+	dist_mat = np.atleast_2d(np.asarray(dist_mat, dtype=float))
+	idxs = top_k_idxs(dist_mat, k)
+	return ranked_entries(idxs, dist_mat.ravel()[idxs], dist_mat.shape, mode_codes=mode_codes,
+	                      tonic_freqs=tonic_freqs)
+
+
+def ranked_entries(idxs, scores, shape, mode_codes=None, tonic_freqs=None):
+	"""-------------------------------------------------------------------------
+	Fills the ranked entries of a distance matrix from their flat indices and
+	scores, e.g. found by top_k_idxs() or scan_top_k_idxs(). See top_k() for
+	the parameters and the output.
+	-------------------------------------------------------------------------"""
+	ranked = np.zeros(len(idxs), dtype=RANK_DTYPE)
+	ranked['row'], ranked['col'] = np.unravel_index(idxs, shape)
+	ranked['score'] = scores
+	ranked['mode_code'] = ranked['col'] if mode_codes is None else \
+		np.broadcast_to(mode_codes, shape).ravel()[idxs]
+	if tonic_freqs is not None:
+		ranked['tonic'] = np.broadcast_to(tonic_freqs, shape).ravel()[idxs]
+	return ranked
+
+
+# The default memory budget of scan_top_k_idxs(), in bytes
+SCAN_MEMORY_BUDGET = 2 ** 28
+
+
+def scan_top_k_idxs(trials, models, k, method='euclidean', transpose=False, memory_budget=SCAN_MEMORY_BUDGET):
+	"""-------------------------------------------------------------------------
+	Finds the k best (smallest) entries of the distance matrix of trials and
+	models without computing the whole matrix, by scanning the models in
+	blocks. This is meant for the models that don't fit in the memory, e.g. a
+	memory-mapped model file: only a block of models is read at a time. The
+	k best entries so far are kept and merged with the k best of each block by
+	a partial sort. The result is the same as top_k_idxs() of the whole matrix
+	(or its transpose), including the order of the ties and the last bit of
+	the distances, since each entry of distance_matrix() is independent of
+	the block it is computed in.
+	----------------------------------------------------------------------------
+	trials        : 2-D array of distribution values, e.g. the shifted
+	                candidates
+	models        : 2-D array of the model values, e.g. a memory map
+	k             : The number of best entries needed
+	method        : The choice of distance method. See distance() for the list.
+	transpose     : If True, the entries are ranked as the transposed matrix,
+	                i.e. models x trials
+	memory_budget : The approximate number of bytes used for a block; the
+	                block of models, its broadcast intermediates and its
+	                distances
+	----------------------------------------------------------------------------
+	idxs          : The flat indices of the k best entries in the matrix (or
+	                its transpose), from the best to the worst
+	scores        : The distances of the k best entries
+	-------------------------------------------------------------------------"""
+	trials = np.atleast_2d(np.asarray(trials, dtype=float))
+	num_trials, num_bins = trials.shape
+	num_models = len(models)
+	block = max(1, memory_budget // (np.dtype(float).itemsize * (num_bins * (num_trials + 2) + num_trials)))
+
+	best_idxs, best_scores = np.zeros(0, dtype=int), np.zeros(0)
+	for b in range(0, num_models, block):
+		block_mat = distance_matrix(trials, np.asarray(models[b:b + block], dtype=float), method=method)
+
+		# The k best of the block, converted to the flat indices of the matrix.
+		# The order of the flat indices of the block is the same as the matrix.
+		if transpose:
+			idxs = top_k_idxs(block_mat.T, k)
+			cols, rows = np.unravel_index(idxs, block_mat.T.shape)
+			scores, idxs = block_mat.T.ravel()[idxs], (b + cols) * num_trials + rows
+		else:
+			idxs = top_k_idxs(block_mat, k)
+			rows, cols = np.unravel_index(idxs, block_mat.shape)
+			scores, idxs = block_mat.ravel()[idxs], rows * num_models + b + cols
+
+		# The entries are ordered by their scores and then their flat indices,
+		# as top_k_idxs() orders them (NaN as infinity)
+		idxs, scores = np.concatenate((best_idxs, idxs)), np.concatenate((best_scores, scores))
+		order = np.lexsort((idxs, np.where(np.isnan(scores), np.inf, scores)))[:k]
+		best_idxs, best_scores = idxs[order], scores[order]
+
+	return best_idxs, best_scores
+
+
+def scan_top_k(trials, models, k, method='euclidean', mode_codes=None, tonic_freqs=None, transpose=False,
+               memory_budget=SCAN_MEMORY_BUDGET):
+	"""-------------------------------------------------------------------------
+	Ranks the k best entries of the distance matrix of trials and models, as
+	top_k() of the whole matrix, by scanning the models in blocks. See
+	scan_top_k_idxs() for the scan and top_k() for mode_codes, tonic_freqs and
+	the output; these are broadcast to the shape of the matrix (or its
+	transpose).
+	-------------------------------------------------------------------------"""
+	num_trials, num_models = len(np.atleast_2d(trials)), len(models)
+	idxs, scores = scan_top_k_idxs(trials, models, k, method=method, transpose=transpose,
+	                               memory_budget=memory_budget)
+	shape = (num_models, num_trials) if transpose else (num_trials, num_models)
+	return ranked_entries(idxs, scores, shape, mode_codes=mode_codes, tonic_freqs=tonic_freqs)
+
+
+def vote(ests):
+	"""-------------------------------------------------------------------------
+	Returns the most frequent estimate among the nearest neighbors, e.g. a mode
+	name or a (tonic, mode) pair. The estimates are coded as integers and
+	counted at once. The ties are broken by the iteration order of the set of
+	the estimates, as in counting each member of the set one by one.
+	----------------------------------------------------------------------------
+	ests : List of the estimates of the nearest neighbors
+	-------------------------------------------------------------------------"""
+	candidates = list(set(ests))
+	codes = dict((c, i) for i, c in enumerate(candidates))
+	return candidates[np.argmax(np.bincount([codes[e] for e in ests], minlength=len(candidates)))]
+
+
+# The order of each Minkowski distance. Only these have the lower bounds that
+# the exact cascade search relies on. See coarse_lower_bound().
+MINKOWSKI_ORDERS = {'manhattan': 1, 'euclidean': 2, 'l3': 3}
+
+# The relative slack of the pruning threshold, so that a bound that is equal
+# to a distance isn't pruned due to the floating point rounding. The cascade,
+# the prefilter and MetricTree all prune with it.
+BOUND_TOL = 1e-9
+
+
+def coarse_vals(vals, factor):
+	"""-------------------------------------------------------------------------
+	Generates the coarse distributions by summing each group of factor
+	consecutive bins, e.g. a 30 cent grid from a 7.5 cent one by factor 4. If
+	the number of bins isn't divisible by factor, the last group is shorter.
+	----------------------------------------------------------------------------
+	vals   : 2-D array of distribution values, one distribution per row
+	factor : The number of fine bins in a coarse bin
+	----------------------------------------------------------------------------
+	coarse : 2-D array of the coarse distribution values
+	sizes  : The number of fine bins in each coarse bin
+	-------------------------------------------------------------------------"""
+	vals = np.atleast_2d(vals)
+	starts = np.arange(0, vals.shape[1], factor)
+	return np.add.reduceat(vals, starts, axis=1), np.diff(np.append(starts, vals.shape[1]))
+
+
+def coarse_factor(coarse_step, step_size=7.5):
+	"""-------------------------------------------------------------------------
+	Returns the number of fine bins in a coarse bin of about coarse_step cents.
+	The coarse bins are multiples of the fine ones, e.g. 25 cents is rounded to
+	22.5 cents (factor 3) for a step size of 7.5 cents.
+	-------------------------------------------------------------------------"""
+	return max(1, int(round(float(coarse_step) / step_size)))
+
+
+def coarse_lower_bound(trials, models, method='euclidean', factor=4):
+	"""-------------------------------------------------------------------------
+	Calculates a lower bound of the Minkowski distance matrix of trials and
+	models from their coarse distributions. For a group of m bins with the
+	differences d_i, Hölder's inequality gives
+
+	    |sum(d_i)|^p <= m^(p-1) * sum(|d_i|^p)
+
+	so the distance of the coarse distributions, each group scaled by
+	1 / m^((p-1)/p), never exceeds the distance of the fine ones.
+	----------------------------------------------------------------------------
+	trials : 2-D array of distribution values, e.g. the shifted candidates
+	models : 2-D array of distribution values, e.g. the mode models
+	method : 'manhattan', 'euclidean' or 'l3'
+	factor : The number of fine bins in a coarse bin
+	-------------------------------------------------------------------------"""
+	order = float(MINKOWSKI_ORDERS[method])
+	coarse_trials, sizes = coarse_vals(trials, factor)
+	coarse_models, sizes = coarse_vals(models, factor)
+	scale = sizes ** ((order - 1) / order)
+	return distance_matrix(coarse_trials / scale, coarse_models / scale, method=method)
+
+
+def paired_distances(trials, models, method='euclidean'):
+	"""-------------------------------------------------------------------------
+	Calculates the distance between each row of trials and the same row of
+	models, i.e. the selected entries of a distance matrix. The Minkowski
+	distances are the same as the corresponding entries of distance_matrix().
+	-------------------------------------------------------------------------"""
 	if (method == 'euclidean'):
-		return distance.euclidean(vals_1, vals_2)
+		return np.sqrt(((trials - models) ** 2).sum(axis=1))
 
 	elif (method == 'manhattan'):
-		return distance.minkowski(vals_1, vals_2, 1)
+		return np.abs(trials - models).sum(axis=1)
 
 	elif (method == 'l3'):
-		return distance.minkowski(vals_1, vals_2, 3)
+		return (np.abs(trials - models) ** 3).sum(axis=1) ** (1.0 / 3)
 
 	elif (method == 'bhat'):
-		return -math.log(sum(np.sqrt(vals_1 * vals_2)))
+		with np.errstate(divide='ignore'):
+			return -np.log((np.sqrt(trials) * np.sqrt(models)).sum(axis=1))
 
-	# Since correlation and intersection are actually similarity measures,
-	# we take their inverse to be able to use them as distances. In other
-	# words, max. similarity would give the min. inverse and we are always
-	# looking for minimum distances.
 	elif (method == 'intersection'):
-		return len(vals_1) / (sum(np.minimum(vals_1, vals_2)))
+		with np.errstate(divide='ignore'):
+			return trials.shape[1] / np.minimum(trials, models).sum(axis=1)
 
 	elif (method == 'corr'):
-		return 1.0 - np.correlate(vals_1, vals_2)
+		return 1.0 - (trials * models).sum(axis=1)
+
+	else:
+		return np.zeros(trials.shape[0])
+
+
+def cascade_distance_matrix(trials, models, k, method='euclidean', factor=4, exact=True, width=4):
+	"""-------------------------------------------------------------------------
+	Calculates the entries of the distance matrix of trials and models that can
+	be among its k best (smallest), by a coarse-to-fine search. The rest of the
+	entries are left as infinity, so top_k() of the result is the same as the
+	top_k() of distance_matrix().
+
+	All pairs are first scored on the coarse grid. In exact mode, the coarse
+	score is the lower bound of coarse_lower_bound(), so it is only available
+	for the Minkowski distances. The k pairs with the smallest bounds are scored
+	on the fine grid; the worst of these is an upper bound of the kth best
+	distance. The pairs whose bounds exceed it can't be among the k best, so
+	only the remaining pairs are scored on the fine grid.
+
+	If exact is False, the coarse score is the distance of the coarse
+	distributions for any method and only the k * width best pairs on the
+	coarse grid are scored on the fine grid. This is faster, but the result may
+	differ from the exhaustive search.
+	----------------------------------------------------------------------------
+	trials : 2-D array of distribution values, e.g. the shifted candidates
+	models : 2-D array of distribution values, e.g. the mode models
+	k      : The number of best entries needed
+	method : The choice of distance method. See distance() for the list. In
+	         exact mode, the other methods are computed by distance_matrix().
+	factor : The number of fine bins in a coarse bin. See coarse_vals().
+	exact  : Whether the result is guaranteed to have the same k best entries
+	         as the exhaustive search
+	width  : The number of fine scored pairs per needed entry, if not exact
+	-------------------------------------------------------------------------"""
+	trials = np.atleast_2d(np.asarray(trials, dtype=float))
+	models = np.atleast_2d(np.asarray(models, dtype=float))
+	num_pairs = trials.shape[0] * models.shape[0]
+
+	if factor <= 1 or k * (1 if exact else width) >= num_pairs or (exact and method not in MINKOWSKI_ORDERS):
+		return distance_matrix(trials, models, method=method)
+
+	if exact:
+		bounds = coarse_lower_bound(trials, models, method=method, factor=factor)
+	else:
+		bounds = distance_matrix(coarse_vals(trials, factor)[0], coarse_vals(models, factor)[0], method=method)
+
+	dist_mat = np.full(bounds.shape, np.inf)
+	scored = np.zeros(bounds.shape, dtype=bool)
+
+	# The seed pairs, with the smallest coarse scores, are scored first
+	rows, cols = np.unravel_index(top_k_idxs(bounds, k if exact else k * width), bounds.shape)
+	dist_mat[rows, cols] = paired_distances(trials[rows], models[cols], method=method)
+	scored[rows, cols] = True
+
+	if exact:
+		# The kth best distance is at most the worst seed, so the pairs with a
+		# larger bound are pruned. The rest are scored on the fine grid.
+		threshold = dist_mat[rows, cols].max()
+		rows, cols = np.nonzero((bounds <= threshold * (1 + BOUND_TOL)) & ~scored)
+		dist_mat[rows, cols] = paired_distances(trials[rows], models[cols], method=method)
+
+	return dist_mat
+
+
+def dft_signature(vals):
+	"""-------------------------------------------------------------------------
+	Generates the shift-invariant signatures of PCDs: the magnitudes of their
+	DFT, which don't change by a circular shift. The magnitudes are weighted
+	such that, by Parseval's theorem, the euclidean distance of two signatures
+	is at most the euclidean distance of the PCDs, for any shift of either.
+	----------------------------------------------------------------------------
+	vals : 2-D array of PCD values, one distribution per row
+	-------------------------------------------------------------------------"""
+	vals = np.atleast_2d(np.asarray(vals, dtype=float))
+	num_bins = vals.shape[1]
+
+	# The rfft omits the conjugate half of the spectrum, so the bins other than
+	# the DC (and the Nyquist, for an even length) are counted twice.
+	weights = np.repeat(np.sqrt(2.0 / num_bins), num_bins // 2 + 1)
+	weights[0] = np.sqrt(1.0 / num_bins)
+	if num_bins % 2 == 0:
+		weights[-1] = np.sqrt(1.0 / num_bins)
+	return np.abs(np.fft.rfft(vals, axis=1)) * weights
+
 
+def signature_lower_bound(signature, model_signatures, method='euclidean', num_bins=None):
+	"""-------------------------------------------------------------------------
+	Calculates a lower bound of the distance of a PCD from each model, over all
+	circular shifts of the PCD, from their signatures. See dft_signature(). The
+	bound of the euclidean distance also holds for manhattan, since the L1
+	norm is at least the L2 norm, and scaled by num_bins^(-1/6) for l3.
+	----------------------------------------------------------------------------
+	signature        : The signature of the PCD
+	model_signatures : 2-D array of the signatures of the models
+	method           : 'manhattan', 'euclidean' or 'l3'
+	num_bins         : The number of bins of the PCDs. Only needed for l3.
+	-------------------------------------------------------------------------"""
+	bounds = distance_matrix(signature, model_signatures, method='euclidean')[0]
+	if method == 'l3':
+		bounds *= float(num_bins) ** (-1.0 / 6)
+	elif method not in MINKOWSKI_ORDERS:
+		raise ValueError('There is no signature bound for ' + str(method))
+	return bounds
+
+
+def prefilter_distance_matrix(trials, models, k, signature, model_signatures, method='euclidean', exact=True,
+                              width=4):
+	"""-------------------------------------------------------------------------
+	Calculates the columns of the distance matrix of the shifted candidates of
+	a PCD (trials) and the models that can have any of the k best (smallest)
+	entries. The models are ranked by the distances of their shift-invariant
+	signatures from the signature of the PCD, before any shift is compared. The
+	rest of the entries are left as infinity, so top_k() of the result is the
+	same as the top_k() of distance_matrix().
+
+	In exact mode, the signature distance is the lower bound of
+	signature_lower_bound(), so it is only available for the Minkowski
+	distances. The models with the smallest bounds are compared first, until
+	there are k entries; the worst of these is an upper bound of the kth best
+	distance. The models whose bounds exceed it can't have any of the k best
+	entries, so only the remaining models are compared.
+
+	If exact is False, the models with the smallest signature distances are
+	compared for any method, until there are k * width entries. The result may
+	differ from the exhaustive search.
+	----------------------------------------------------------------------------
+	trials           : 2-D array of the shifted candidates of the PCD
+	models           : 2-D array of the model PCDs
+	k                : The number of best entries needed
+	signature        : The signature of the PCD. See dft_signature().
+	model_signatures : 2-D array of the signatures of the models
+	method           : The choice of distance method. See distance(). In exact
+	                   mode, the other methods are computed by distance_matrix().
+	exact            : Whether the result is guaranteed to have the same k best
+	                   entries as the exhaustive search
+	width            : The number of compared entries per needed entry, if not
+	                   exact
+	-------------------------------------------------------------------------"""
+	trials = np.atleast_2d(np.asarray(trials, dtype=float))
+	models = np.atleast_2d(np.asarray(models, dtype=float))
+	num_trials, num_models = trials.shape[0], models.shape[0]
+
+	num_seeds = -(-k * (1 if exact else width) // max(num_trials, 1))
+	if num_seeds >= num_models or (exact and method not in MINKOWSKI_ORDERS):
+		return distance_matrix(trials, models, method=method)
+
+	if exact:
+		bounds = signature_lower_bound(signature, model_signatures, method=method, num_bins=trials.shape[1])
 	else:
-		return 0
+		bounds = distance_matrix(signature, model_signatures, method='euclidean')[0]
+	order = np.argsort(bounds, kind='mergesort')
+
+	# The models with the smallest bounds are compared first
+	dist_mat = np.full((num_trials, num_models), np.inf)
+	seeds = order[:num_seeds]
+	dist_mat[:, seeds] = distance_matrix(trials, models[seeds], method=method)
+
+	if exact:
+		# The kth best distance is at most the kth best of the seeds, so the
+		# models with a larger bound are pruned. The rest are compared.
+		seed_dists = dist_mat[:, seeds].ravel()
+		threshold = np.partition(seed_dists, k - 1)[k - 1]
+		rest = order[num_seeds:]
+		rest = rest[bounds[rest] <= threshold * (1 + BOUND_TOL)]
+		if len(rest):
+			dist_mat[:, rest] = distance_matrix(trials, models[rest], method=method)
+
+	return dist_mat
+
+
+def bin_offset(dist, step_size=7.5):
+	"""-------------------------------------------------------------------------
+	Returns the index of the first bin of a PD on the canonical bin grid, i.e.
+	the first bin is at bin_offset * step_size cents. All PDs generated by
+	generate_pd() share this grid, so their relative positions are found by
+	integer arithmetic.
+	-------------------------------------------------------------------------"""
+	return int(round(dist.bins[0] / step_size))
+
+
+def pd_union(pd, mode_pd, step_size=7.5):
+	"""-------------------------------------------------------------------------
+	Returns the (first bin index, number of bins) of the union of the grids of
+	two PDs. The inputs are symmetric.
+	-------------------------------------------------------------------------"""
+	start_1, start_2 = bin_offset(pd, step_size), bin_offset(mode_pd, step_size)
+	first = min(start_1, start_2)
+	return first, max(start_1 + len(pd.vals), start_2 + len(mode_pd.vals)) - first
 
 
 def pd_zero_pad(pd, mode_pd, step_size=7.5):
 	"""-------------------------------------------------------------------------
-	This function is only used in tonic detection with pD. If necessary, it zero
-	pads the distributions from both sides, to make them of the same length. The
-	inputs are symmetric, i.e. the input distributions can be given in any order
+	Zero pads two PDs from both sides to the union of their grids, to make them
+	of the same length. The inputs are symmetric and they aren't modified; the
+	padded distributions are returned as new PitchDistribution objects. The
+	estimation functions don't need this; see pd_distance().
 	----------------------------------------------------------------------------
 	pD      : Input pD
 	mode_pd : pD of the candidate mode
 	-------------------------------------------------------------------------"""
+	first, num_bins = pd_union(pd, mode_pd, step_size=step_size)
+	bins = (first + np.arange(num_bins)) * float(step_size)
+
+	padded = []
+	for d in [pd, mode_pd]:
+		start = bin_offset(d, step_size) - first
+		vals = np.zeros(num_bins)
+		vals[start:start + len(d.vals)] = d.vals
+		padded.append(pD.PitchDistribution(bins, vals, kernel_width=d.kernel_width, source=d.source,
+		                                   ref_freq=d.ref_freq, segment=d.segmentation, overlap=d.overlap))
+	return padded[0], padded[1]
+
+
+def pd_distance(pd, mode_pd, shift=0, method='euclidean', num_bins=None, step_size=7.5):
+	"""-------------------------------------------------------------------------
+	Calculates the distance between a PD, shifted by the given number of
+	samples (see shift() of PitchDistribution), and a model PD. The result is
+	the same as the distance of the two, zero padded to a common grid, but the
+	distributions are neither padded nor modified. The overlapping window of
+	the two grids is found by the bin offsets and the values are compared as
+	slices; outside the window, one of the distributions is zero, so only the
+	power sums of the other are needed for the Minkowski distances.
+	----------------------------------------------------------------------------
+	pd        : The input PD
+	mode_pd   : The model PD
+	shift     : The number of samples to shift pd
+	method    : The choice of distance method. See distance().
+	num_bins  : The length of the common grid, which the intersection is
+	            normalized by. If None, it is the union of the grids.
+	step_size : The step size of the distributions
+	-------------------------------------------------------------------------"""
+	vals_1, vals_2 = np.asarray(pd.vals, dtype=float), np.asarray(mode_pd.vals, dtype=float)
 
-	# The padding process requires the two bin lists to have an intersection. 
-	# This is ensured by the generate_pd function, since we enforce all pds to
-	# include zero in their bins.
+	# The bin indices of the shifted input and the model on the common grid
+	start_1 = bin_offset(pd, step_size) - shift
+	start_2 = bin_offset(mode_pd, step_size)
+	lo = max(start_1, start_2)
+	hi = max(min(start_1 + len(vals_1), start_2 + len(vals_2)), lo)
 
-	# Finds the number of missing bins in the left and right sides of pD and
-	# inserts that many zeros.
-	diff_bins = set(mode_pd.bins) - set(pd.bins)
-	num_left_missing = len([x for x in diff_bins if x < min(pd.bins)]) 
-	num_right_missing = len([x for x in diff_bins if x > max(pd.bins)])
-	pd.vals = np.concatenate((np.zeros(num_left_missing), pd.vals,
-	                          np.zeros(num_right_missing)))
+	over_1 = vals_1[lo - start_1:hi - start_1]
+	over_2 = vals_2[lo - start_2:hi - start_2]
 
-	# Finds the number of missing bins in the left and right sides of mode_pd
-	# and inserts that many zeros.
-	diff_bins = set(pd.bins) - set(mode_pd.bins)
-	num_left_missing = len([x for x in diff_bins if x < min(mode_pd.bins)]) 
-	num_right_missing = len([x for x in diff_bins if x > max(mode_pd.bins)])
-	mode_pd.vals = np.concatenate((np.zeros(num_left_missing), mode_pd.vals,
-	                               np.zeros(num_right_missing)))
+	if method in ['manhattan', 'euclidean', 'l3']:
+		power = {'manhattan': 1, 'euclidean': 2, 'l3': 3}[method]
+		outer = sum([(np.abs(v[:lo - start]) ** power).sum() + (np.abs(v[hi - start:]) ** power).sum()
+		             for v, start in [(vals_1, start_1), (vals_2, start_2)]])
+		return ((np.abs(over_1 - over_2) ** power).sum() + outer) ** (1.0 / power)
 
-	return pd, mode_pd
+	elif (method == 'bhat'):
+		with np.errstate(divide='ignore'):
+			return -np.log(np.sqrt(over_1 * over_2).sum())
+
+	elif (method == 'intersection'):
+		if num_bins is None:
+			num_bins = max(start_1 + len(vals_1), start_2 + len(vals_2)) - min(start_1, start_2)
+		with np.errstate(divide='ignore'):
+			return num_bins / np.minimum(over_1, over_2).sum()
+
+	elif (method == 'corr'):
+		return 1.0 - np.dot(over_1, over_2)
+
+	else:
+		return 0.0
 
 
 def tonic_estimate(dist, peak_idxs, mode_dist, distance_method="euclidean", metric='pcd', step_size=7.5):
@@ -237,15 +1092,17 @@ def tonic_estimate(dist, peak_idxs, mode_dist, distance_method="euclidean", metr
 	Given a mode (or candidate mode), compares the piece's distribution with 
 	each candidate tonic and returns the resultant distance vector to higher
 	level functions. This is a wrapper function that handles the required
-	preliminary tasks and calls generate_distance_matrix() accordingly.
+	preliminary tasks and calls generate_distance_matrix() accordingly. The
+	input distributions aren't modified.
 	----------------------------------------------------------------------------
 	dist            : Distribution of the input recording
-	peak_idxs       : Indices of peaks (i.e. tonic candidates) of dist
+	peak_idxs       : Indices of peaks (i.e. tonic candidates) of dist. For PD,
+	                  these are the shifts w.r.t. the zero cent bin.
 	mode_dist       : Distribution of the mode that dist will be compared at
 	                  each iteration.
 	distance_method : The choice of distance method. See the full list at
 	                  distance()
-	metric          : Whether PCD or PD is used
+	metric          : Whether PCD ('pcd') or PD ('pD' or 'pd') is used
 	step_size         : The step-size of the pitch distribution. Unit is cents
 	-------------------------------------------------------------------------"""
 
@@ -256,20 +1113,15 @@ def tonic_estimate(dist, peak_idxs, mode_dist, distance_method="euclidean", metr
 	if (metric == 'pcd'):
 		return np.array(generate_distance_matrix(dist, peak_idxs, [mode_dist], method=distance_method))[:, 0]
 
-	elif (metric == 'pD'):
+	# The shifted distribution is compared with the model on the union of their
+	# grids. The intersection is normalized by the length of the union, extended
+	# by the largest shifts to both sides, so that no shift drops any values.
+	shift_idxs = np.asarray(peak_idxs, dtype=int).reshape(-1)
+	num_bins = pd_union(dist, mode_dist, step_size=step_size)[1]
+	num_bins += abs(shift_idxs.max()) + abs(shift_idxs.min()) if len(shift_idxs) else 0
 
-		# The PitchDistribution object is copied in order not to change its
-		# internals before the following steps.
-		temp = pD.PitchDistribution(dist.bins, dist.vals, kernel_width=dist.kernel_width, source=dist.source,
-		                             ref_freq=dist.ref_freq, segment=dist.segmentation)
-		temp, mode_dist = pd_zero_pad(temp, mode_dist, step_size=step_size)
-
-		# Fills both sides of distribution values with zeros, to make sure
-		# that the shifts won't drop any non-zero values
-		temp.vals = np.concatenate((np.zeros(abs(max(peak_idxs))), temp.vals, np.zeros(abs(min(peak_idxs)))))
-		mode_dist.vals = np.concatenate((np.zeros(abs(max(peak_idxs))), mode_dist.vals, np.zeros(abs(min(peak_idxs)))))
-
-		return np.array(generate_distance_matrix(temp, peak_idxs, [mode_dist], method=distance_method))[:, 0]
+	return np.array([pd_distance(dist, mode_dist, shift=shift, method=distance_method, num_bins=num_bins,
+	                             step_size=step_size) for shift in shift_idxs])
 
 
 def mode_estimate(dist, mode_dists, distance_method='euclidean', metric='pcd', step_size=7.5):
@@ -279,14 +1131,15 @@ def mode_estimate(dist, mode_dists, distance_method='euclidean', metric='pcd', s
 	functions. Here the input distribution is expected to be aligned according to
 	the tonic and tonic  isn't explicitly used in this function. This is a wrapper
 	function that handles the required preliminary tasks and calls
-	generate_distance_matrix() accordingly.
+	generate_distance_matrix() accordingly. The input distributions aren't
+	modified.
 	----------------------------------------------------------------------------
 	dist            : Distribution of the input recording
 	mode_dists      : List of PitchDistribution objects. These are the model
 	                  pitch distributions of candidate modes.
 	distance_method : The choice of distance method. See the full list at
 	                  distance()
-	metric          : Whether PCD or PD is used
+	metric          : Whether PCD ('pcd') or PD ('pD' or 'pd') is used
 	step_size         : The step-size of the pitch distribution. Unit is cents
 	-------------------------------------------------------------------------"""
 
@@ -295,21 +1148,12 @@ def mode_estimate(dist, mode_dists, distance_method='euclidean', metric='pcd', s
 
 	# There are no preliminaries, simply generate the distance vector.
 	if (metric == 'pcd'):
-		distance_vector = np.array(generate_distance_matrix(dist, [0], mode_dists, method=distance_method))[0]
-
-	elif (metric == 'pD'):
-		distance_vector = np.zeros(len(mode_dists))
+		return np.array(generate_distance_matrix(dist, [0], mode_dists, method=distance_method))[0]
 
-		# For each trial, a new instance of PitchDistribution is created and its
-		# attributes are copied from dist. For each trial, it needs to be zero
-		# padded according to the current mode distribution length. The entries
-		# of the vector is generated iteratively, one-by-one.
-		for i in range(len(mode_dists)):
-			trial = pD.PitchDistribution(dist.bins, dist.vals, kernel_width=dist.kernel_width,
-				                          source=dist.source, ref_freq=dist.ref_freq, segment=dist.segmentation)
-			trial, mode_trial = pd_zero_pad(trial, mode_dists[i], step_size=step_size)
-			distance_vector[i] = distance(trial, mode_trial, method=distance_method)
-	return distance_vector
+	# Each model PD is compared with the distribution on the union of their
+	# grids, without padding either of them. See pd_distance().
+	return np.array([pd_distance(dist, mode_dist, method=distance_method, step_size=step_size)
+	                 for mode_dist in mode_dists])
 
 
 def slice(time_track, pitch_track, pt_source, chunk_size, threshold=0.5, overlap=0):
@@ -339,28 +1183,148 @@ def slice(time_track, pitch_track, pt_source, chunk_size, threshold=0.5, overlap
 	              the information of ith chunk in chunks, is in the ith tuple
 	              in chunk_info. The structure is: (source, start time, end time)
 	-------------------------------------------------------------------------"""
-	chunks = []
-	chunk_info = []
-	last = 0
-
-	# Main slicing loop
-	for k in np.arange(1, (int(max(time_track) / chunk_size) + 1)):
-		cur = 1 + max(np.where(time_track < chunk_size * k)[0])
-		chunks.append(pitch_track[last:(cur - 1)])
-		chunk_info.append((pt_source, int(round(time_track[last])),
-		                 int(round(time_track[cur - 1]))))  # 0 - source, 1 - init, 2 - final
-		
-		# This variable keep track of where the first sample of the
-		# next iteration should start from.
-		last = 1 + max(np.where(time_track < chunk_size * k * (1 - overlap))[0]) if (overlap > 0) else cur
+	bounds = chunk_bounds(time_track, chunk_size, threshold=threshold, overlap=overlap)
+	chunks = [pitch_track[c['start']:c['stop']] for c in bounds]
+	chunk_info = [(pt_source, int(c['init']), int(c['final'])) for c in bounds]  # 0 - source, 1 - init, 2 - final
+	return chunks, chunk_info
+
+
+# The structure of the chunk metadata returned by chunk_bounds(). start and stop
+# are the sample indices of the chunk (stop is exclusive); init and final are
+# its initial and final timestamps, rounded to seconds as in slice().
+CHUNK_DTYPE = np.dtype([('start', int), ('stop', int), ('init', int), ('final', int)])
+
+
+def chunk_bounds(time_track, chunk_size, threshold=0.5, overlap=0):
+	"""-------------------------------------------------------------------------
+	Finds the chunks of a pitch track, as slice() does, without slicing it. The
+	chunk boundaries are found by binary search over the timestamps, instead of
+	a scan of the track per chunk. If chunk_size is zero, the entire track is a
+	single chunk.
+	----------------------------------------------------------------------------
+	time_track  : The timestamps of the pitch track, in ascending order
+	chunk_size  : The sizes of the chunks.
+	threshold   : The ratio of smallest acceptable chunk to chunk_size. See
+	              slice().
+	overlap     : The overlap ratio of the consecutive chunks. See slice().
+	----------------------------------------------------------------------------
+	chunk_info  : Structured array of the chunks with the fields in CHUNK_DTYPE
+	-------------------------------------------------------------------------"""
+	time_track = np.asarray(time_track)
+	num_samples = len(time_track)
+	final_time = int(round(time_track[-1]))
+	if chunk_size == 0:
+		return np.array([(0, num_samples, 0, final_time)], dtype=CHUNK_DTYPE)
+
+	# The kth chunk ends before the first sample at or after chunk_size * k. As
+	# in slice(), that is 1 + the index of the last sample before it, and the
+	# chunk excludes the last sample before it. The next chunk starts either
+	# at its end or, with overlap, at the first sample at or after
+	# chunk_size * k * (1 - overlap).
+	ks = np.arange(1, int(max(time_track) / chunk_size) + 1)
+	ends = np.searchsorted(time_track, chunk_size * ks)
+	nexts = np.searchsorted(time_track, chunk_size * ks * (1 - overlap)) if (overlap > 0) else ends
+	starts = np.concatenate([[0], nexts[:-1]]).astype(int)
+	last = nexts[-1] if len(ks) else 0
+
+	chunk_info = [(starts[i], ends[i] - 1, int(round(time_track[starts[i]])), int(round(time_track[ends[i] - 1])))
+	              for i in range(len(ks))]
 
 	# Checks if the remaining tail should be discarded or not.
 	if ((max(time_track) - time_track[last]) >= (chunk_size * threshold)):
-		chunks.append(pitch_track[last:])
-		chunk_info.append((pt_source, int(round(time_track[last])), int(round(time_track[len(time_track) - 1]))))
+		chunk_info.append((last, num_samples, int(round(time_track[last])), final_time))
 
 	# If the runtime of the entire track is below the threshold, keep it as it is
-	elif (last == 0):  
-		chunks.append(pitch_track)
-		chunk_info.append((pt_source, 0, int(round(time_track[len(time_track) - 1]))))
-	return chunks, chunk_info
+	elif (last == 0):
+		chunk_info.append((0, num_samples, 0, final_time))
+
+	return np.array(chunk_info, dtype=CHUNK_DTYPE)
+
+
+def chunk_histograms(cent_track, chunk_info, step_size=7.5, metric='pcd'):
+	"""-------------------------------------------------------------------------
+	Counts the samples of all chunks of a pitch track at once. The samples are
+	binned once and counted in blocks between the consecutive chunk boundaries;
+	the histogram of a chunk is the difference of the cumulative block
+	histograms at its boundaries. So the overlapping chunks don't cost any
+	extra counting.
+	----------------------------------------------------------------------------
+	cent_track  : 1-D array of frequency values of the entire track, in cents.
+	              It should be aligned with the timestamps the chunks are found
+	              from; the unvoiced samples should be NaN (see hz_to_cent()).
+	chunk_info  : The chunks of the track, as returned by chunk_bounds()
+	step_size   : The step size of the bins
+	metric      : 'pcd' for the pitch class histograms, else the bins are on the
+	              canonical grid of histogram_counts(), covering the entire
+	              track and including the bin of zero cents.
+	----------------------------------------------------------------------------
+	first_bin   : The index of the first bin, i.e. the first bin is at
+	              first_bin * step_size cents. Zero for PCD.
+	counts      : (number of chunks x number of bins) array of the counts
+	-------------------------------------------------------------------------"""
+	cent_track = np.asarray(cent_track, dtype=float)
+	bin_idxs = np.floor(cent_track / step_size + 0.5)
+	valid = np.isfinite(bin_idxs)
+
+	if metric == 'pcd':
+		first_bin = 0
+		num_bins = len(np.arange(0, 1200, step_size))
+		bin_idxs[valid] %= num_bins
+	elif valid.any():
+		first_bin = int(min(bin_idxs[valid].min(), 0))
+		num_bins = int(max(bin_idxs[valid].max(), 0)) - first_bin + 1
+		bin_idxs -= first_bin
+	else:
+		first_bin, num_bins = 0, 1
+
+	# The samples between the consecutive boundaries form a block
+	starts = np.minimum(chunk_info['start'], len(cent_track))
+	stops = np.minimum(chunk_info['stop'], len(cent_track))
+	bounds = np.unique(np.concatenate([starts, stops]))
+	block_idxs = np.repeat(np.arange(len(bounds) - 1), np.diff(bounds))
+
+	block_valid = valid[bounds[0]:bounds[-1]]
+	block_bins = bin_idxs[bounds[0]:bounds[-1]][block_valid].astype(int)
+	block_counts = np.bincount(block_idxs[block_valid] * num_bins + block_bins,
+	                           minlength=(len(bounds) - 1) * num_bins).reshape(len(bounds) - 1, num_bins)
+
+	cumulative = np.zeros((len(bounds), num_bins), dtype=np.int64)
+	np.cumsum(block_counts, axis=0, out=cumulative[1:])
+	counts = cumulative[np.searchsorted(bounds, stops)] - cumulative[np.searchsorted(bounds, starts)]
+	return first_bin, counts
+
+
+def generate_chunk_dists(cent_track, chunk_info, ref_freq=440, smooth_factor=7.5, step_size=7.5,
+                         metric='pcd', source='', overlap='-'):
+	"""-------------------------------------------------------------------------
+	Generates the distributions of all chunks of a pitch track from the chunk
+	histograms (see chunk_histograms()). The result is the same as generating
+	the distribution of each chunk separately by generate_pd() (and
+	generate_pcd_from_cents() for PCD); the PD of a chunk spans the range of
+	its own samples.
+	----------------------------------------------------------------------------
+	cent_track  : 1-D array of frequency values of the entire track, in cents,
+	              with NaN for the unvoiced samples. See chunk_histograms().
+	chunk_info  : The chunks of the track, as returned by chunk_bounds()
+	metric      : 'pcd' or 'pd'
+	The segmentation of each distribution is the (init, final) of its chunk and
+	the remaining parameters are the same as generate_pd().
+	-------------------------------------------------------------------------"""
+	first_bin, counts = chunk_histograms(cent_track, chunk_info, step_size=step_size, metric=metric)
+
+	dists = []
+	for c, chunk_counts in zip(chunk_info, counts):
+		segment = (int(c['init']), int(c['final']))
+		if metric == 'pcd':
+			dists.append(histogram_to_pcd(first_bin, chunk_counts, ref_freq=ref_freq, smooth_factor=smooth_factor,
+			                              step_size=step_size, source=source, segment=segment, overlap=overlap))
+			continue
+
+		# The counts are trimmed to the range of the chunk, including zero cents
+		nonzero = np.flatnonzero(chunk_counts)
+		lo = min(nonzero[0], -first_bin) if len(nonzero) else -first_bin
+		hi = max(nonzero[-1], -first_bin) if len(nonzero) else -first_bin
+		dists.append(histogram_to_pd(first_bin + lo, chunk_counts[lo:hi + 1], ref_freq=ref_freq,
+		                             smooth_factor=smooth_factor, step_size=step_size, source=source,
+		                             segment=segment, overlap=overlap))
+	return dists
@@ -0,0 +1,329 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+import struct
+import json
+import os
+import tempfile
+
+# The binary model file stores a list of distributions, e.g. a Bozkurt mode
+# model or a Chordia chunk collection, in a single (num_models x num_bins)
+# matrix on a common bin grid. The layout is:
+#
+#   magic (8 bytes) | version (uint32) | header length (uint32)
+#   JSON header, padded to a multiple of ALIGNMENT bytes
+#   values, raw little-endian float64 matrix in C order
+#
+# The header holds the bins and the metadata of each row (source,
+# segmentation, overlap, kernel_width, ref_freq and the span of the row on
+# the common grid). A file of several modes, e.g. a model store, also holds
+# the mode names and the mode code of each row. Since the values are written
+# as a raw array at a known offset, they are memory-mapped on load without any
+# copy or parsing.
+BINARY_EXT = '.model'
+MAGIC = b'MTEMODEL'
+VERSION = 1
+DTYPE = np.dtype('<f8')
+ALIGNMENT = 64
+
+_PREAMBLE = struct.Struct('<8sII')
+
+# The metadata of a distribution, as named in the JSON files
+META_KEYS = ['source', 'segmentation', 'overlap', 'kernel_width', 'ref_freq']
+
+
+def model_path(dist_dir, mode_name):
+	"""-------------------------------------------------------------------------
+	Returns the path of the model file of a mode. If both the binary and the
+	JSON model files exist, the binary is preferred.
+	----------------------------------------------------------------------------
+	dist_dir  : Directory where the model files are stored
+	mode_name : Name of the mode. The files are expected to be named
+	            "mode_name.model" or "mode_name.json"
+	-------------------------------------------------------------------------"""
+	fname = os.path.join(dist_dir, mode_name + BINARY_EXT)
+	return fname if os.path.isfile(fname) else os.path.join(dist_dir, mode_name + '.json')
+
+
+def is_binary(fname):
+	"""-------------------------------------------------------------------------
+	Checks whether the file is a binary model file, from its first bytes.
+	-------------------------------------------------------------------------"""
+	with open(fname, 'rb') as f:
+		return f.read(len(MAGIC)) == MAGIC
+
+
+def step_size(bins):
+	"""-------------------------------------------------------------------------
+	Returns the step size of the bins. As in PitchDistribution, it is rounded
+	to the first decimal to fix the floating point issues.
+	-------------------------------------------------------------------------"""
+	temp_ss = bins[1] - bins[0]
+	return temp_ss if (temp_ss == (round(temp_ss * 10) / 10)) else (round(temp_ss * 10) / 10)
+
+
+def align(bins_list, vals_list):
+	"""-------------------------------------------------------------------------
+	Aligns distributions with possibly different bins on a common grid. All
+	bins are multiples of the same step size, so the position of each
+	distribution on the grid is found from the index of its first bin. PDs are
+	zero padded to the union of their ranges; PCDs share the same bins.
+	----------------------------------------------------------------------------
+	bins_list : List of the bins of the distributions
+	vals_list : List of the values of the distributions
+	----------------------------------------------------------------------------
+	bins       : The common bins
+	vals       : 2-D array of the values, one distribution per row
+	first_bins : The index of the first bin of each distribution in bins
+	num_bins   : The number of bins of each distribution
+	-------------------------------------------------------------------------"""
+	if not bins_list:
+		raise ValueError('There are no distributions to align')
+
+	ss = step_size(bins_list[0])
+	starts = np.array([int(round(b[0] / ss)) for b in bins_list])
+	num_bins = np.array([len(v) for v in vals_list])
+	grid_start = starts.min()
+	grid_len = (starts + num_bins).max() - grid_start
+
+	vals = np.zeros((len(vals_list), grid_len))
+	for i, v in enumerate(vals_list):
+		start = starts[i] - grid_start
+		vals[i, start:start + num_bins[i]] = v
+
+	# The bins of the distributions are kept as they are when they share the
+	# same grid, e.g. PCDs. Otherwise, the union grid is generated.
+	if grid_len == len(bins_list[0]) and starts[0] == grid_start:
+		bins = np.asarray(bins_list[0], dtype=float)
+	else:
+		bins = np.arange(grid_start, grid_start + grid_len) * ss
+
+	return bins, vals, starts - grid_start, num_bins
+
+
+def write(fname, bins, vals, rows, mode_names=None):
+	"""-------------------------------------------------------------------------
+	Writes distributions, aligned on a common grid, to a binary model file.
+	----------------------------------------------------------------------------
+	fname      : The name of the file to be created
+	bins       : The common bins
+	vals       : 2-D array of the values, one distribution per row
+	rows       : List of dictionaries, one per row, with the keys in META_KEYS
+	             and 'first_bin', 'num_bins' for the span of the row on the
+	             grid. The rows of a file of several modes also have the
+	             'mode_code' key, the index of their mode in mode_names.
+	mode_names : Names of the modes in the file, if it has several modes
+	-------------------------------------------------------------------------"""
+	vals = np.ascontiguousarray(vals, dtype=DTYPE)
+
+	def write_func(f):
+		_write_header(f, bins, vals.shape, rows, mode_names)
+		f.write(vals.tobytes())
+	_write_atomic(fname, write_func)
+
+
+def _write_atomic(fname, write_func):
+	# Writes a file under a temporary name in the same directory by
+	# write_func, which is given the open file, and renames it. read()
+	# memory-maps the existing file and truncating it would invalidate the
+	# live maps; the readers keep the old file until they reload. A reader
+	# never sees a partially written file either.
+	fd, tmp_fname = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(fname)),
+	                                 suffix=BINARY_EXT)
+	os.close(fd)
+	try:
+		with open(tmp_fname, 'wb') as f:
+			write_func(f)
+
+		# mkstemp creates the file readable only by its owner
+		os.chmod(tmp_fname, 0o644)
+
+		# os.rename doesn't overwrite an existing file on Windows
+		if os.name == 'nt' and os.path.exists(fname):
+			os.remove(fname)
+		os.rename(tmp_fname, fname)
+	except Exception:
+		os.remove(tmp_fname)
+		raise
+
+
+def _write_header(f, bins, shape, rows, mode_names=None):
+	# Writes the preamble and the padded header to an open file. The values
+	# are to be written right after, at the aligned offset.
+	header = {'bins': np.asarray(bins, dtype=float).tolist(), 'shape': list(shape),
+	          'dtype': DTYPE.str, 'rows': rows}
+	if mode_names is not None:
+		header['mode_names'] = list(mode_names)
+	header = json.dumps(header).encode('utf-8')
+
+	# The values start at an aligned offset, after the padded header
+	data_offset = _PREAMBLE.size + len(header)
+	data_offset += (-data_offset) % ALIGNMENT
+	header = header.ljust(data_offset - _PREAMBLE.size, b' ')
+
+	f.write(_PREAMBLE.pack(MAGIC, VERSION, len(header)))
+	f.write(header)
+
+
+# The maximum number of values merge() keeps in memory at a time
+_BLOCK_SIZE = 2 ** 22
+
+
+def merge(fnames, out_fname, mode_names):
+	"""-------------------------------------------------------------------------
+	Merges the model files of several modes into a single binary model file
+	with the mode labels, as save() of ModelSet writes it. The binary files are
+	memory-mapped and copied in blocks of rows, so the merged matrix is never
+	in memory; a model set larger than the memory can be merged and then
+	memory-mapped as a whole, e.g. by a ModelStore. The grids of the files are
+	merged as in load() of ModelSet. As in write(), the file is written under
+	a temporary name and renamed.
+	----------------------------------------------------------------------------
+	fnames     : The model files, one per mode, in either format
+	out_fname  : The name of the merged file to be created
+	mode_names : Names of the modes, parallel to fnames
+	-------------------------------------------------------------------------"""
+	parts = [read_any(fname) for fname in fnames]
+	if not parts:
+		raise ValueError('There are no model files to merge')
+
+	ss = step_size(parts[0][0])
+	starts = [int(round(bins[0] / ss)) for bins, vals, rows in parts]
+	grid_start = min(starts)
+	grid_len = max(start + len(bins) for start, (bins, vals, rows) in zip(starts, parts)) - grid_start
+	if starts[0] == grid_start and grid_len == len(parts[0][0]):
+		bins = parts[0][0]
+	else:
+		bins = np.arange(grid_start, grid_start + grid_len) * ss
+
+	rows = [dict(r, first_bin=r['first_bin'] + start - grid_start, mode_code=code)
+	        for code, (start, (part_bins, part_vals, part_rows)) in enumerate(zip(starts, parts))
+	        for r in part_rows]
+
+	block = max(1, _BLOCK_SIZE // grid_len)
+
+	def write_func(f):
+		_write_header(f, bins, (len(rows), grid_len), rows, mode_names)
+		for start, (part_bins, part_vals, part_rows) in zip(starts, parts):
+			offset = start - grid_start
+			for b in range(0, len(part_vals), block):
+				block_vals = np.zeros((len(part_vals[b:b + block]), grid_len), dtype=DTYPE)
+				block_vals[:, offset:offset + len(part_bins)] = part_vals[b:b + block]
+				f.write(block_vals.tobytes())
+	_write_atomic(out_fname, write_func)
+
+
+def _read_header(f, fname):
+	# Reads the header of an open binary model file. The file is left at the
+	# start of the values, whose offset is returned with the header.
+	magic, version, header_len = _PREAMBLE.unpack(f.read(_PREAMBLE.size))
+	if magic != MAGIC:
+		raise ValueError('Not a binary model file: ' + fname)
+	if version > VERSION:
+		raise ValueError('Unsupported model file version %d: %s' % (version, fname))
+	return json.loads(f.read(header_len).decode('utf-8')), _PREAMBLE.size + header_len
+
+
+def read(fname, mmap=True):
+	"""-------------------------------------------------------------------------
+	Reads a binary model file. The values are memory-mapped read-only, unless
+	mmap is False.
+	----------------------------------------------------------------------------
+	fname : The name of the binary model file
+	mmap  : Whether the values are memory-mapped or read into memory
+	----------------------------------------------------------------------------
+	bins : The common bins
+	vals : 2-D array of the values, one distribution per row
+	rows : List of the metadata of the rows. See write().
+	-------------------------------------------------------------------------"""
+	with open(fname, 'rb') as f:
+		header, offset = _read_header(f, fname)
+		shape = tuple(header['shape'])
+		if mmap and shape[0] * shape[1] > 0:
+			vals = np.memmap(fname, dtype=np.dtype(header['dtype']), mode='r', offset=offset, shape=shape)
+		else:
+			vals = np.fromfile(f, dtype=np.dtype(header['dtype']), count=shape[0] * shape[1]).reshape(shape)
+
+	return np.array(header['bins']), vals, header['rows']
+
+
+def read_mode_names(fname):
+	"""-------------------------------------------------------------------------
+	Returns the mode names of a binary model file of several modes, or None if
+	the file doesn't record them. See write().
+	-------------------------------------------------------------------------"""
+	with open(fname, 'rb') as f:
+		return _read_header(f, fname)[0].get('mode_names')
+
+
+def read_json(fname):
+	"""-------------------------------------------------------------------------
+	Reads a JSON model file, i.e. a list of distributions saved by the train()
+	functions, and aligns the distributions on a common grid. The output is the
+	same as read().
+	-------------------------------------------------------------------------"""
+	with open(fname) as f:
+		dist_list = json.load(f)
+
+	bins, vals, first_bins, num_bins = align([d['bins'] for d in dist_list], [d['vals'] for d in dist_list])
+	rows = [dict([(k, d[k]) for k in META_KEYS] + [('first_bin', int(first_bins[i])),
+	                                                ('num_bins', int(num_bins[i]))])
+	        for i, d in enumerate(dist_list)]
+	return bins, vals, rows
+
+
+def read_any(fname, mmap=True):
+	"""-------------------------------------------------------------------------
+	Reads a model file in either format. The format is detected from the file
+	content, not from the extension. See read().
+	-------------------------------------------------------------------------"""
+	return read(fname, mmap=mmap) if is_binary(fname) else read_json(fname)
+
+
+def json_to_binary(json_fname, binary_fname=None):
+	"""-------------------------------------------------------------------------
+	Converts a JSON model file to the binary format. If binary_fname isn't
+	given, the binary file is written next to the JSON file, with BINARY_EXT.
+	Returns the name of the binary file.
+	-------------------------------------------------------------------------"""
+	binary_fname = binary_fname or (os.path.splitext(json_fname)[0] + BINARY_EXT)
+	bins, vals, rows = read_json(json_fname)
+	write(binary_fname, bins, vals, rows)
+	return binary_fname
+
+
+def binary_to_json(binary_fname, json_fname=None):
+	"""-------------------------------------------------------------------------
+	Converts a binary model file back to the JSON format, as written by the
+	train() functions. Returns the name of the JSON file.
+	-------------------------------------------------------------------------"""
+	json_fname = json_fname or (os.path.splitext(binary_fname)[0] + '.json')
+	bins, vals, rows = read(binary_fname, mmap=False)
+
+	dist_json = []
+	for i, row in enumerate(rows):
+		start, stop = row['first_bin'], row['first_bin'] + row['num_bins']
+		dist = dict((k, row[k]) for k in META_KEYS)
+		dist['bins'] = bins[start:stop].tolist()
+		dist['vals'] = vals[i, start:stop].tolist()
+		dist_json.append(dist)
+
+	with open(json_fname, 'w') as f:
+		json.dump(dist_json, f, indent=2)
+	return json_fname
+
+
+if __name__ == '__main__':
+	# argparse is only needed by the command line, not by the importers
+	import argparse
+
+	parser = argparse.ArgumentParser(description='Converts the JSON model files in a folder to the binary '
+	                                             'model format, or back.')
+	parser.add_argument('model_dir', help='folder of the model files')
+	parser.add_argument('--to-json', action='store_true', help='convert the binary files to JSON instead')
+	args = parser.parse_args()
+
+	src_ext = BINARY_EXT if args.to_json else '.json'
+	converter = binary_to_json if args.to_json else json_to_binary
+	for f in sorted(os.listdir(args.model_dir)):
+		if f.endswith(src_ext):
+			print(converter(os.path.join(args.model_dir, f)))
@@ -0,0 +1,446 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+import os
+from ModeTonicEstimation import ModeFunctions as mF
+from ModeTonicEstimation import PitchDistribution as pD
+from ModeTonicEstimation import ModelFile as mFile
+from ModeTonicEstimation import MetricTree as mT
+from ModeTonicEstimation import InvertedFile as iF
+
+
+def file_stamp(fname):
+	"""-------------------------------------------------------------------------
+	Returns the (size, modification time) pair of a file. These are recorded
+	while loading the model files, to detect the changes afterwards.
+	-------------------------------------------------------------------------"""
+	st = os.stat(fname)
+	return st.st_size, st.st_mtime
+
+
+def from_dists(mode_dists, mode_names, files=None):
+	"""-------------------------------------------------------------------------
+	Builds a ModelSet from the lists of PitchDistribution objects of the modes.
+	The distributions are aligned on a common bin grid; the PDs, which may span
+	different ranges, are zero padded to the union of their ranges.
+	----------------------------------------------------------------------------
+	mode_dists : List of lists of PitchDistribution objects. The ith list is the
+	             collection of the ith mode.
+	mode_names : Names of the modes, parallel to mode_dists
+	files      : The model files these distributions are loaded from, if any.
+	             They are used to detect if the model set is stale.
+	-------------------------------------------------------------------------"""
+	dists = [d for col in mode_dists for d in col]
+	if not dists:
+		raise ValueError('The model set is empty')
+	if any(d.step_size != dists[0].step_size for d in dists):
+		raise ValueError('The models have different step sizes')
+
+	bins, vals, first_bins, num_bins = mFile.align([d.bins for d in dists], [d.vals for d in dists])
+	mode_codes = np.repeat(np.arange(len(mode_dists)), [len(col) for col in mode_dists])
+	return ModelSet(bins, vals, mode_names, mode_codes, [d.source for d in dists],
+	                first_bins=first_bins, num_bins=num_bins,
+	                kernel_widths=[d.kernel_width for d in dists], ref_freqs=[d.ref_freq for d in dists],
+	                segments=[d.segmentation for d in dists], overlaps=[d.overlap for d in dists],
+	                files=files)
+
+
+def load(mode_names, dist_dir='./'):
+	"""-------------------------------------------------------------------------
+	Loads the model files of the given modes into a single ModelSet. Each file
+	is expected to be named "mode_name.model" (binary) or "mode_name.json" and
+	to contain a list of distributions, as saved by the train() functions. See
+	ModelFile for the formats. The values of the binary model files are
+	memory-mapped. Several files aren't copied into one matrix on load; they
+	are stacked by a RowStack, which reads the rows from the files as they are
+	needed. See models() and vals of ModelSet.
+	----------------------------------------------------------------------------
+	mode_names : Names of the modes to be loaded
+	dist_dir   : Directory where the model files are stored.
+	-------------------------------------------------------------------------"""
+	files = [mFile.model_path(dist_dir, mode_name) for mode_name in mode_names]
+	parts = [mFile.read_any(fname) for fname in files]
+	if not parts:
+		raise ValueError('The model set is empty')
+
+	# Each file has its own grid. The grids are merged by placing each file's
+	# matrix at the offset of its first bin on the union grid.
+	step_size = mFile.step_size(parts[0][0])
+	starts = [int(round(bins[0] / step_size)) for bins, vals, rows in parts]
+	grid_start = min(starts)
+	grid_len = max(start + len(bins) for start, (bins, vals, rows) in zip(starts, parts)) - grid_start
+
+	if len(parts) == 1:
+		bins, vals, rows = parts[0]
+	else:
+		if starts[0] == grid_start and grid_len == len(parts[0][0]):
+			bins = parts[0][0]
+		else:
+			bins = np.arange(grid_start, grid_start + grid_len) * step_size
+		vals = RowStack([(part_vals, np.arange(len(part_vals)), start - grid_start)
+		                 for start, (part_bins, part_vals, part_rows) in zip(starts, parts)], grid_len)
+		rows = [dict(r, first_bin=r['first_bin'] + start - grid_start)
+		        for start, (part_bins, part_vals, part_rows) in zip(starts, parts) for r in part_rows]
+
+	mode_codes = np.repeat(np.arange(len(parts)), [len(p[2]) for p in parts])
+	return ModelSet(bins, vals, mode_names, mode_codes, [r['source'] for r in rows],
+	                first_bins=[r['first_bin'] for r in rows], num_bins=[r['num_bins'] for r in rows],
+	                kernel_widths=[r['kernel_width'] for r in rows], ref_freqs=[r['ref_freq'] for r in rows],
+	                segments=[r['segmentation'] for r in rows], overlaps=[r['overlap'] for r in rows],
+	                files=files)
+
+
+def read(fname):
+	"""-------------------------------------------------------------------------
+	Loads a ModelSet saved by save() with the mode labels, e.g. from a model
+	store. The values are memory-mapped read-only, so the processes that read
+	the same file share its pages. A file without the mode labels is read as
+	a single mode, named after the file.
+	----------------------------------------------------------------------------
+	fname : The name of the binary model file
+	-------------------------------------------------------------------------"""
+	bins, vals, rows = mFile.read(fname)
+	mode_names = mFile.read_mode_names(fname)
+	if mode_names is None:
+		mode_names = [os.path.splitext(os.path.basename(fname))[0]]
+	return ModelSet(bins, vals, mode_names, [r.get('mode_code', 0) for r in rows], [r['source'] for r in rows],
+	                first_bins=[r['first_bin'] for r in rows], num_bins=[r['num_bins'] for r in rows],
+	                kernel_widths=[r['kernel_width'] for r in rows], ref_freqs=[r['ref_freq'] for r in rows],
+	                segments=[r['segmentation'] for r in rows], overlaps=[r['overlap'] for r in rows],
+	                files=[fname])
+
+
+def take_rows(vals, idxs):
+	"""-------------------------------------------------------------------------
+	Returns the RowStack of the given rows of a model matrix or a RowStack,
+	without reading them. The rows are kept as ranges of the arrays they are
+	in, e.g. the memory maps of the model files.
+	----------------------------------------------------------------------------
+	vals : 2-D array of the model values or a RowStack
+	idxs : The indices of the rows, in the order of the result
+	-------------------------------------------------------------------------"""
+	if not isinstance(vals, RowStack):
+		vals = RowStack([(vals, np.arange(len(vals)), 0)], vals.shape[1])
+	idxs = np.asarray(idxs, dtype=int)
+
+	# The rows are grouped into the runs that are in the same part
+	part_idxs = np.searchsorted(vals.offsets, idxs, side='right') - 1
+	local = idxs - vals.offsets[part_idxs]
+	bounds = np.concatenate(([0], np.flatnonzero(np.diff(part_idxs)) + 1, [len(idxs)]))
+	parts = [(vals.parts[part_idxs[a]][0], vals.parts[part_idxs[a]][1][local[a:b]], vals.parts[part_idxs[a]][2])
+	         for a, b in zip(bounds[:-1], bounds[1:]) if b > a]
+	return RowStack(parts, vals.shape[1])
+
+
+class RowStack:
+
+	def __init__(self, parts, num_cols):
+		"""------------------------------------------------------------------------
+		A model matrix stacked from the rows of several arrays, e.g. the memory
+		maps of the model files of the modes or the rows of the modes in a model
+		store, without copying them into a single matrix. Only the rows that are
+		indexed are read, so the search that reads the models a block of rows at
+		a time, e.g. scan_top_k() of ModeFunctions, never holds the whole matrix
+		in memory. np.asarray() of it is the whole matrix.
+		---------------------------------------------------------------------------
+		parts    : List of (array, rows, col_offset) triples. The rows of the
+		           stack are the given rows of each array in turn; the columns of
+		           each array start from col_offset, the rest are zero.
+		num_cols : The number of columns of the stack
+		------------------------------------------------------------------------"""
+		self.parts = [(arr, np.asarray(rows, dtype=int), int(offset)) for arr, rows, offset in parts]
+		self.offsets = np.concatenate(([0], np.cumsum([len(rows) for arr, rows, offset in self.parts])))
+		self.shape = (int(self.offsets[-1]), int(num_cols))
+		self.ndim = 2
+		self.dtype = np.dtype(float)
+
+	def __len__(self):
+		return self.shape[0]
+
+	def __array__(self, dtype=None):
+		vals = self.read(np.arange(len(self)))
+		return vals if dtype is None else vals.astype(dtype)
+
+	def __getitem__(self, key):
+		# A row or a range of rows, an array of row indices or a (rows, cols)
+		# tuple, as an array is indexed
+		if isinstance(key, tuple):
+			return self[key[0]][(Ellipsis,) + key[1:]]
+		if isinstance(key, slice):
+			return self.read(np.arange(len(self))[key])
+		if np.ndim(key) == 0:
+			return self.read(np.arange(len(self))[[key]])[0]
+		return self.read(np.arange(len(self))[np.asarray(key)])
+
+	def read(self, idxs):
+		"""-------------------------------------------------------------------------
+		Reads the given rows into a matrix. A range of rows of a single array
+		that spans all the columns is returned as a view of the array.
+		-------------------------------------------------------------------------"""
+		idxs = np.asarray(idxs, dtype=int)
+		part_idxs = np.searchsorted(self.offsets, idxs, side='right') - 1
+		local = idxs - self.offsets[part_idxs]
+		bounds = np.concatenate(([0], np.flatnonzero(np.diff(part_idxs)) + 1, [len(idxs)]))
+
+		blocks = []
+		for a, b in [(a, b) for a, b in zip(bounds[:-1], bounds[1:]) if b > a]:
+			arr, rows, offset = self.parts[part_idxs[a]]
+			part_rows = rows[local[a:b]]
+			# Consecutive rows are read as a slice of the array, e.g. a range
+			# of a memory map, rather than gathered
+			if len(part_rows) and np.array_equal(part_rows, np.arange(part_rows[0], part_rows[0] + len(part_rows))):
+				blocks.append((arr[part_rows[0]:part_rows[0] + len(part_rows)], offset))
+			else:
+				blocks.append((arr[part_rows], offset))
+
+		if len(blocks) == 1 and blocks[0][1] == 0 and blocks[0][0].shape[1] == self.shape[1]:
+			return np.asarray(blocks[0][0], dtype=float)
+
+		vals = np.zeros((len(idxs), self.shape[1]))
+		row = 0
+		for block, offset in blocks:
+			vals[row:row + len(block), offset:offset + block.shape[1]] = block
+			row += len(block)
+		return vals
+
+
+class ModelSet:
+
+	def __init__(self, bins, vals, mode_names, mode_codes, sources, first_bins=None, num_bins=None,
+	             kernel_widths=None, ref_freqs=None, segments=None, overlaps=None, files=None):
+		"""------------------------------------------------------------------------
+		A loaded set of mode models, where all model distributions are stacked in
+		one contiguous matrix. This is built once and shared between estimations,
+		so the arrays are read-only; none of the estimation functions are allowed
+		to modify them.
+		---------------------------------------------------------------------------
+		bins          : The common bins of the models
+		vals          : 2-D array of the model values, one model per row, or a
+		                RowStack of them. See models().
+		mode_names    : Names of the modes in the set
+		mode_codes    : Integer array, the index of the mode (in mode_names) that
+		                each model belongs to
+		sources       : Array of the sources, i.e. the recording name/id each
+		                model is generated from
+		first_bins    : The index of the first bin of each model in bins. The
+		                model spans num_bins bins from there on. These are only
+		                different from zero/len(bins) for the PD models.
+		num_bins      : The original number of bins of each model
+		kernel_widths : Kernel widths of the models. See PitchDistribution.
+		ref_freqs     : Reference frequencies of the models
+		segments      : Segmentation info of the models
+		overlaps      : Overlap info of the models
+		files         : The model files the set is loaded from. The size and the
+		                modification time of these are recorded to find out if
+		                the set is stale.
+		------------------------------------------------------------------------"""
+		num_models = len(vals)
+
+		self.bins = np.asarray(bins, dtype=float)
+		# A RowStack is only read into a matrix if the whole matrix is needed.
+		# See vals.
+		if isinstance(vals, RowStack):
+			self._models, self._vals = vals, None
+		else:
+			self._vals = vals if isinstance(vals, np.memmap) else np.ascontiguousarray(vals, dtype=float)
+			self._models = self._vals
+		self.mode_names = list(mode_names)
+		self.mode_codes = np.asarray(mode_codes, dtype=int)
+		# The sources are filled one by one, since a source may be a list, e.g.
+		# the recordings of a Bozkurt model
+		self.sources = np.empty(num_models, dtype=object)
+		for i, source in enumerate(sources):
+			self.sources[i] = source
+		self.first_bins = np.zeros(num_models, dtype=int) if first_bins is None else np.asarray(first_bins, dtype=int)
+		self.num_bins = np.repeat(len(self.bins), num_models) if num_bins is None else np.asarray(num_bins, dtype=int)
+		self.kernel_widths = [7.5] * num_models if kernel_widths is None else list(kernel_widths)
+		self.ref_freqs = [440] * num_models if ref_freqs is None else list(ref_freqs)
+		self.segments = ['all'] * num_models if segments is None else list(segments)
+		self.overlaps = ['-'] * num_models if overlaps is None else list(overlaps)
+		self.files = [] if files is None else list(files)
+		self.stamps = [file_stamp(fname) for fname in self.files]
+
+		# The shared arrays are made read-only
+		arrs = [self.bins, self.mode_codes, self.first_bins, self.num_bins]
+		arrs += [arr for arr, rows, offset in self._models.parts] if self._vals is None else [self._vals]
+		for arr in arrs:
+			arr.flags.writeable = False
+
+		# The DFT signatures of the PCD models, generated on the first request.
+		# See signatures().
+		self._signatures = None
+
+		# The ball trees of the models, loaded or built on the first request. See
+		# trees().
+		self._trees = None
+
+		# The inverted files of the models, keyed by their projection dimension.
+		# See inverted_file().
+		self._inverted_files = {}
+
+		# The subsets of the modes, keyed by the mode names. See subset().
+		self._subsets = {}
+
+	def __len__(self):
+		return len(self._models)
+
+	@property
+	def vals(self):
+		"""-------------------------------------------------------------------------
+		The 2-D array of the model values, one model per row. If the set is a
+		RowStack, e.g. loaded from several model files, it is read into a single
+		matrix on the first access and kept.
+		-------------------------------------------------------------------------"""
+		if self._vals is None:
+			self._vals = np.asarray(self._models)
+			self._vals.flags.writeable = False
+		return self._vals
+
+	def models(self):
+		"""-------------------------------------------------------------------------
+		Returns the model values as they are kept: a 2-D array, e.g. a memory
+		map, or a RowStack whose rows are read as they are indexed. The searches
+		that read the models a block of rows at a time, i.e. the 'scan', 'tree'
+		and 'ivf' searches of ChordiaEstimation, use this instead of vals, so a
+		set that doesn't fit in the memory is never read as a whole.
+		-------------------------------------------------------------------------"""
+		return self._models
+
+	def is_pcd(self):
+		"""-------------------------------------------------------------------------
+		The boolean flag of whether the models are PCDs or not.
+		-------------------------------------------------------------------------"""
+		step_size = self.bins[1] - self.bins[0]
+		return (self.bins[0] == 0 and abs(self.bins[-1] + step_size - 1200) < 1e-6)
+
+	def is_stale(self):
+		"""-------------------------------------------------------------------------
+		Checks whether any of the model files is changed (or removed) since the
+		set is loaded.
+		-------------------------------------------------------------------------"""
+		try:
+			return any(file_stamp(fname) != stamp for fname, stamp in zip(self.files, self.stamps))
+		except (IOError, OSError):
+			return True
+
+	def signatures(self):
+		"""-------------------------------------------------------------------------
+		Returns the shift-invariant signatures of the PCD models, one per row. They
+		are generated once and kept with the models. See dft_signature() of
+		ModeFunctions.
+		-------------------------------------------------------------------------"""
+		if self._signatures is None:
+			self._signatures = mF.dft_signature(self.vals)
+			self._signatures.flags.writeable = False
+		return self._signatures
+
+	def trees(self):
+		"""-------------------------------------------------------------------------
+		Returns the ball trees of the PCD models, one per model file, for the
+		nearest neighbor search. See MetricTree. The trees saved next to the model
+		files are loaded, if they are built from the current files; otherwise
+		they are built in memory. A set that isn't loaded from a model file per
+		mode, e.g. a model store, has a single tree. The trees are kept with the
+		models.
+		-------------------------------------------------------------------------"""
+		if self._trees is None:
+			if len(self.files) != len(self.mode_names):
+				self._trees = [mT.build(self._models)]
+			else:
+				self._trees = []
+				for code, (fname, stamp) in enumerate(zip(self.files, self.stamps)):
+					rows = np.where(self.mode_codes == code)[0]
+					tree = mT.load(mT.tree_path(fname), stamp=stamp, shape=(len(rows), len(self.bins)))
+					tree = mT.build(self._models[rows]) if tree is None else tree
+					tree.offset = rows[0] if len(rows) else 0
+					self._trees.append(tree)
+		return self._trees
+
+	def inverted_file(self, dim=iF.PROJECTION_DIM):
+		"""-------------------------------------------------------------------------
+		Returns the inverted file of the models for the approximate nearest
+		neighbor search, with the given projection dimension. It is built on the
+		first request and kept with the models. See InvertedFile.
+		-------------------------------------------------------------------------"""
+		if dim not in self._inverted_files:
+			self._inverted_files[dim] = iF.build(self._models, dim=dim)
+		return self._inverted_files[dim]
+
+	def subset(self, mode_names):
+		"""-------------------------------------------------------------------------
+		Returns the ModelSet of the given modes of the set, e.g. the annotated
+		mode of a model store. If the models of the modes are consecutive rows
+		of a matrix, e.g. a single mode, the values are a view of the matrix;
+		otherwise they are a RowStack of the rows of the set, so nothing is
+		copied either way. The subsets are kept with the set.
+		----------------------------------------------------------------------------
+		mode_names : Names of the modes, in the order of the subset
+		-------------------------------------------------------------------------"""
+		key = tuple(mode_names)
+		if key == tuple(self.mode_names):
+			return self
+
+		if key not in self._subsets:
+			mode_idxs = [self.mode_idxs(m) for m in mode_names]
+			idxs = np.concatenate(mode_idxs)
+			if (not isinstance(self._models, RowStack) and len(idxs) and
+			    np.array_equal(idxs, np.arange(idxs[0], idxs[0] + len(idxs)))):
+				vals = self._models[idxs[0]:idxs[0] + len(idxs)]
+			else:
+				vals = take_rows(self._models, idxs)
+
+			# The model files are kept per mode, if the set is loaded so
+			files = [self.files[self.mode_names.index(m)] for m in mode_names] \
+				if len(self.files) == len(self.mode_names) else self.files
+			self._subsets[key] = ModelSet(self.bins, vals, mode_names,
+			                              np.repeat(np.arange(len(mode_names)), [len(i) for i in mode_idxs]),
+			                              self.sources[idxs], first_bins=self.first_bins[idxs],
+			                              num_bins=self.num_bins[idxs],
+			                              kernel_widths=[self.kernel_widths[i] for i in idxs],
+			                              ref_freqs=[self.ref_freqs[i] for i in idxs],
+			                              segments=[self.segments[i] for i in idxs],
+			                              overlaps=[self.overlaps[i] for i in idxs], files=files)
+		return self._subsets[key]
+
+	def mode_idxs(self, mode_name):
+		"""-------------------------------------------------------------------------
+		Returns the row indices of the models of the given mode.
+		-------------------------------------------------------------------------"""
+		return np.where(self.mode_codes == self.mode_names.index(mode_name))[0]
+
+	def dist(self, idx):
+		"""-------------------------------------------------------------------------
+		Returns the PitchDistribution object of the idxth model, on its original
+		bins. The values are a read-only view of the model matrix, or read from
+		the RowStack. See models().
+		-------------------------------------------------------------------------"""
+		start, stop = self.first_bins[idx], self.first_bins[idx] + self.num_bins[idx]
+		return pD.PitchDistribution(self.bins[start:stop], self._models[idx, start:stop],
+		                            kernel_width=self.kernel_widths[idx], source=self.sources[idx],
+		                            ref_freq=self.ref_freqs[idx], segment=self.segments[idx],
+		                            overlap=self.overlaps[idx])
+
+	def dists(self, idxs=None):
+		"""-------------------------------------------------------------------------
+		Returns the list of PitchDistribution objects of the given models. If
+		idxs is None, all models are returned.
+		-------------------------------------------------------------------------"""
+		idxs = range(len(self)) if idxs is None else idxs
+		return [self.dist(i) for i in idxs]
+
+	def save(self, fname, with_modes=False):
+		"""-------------------------------------------------------------------------
+		Saves the models to a binary model file. By default, the mode labels
+		aren't saved; the model files are per mode. See ModelFile for the format.
+		----------------------------------------------------------------------------
+		fname      : The name of the file to be created
+		with_modes : Whether the mode names and the mode code of each model are
+		             saved, so the whole set is loaded back by read()
+		-------------------------------------------------------------------------"""
+		rows = [{'source': self.sources[i], 'segmentation': self.segments[i], 'overlap': self.overlaps[i],
+		         'kernel_width': self.kernel_widths[i], 'ref_freq': self.ref_freqs[i],
+		         'first_bin': int(self.first_bins[i]), 'num_bins': int(self.num_bins[i])}
+		        for i in range(len(self))]
+		if with_modes:
+			for row, code in zip(rows, self.mode_codes):
+				row['mode_code'] = int(code)
+		mFile.write(fname, self.bins, self.vals, rows, mode_names=self.mode_names if with_modes else None)
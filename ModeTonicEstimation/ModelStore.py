@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+import tempfile
+import os
+from ModeTonicEstimation import ModelSet as mS
+from ModeTonicEstimation import ModelFile as mFile
+
+# A model store shares a ModelSet between the processes of a machine, e.g. the
+# workers of a multiprocessing pool. The set is published once as a binary
+# model file with the mode labels (see save() of ModelSet) and each worker
+# attaches to it by name. The values are memory-mapped read-only, so all
+# workers share the same pages of the file, instead of each loading its own
+# copy. On Linux, the store is in /dev/shm, which is kept in memory.
+#
+#   ModelStore.publish(ModelSet.load(modes, 'models/'), 'makam')   # once
+#   model_set = ModelStore.attach('makam')                         # in each worker
+#   chordia.estimate(pitch_file, mode_names=modes, mode_dir=model_set)
+#
+# A set that doesn't fit in the memory is published from its model files by
+# publish_files() and searched block by block with neighbor_search='scan'.
+
+
+def default_dir():
+	"""-------------------------------------------------------------------------
+	Returns the default directory of the store: /dev/shm if it exists, else
+	the temporary directory of the system.
+	-------------------------------------------------------------------------"""
+	return '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+
+
+def store_path(name, store_dir=None):
+	"""-------------------------------------------------------------------------
+	Returns the path of the model file of a published set.
+	-------------------------------------------------------------------------"""
+	return os.path.join(store_dir or default_dir(), name + mFile.BINARY_EXT)
+
+
+def publish(model_set, name, store_dir=None):
+	"""-------------------------------------------------------------------------
+	Publishes a ModelSet to the store under the given name and returns the
+	path of its file. The file is written under a temporary name and renamed
+	by write() of ModelFile, so that a worker never attaches to a partially
+	written set and the workers attached to a previous set keep it.
+	----------------------------------------------------------------------------
+	model_set : The ModelSet to be shared, e.g. loaded by load() of ModelSet
+	name      : The name of the set in the store
+	store_dir : The directory of the store. See default_dir().
+	-------------------------------------------------------------------------"""
+	fname = store_path(name, store_dir)
+	model_set.save(fname, with_modes=True)
+	return fname
+
+
+def publish_files(mode_names, dist_dir, name, store_dir=None):
+	"""-------------------------------------------------------------------------
+	Publishes the model files of the given modes to the store under the given
+	name and returns the path of its file. The files are merged block by block
+	(see merge() of ModelFile), without loading the whole set into memory, so
+	that a set larger than the memory can be published and then searched from
+	its memory map, e.g. with neighbor_search='scan' in ChordiaEstimation. As
+	in publish(), the file is written under a temporary name and renamed.
+	----------------------------------------------------------------------------
+	mode_names : Names of the modes to be published
+	dist_dir   : Directory where the model files are stored. See load() of
+	             ModelSet.
+	name       : The name of the set in the store
+	store_dir  : The directory of the store. See default_dir().
+	-------------------------------------------------------------------------"""
+	fnames = [mFile.model_path(dist_dir, mode_name) for mode_name in mode_names]
+	fname = store_path(name, store_dir)
+	mFile.merge(fnames, fname, mode_names)
+	return fname
+
+
+def attach(name, store_dir=None):
+	"""-------------------------------------------------------------------------
+	Attaches to a published set. The values of the returned ModelSet are a
+	read-only memory map of the file of the set. See read() of ModelSet.
+	----------------------------------------------------------------------------
+	name      : The name of the set in the store
+	store_dir : The directory of the store. See default_dir().
+	-------------------------------------------------------------------------"""
+	fname = store_path(name, store_dir)
+	if not os.path.isfile(fname):
+		raise IOError('There is no published model set named ' + name)
+	return mS.read(fname)
+
+
+def unlink(name, store_dir=None):
+	"""-------------------------------------------------------------------------
+	Removes a published set from the store. The processes that are attached
+	to it keep their memory maps until they release them.
+	-------------------------------------------------------------------------"""
+	os.remove(store_path(name, store_dir))
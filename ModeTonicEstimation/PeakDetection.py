@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+
+# The maximum number of peaks per distribution, as the default of Essentia
+MAX_PEAKS = 100
+
+BACKENDS = ['numpy', 'essentia']
+
+
+def peak_positions(vals_mat, max_peaks=MAX_PEAKS):
+	"""-------------------------------------------------------------------------
+	Finds the peaks of each row of a 2-D array of distributions at once. This is
+	a vectorized port of the PeakDetection algorithm of Essentia with its
+	default parameters, which used to be called by detect_peaks() of
+	PitchDistribution. A peak is either:
+
+	  * a local maximum; its position is refined by parabolic interpolation,
+	  * a plateau, which is climbed into and followed by a lower sample; its
+	    position is the middle of the plateau,
+	  * the first or the last sample, if it is higher than its neighbor.
+
+	As in Essentia, a plateau that ends at the sample before the last isn't a
+	peak, the values are compared and interpolated in single precision and the
+	first max_peaks peaks (by position) of each row are kept. The normalized
+	positions are the bins multiplied by the single precision 1 / (number of
+	samples - 1), as Essentia, so a plateau in the middle of two samples may be
+	rounded to either of them and the last sample may be excluded for some
+	numbers of samples. The only known difference is for two samples, where
+	Essentia reads before the start of the distribution and may report the
+	first sample twice.
+	----------------------------------------------------------------------------
+	vals_mat  : 2-D array of distribution values, one distribution per row
+	max_peaks : The maximum number of peaks per row
+	----------------------------------------------------------------------------
+	rows      : The row of each peak, in ascending order
+	positions : The position of each peak in samples, in ascending order within
+	            each row. It is the same as Essentia's normalized position
+	            multiplied by (number of samples - 1).
+	peak_vals : The (interpolated) value of each peak, in single precision
+	-------------------------------------------------------------------------"""
+	vals = np.atleast_2d(np.asarray(vals_mat, dtype=np.float32))
+	num_rows, num_vals = vals.shape
+	if num_vals < 2:
+		raise ValueError('The distributions should have at least two samples')
+
+	# The direction of each step: 1 rising, -1 falling, 0 flat. The last non-flat
+	# step before a falling step tells whether a plateau is climbed into.
+	steps = np.sign(vals[:, 1:] - vals[:, :-1])
+	last_step = np.maximum.accumulate(np.where(steps != 0, np.arange(num_vals - 1), -1), axis=1)
+
+	# Interior peaks: the plateau [start, end] (a single sample if start is end)
+	# is followed by a falling step and preceded by a rising one
+	rows, ends = np.nonzero(steps[:, 1:] < 0)
+	ends += 1
+	starts = last_step[rows, ends - 1] + 1
+	is_peak = (starts > 0) & (steps[rows, starts - 1] > 0)
+	is_peak &= (ends < num_vals - 2) | (starts == ends)
+	rows, starts, ends = rows[is_peak], starts[is_peak], ends[is_peak]
+
+	left, mid, right = vals[rows, ends - 1], vals[rows, ends], vals[rows, ends + 1]
+	with np.errstate(divide='ignore', invalid='ignore'):
+		delta = np.float32(0.5) * ((left - right) / (left - np.float32(2) * mid + right))
+	interp_vals = (mid.astype(float) - 0.25 * (left - right).astype(float) * delta).astype(np.float32)
+
+	single = starts == ends
+	bins = np.where(single, ends.astype(np.float32) + delta,
+	                (starts + ends).astype(np.float32) * np.float32(0.5)).astype(np.float32)
+	peak_vals = np.where(single, interp_vals, mid)
+
+	# Boundary peaks. Essentia checks the last sample against its normalized
+	# maximum position, which may exclude it due to the rounding.
+	scale = np.float32(1) / np.float32(num_vals - 1)
+	first_rows = np.nonzero(steps[:, 0] < 0)[0]
+	max_bin = np.float32(1) / scale
+	last_rows = np.nonzero(steps[:, -1] > 0)[0] if (num_vals - 2 < max_bin <= num_vals - 1) else np.zeros(0, int)
+
+	rows = np.concatenate((first_rows, rows, last_rows))
+	keys = np.concatenate((np.zeros(len(first_rows), int), ends, np.repeat(num_vals - 1, len(last_rows))))
+	bins = np.concatenate((np.zeros(len(first_rows), np.float32), bins,
+	                       np.repeat(np.float32(num_vals - 1), len(last_rows))))
+	peak_vals = np.concatenate((vals[first_rows, 0], peak_vals, vals[last_rows, -1]))
+
+	# sort by row, then by position, and keep the first max_peaks of each row
+	order = np.lexsort((keys, rows))
+	rows, bins, peak_vals = rows[order], bins[order], peak_vals[order]
+	rank = np.arange(len(rows)) - np.searchsorted(rows, rows)
+	keep = rank < max_peaks
+
+	# The normalized positions are computed in single precision, as Essentia
+	positions = (bins[keep] * scale).astype(float) * (num_vals - 1)
+	return rows[keep], positions, peak_vals[keep]
+
+
+def drop_wrapped(peak_idxs, peak_vals):
+	"""-------------------------------------------------------------------------
+	If there is a peak at the first bin, the last peak is dropped. For a PCD,
+	the last peak is the same peak as the first due to the circularity.
+	-------------------------------------------------------------------------"""
+	if len(peak_idxs) and peak_idxs[0] == 0:
+		return peak_idxs[:-1], peak_vals[:-1]
+	return peak_idxs, peak_vals
+
+
+def detect_peaks_batch(vals_mat, wrap=True):
+	"""-------------------------------------------------------------------------
+	Finds the peak indices of each row of a 2-D array of distributions. The
+	positions of peak_positions() are rounded to the nearest bin.
+	----------------------------------------------------------------------------
+	vals_mat : 2-D array of distribution values, one distribution per row
+	wrap     : Whether the wrapped peaks are dropped. See drop_wrapped().
+	----------------------------------------------------------------------------
+	A list of (peak_idxs, peak_vals) pairs, one per row
+	-------------------------------------------------------------------------"""
+	vals_mat = np.atleast_2d(vals_mat)
+	rows, positions, peak_vals = peak_positions(vals_mat)
+	peak_idxs = np.floor(positions + 0.5).astype(int)
+
+	splits = np.searchsorted(rows, np.arange(1, len(vals_mat)))
+	peaks = zip(np.split(peak_idxs, splits), np.split(peak_vals, splits))
+	return [drop_wrapped(idxs, pvals) if wrap else (idxs, pvals) for idxs, pvals in peaks]
+
+
+def essentia_peaks(vals):
+	"""-------------------------------------------------------------------------
+	Finds the peaks of a distribution by the PeakDetection algorithm of
+	Essentia. Essentia is imported only when this is called.
+	----------------------------------------------------------------------------
+	vals      : The values of the distribution
+	----------------------------------------------------------------------------
+	peak_idxs : The indices of the peaks
+	peak_vals : The values of the peaks
+	-------------------------------------------------------------------------"""
+	import essentia
+	import essentia.standard as std
+
+	peak_bins, peak_vals = std.PeakDetection()(essentia.array(vals))
+
+	# Essentia normalizes the positions to 1, they are converted here
+	# to actual index values to be used in bins. The halves are rounded up
+	# as detect_peaks_batch(), regardless of the rounding of round().
+	peak_idxs = np.floor(np.asarray(peak_bins, dtype=float) * (len(vals) - 1) + 0.5).astype(int)
+	return peak_idxs, peak_vals
+
+
+def detect_peaks(vals, wrap=True, backend='numpy'):
+	"""-------------------------------------------------------------------------
+	Finds the peak indices of a distribution.
+	----------------------------------------------------------------------------
+	vals    : The values of the distribution
+	wrap    : Whether the wrapped peak is dropped. See drop_wrapped().
+	backend : 'numpy' for peak_positions() or 'essentia'. Both find the same
+	          peaks, except for the two-sample case noted in peak_positions().
+	-------------------------------------------------------------------------"""
+	if backend == 'essentia':
+		peak_idxs, peak_vals = essentia_peaks(vals)
+		return drop_wrapped(peak_idxs, peak_vals) if wrap else (peak_idxs, peak_vals)
+	elif backend == 'numpy':
+		return detect_peaks_batch([vals], wrap=wrap)[0]
+	raise ValueError('Unknown peak detection backend: ' + str(backend))
@@ -1,23 +1,25 @@
 # -*- coding: utf-8 -*-
-import essentia
-import essentia.standard as std
 import numpy as np
 import json
 import os
+from ModeTonicEstimation import ModelFile as mFile
+from ModeTonicEstimation import PeakDetection as pK
 
 def load(fname):
 	"""-------------------------------------------------------------------------
-	Loads a PitchDistribution object from JSON file.
+	Loads a PitchDistribution object from a JSON or a binary model file. The
+	format is detected from the file content. The values of a binary file are
+	memory-mapped read-only. See ModelFile for the formats.
 	----------------------------------------------------------------------------
-	fname    : The filename of the JSON file
+	fname    : The filename of the JSON or binary model file
 	-------------------------------------------------------------------------"""
-	with open(fname) as f:
-		dist = json.load(f)
+	bins, vals, rows = mFile.read_any(fname)
+	start, stop = rows[0]['first_bin'], rows[0]['first_bin'] + rows[0]['num_bins']
 
-	return PitchDistribution(np.array(dist[0]['bins']), np.array(dist[0]['vals']),
-		                     kernel_width=dist[0]['kernel_width'],
-		                     source=dist[0]['source'], ref_freq=dist[0]['ref_freq'],
-		                     segment=dist[0]['segmentation'], overlap=dist[0]['overlap'])
+	return PitchDistribution(bins[start:stop], vals[0, start:stop],
+		                     kernel_width=rows[0]['kernel_width'],
+		                     source=rows[0]['source'], ref_freq=rows[0]['ref_freq'],
+		                     segment=rows[0]['segmentation'], overlap=rows[0]['overlap'])
 
 class PitchDistribution:
 	
@@ -63,11 +65,20 @@ class PitchDistribution:
 
 	def save(self, fname, save_dir='./'):
 		"""-------------------------------------------------------------------------
-		Saves the PitchDistribution object to a JSON file.
+		Saves the PitchDistribution object to a JSON file. If fname has the binary
+		model file extension (ModelFile.BINARY_EXT), it is saved in the binary
+		format instead.
 		----------------------------------------------------------------------------
 		fname    : The name of the JSON file to be created.
 		save_dir : Pathway of where the JSON would saved
 		-------------------------------------------------------------------------"""
+		if fname.endswith(mFile.BINARY_EXT):
+			mFile.write(os.path.join(save_dir, fname), self.bins, [self.vals],
+			            [{'source': self.source, 'segmentation': self.segmentation,
+			              'overlap': self.overlap, 'kernel_width': self.kernel_width,
+			              'ref_freq': self.ref_freq, 'first_bin': 0, 'num_bins': len(self.bins)}])
+			return
+
 		dist_json = [{'bins':self.bins.tolist(), 'vals':self.vals.tolist(),
 		              'kernel_width':self.kernel_width, 'source':self.source,
 		              'ref_freq':self.ref_freq, 'segmentation':self.segmentation,
@@ -82,22 +93,19 @@ class PitchDistribution:
 		-------------------------------------------------------------------------"""
 		return (max(self.bins) == (1200 - self.step_size) and min(self.bins) == 0)
 
-	def detect_peaks(self):
+	def detect_peaks(self, backend='numpy'):
 		"""-------------------------------------------------------------------------
 		Finds the peak indices of the distribution. These are treated as tonic
 		candidates in higher order functions.
+		----------------------------------------------------------------------------
+		backend : 'numpy' for the vectorized port of Essentia's PeakDetection or
+		          'essentia' for Essentia itself, which is imported only then.
+		          Both find the same peaks, except for the two-sample case noted
+		          in peak_positions() of PeakDetection.
 		-------------------------------------------------------------------------"""
-		# Peak detection is handled by Essentia
-		detector = std.PeakDetection()
-		peak_bins, peak_vals = detector(essentia.array(self.vals))
-
-		# Essentia normalizes the positions to 1, they are converted here
-		# to actual index values to be used in bins.
-		peak_idxs = [round(bn * (len(self.bins) - 1)) for bn in peak_bins]
-		if(peak_idxs[0] == 0):
-			peak_idxs = np.delete(peak_idxs, [len(peak_idxs) - 1])
-			peak_vals = np.delete(peak_vals, [len(peak_vals) - 1])
-		return peak_idxs, peak_vals
+		# If there is a peak at the first bin, the last peak is dropped, since it
+		# is the same peak for a PCD.
+		return pK.detect_peaks(self.vals, wrap=True, backend=backend)
 
 	def shift(self, shift_idx):
 		"""-------------------------------------------------------------------------
@@ -112,9 +120,9 @@ class PitchDistribution:
 			if self.is_pcd():
 				shifted_vals = np.concatenate((self.vals[shift_idx:], self.vals[:shift_idx]))
 			
-			# If distribution is a PD, it just shifts the values. In this case,
-			# pd_zero_pad() of ModeFunctions is always applied beforehand to make
-			# sure that no non-zero values are dropped.
+			# If distribution is a PD, it just shifts the values, so the values
+			# shifted out are dropped. The estimation functions compare the shifted
+			# PDs by pd_distance() of ModeFunctions instead, which keeps them.
 			else:
 				
 				# Shift towards left
@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+import json
+import os
+from ModeTonicEstimation import ModeFunctions as mF
+
+
+def load(fname):
+	"""-------------------------------------------------------------------------
+	Loads a PitchHistogram object from JSON file.
+	----------------------------------------------------------------------------
+	fname    : The filename of the JSON file
+	-------------------------------------------------------------------------"""
+	with open(fname) as f:
+		hist = json.load(f)
+
+	return PitchHistogram(step_size=hist['step_size'], first_bin=hist['first_bin'],
+	                      counts=np.array(hist['counts'], dtype=np.int64), sources=hist['sources'])
+
+
+def merge(hists):
+	"""-------------------------------------------------------------------------
+	Merges a list of PitchHistogram objects, e.g. the partial models of a mode
+	trained on different processes, into a new one.
+	----------------------------------------------------------------------------
+	hists    : List of PitchHistogram objects with the same step size
+	-------------------------------------------------------------------------"""
+	merged = PitchHistogram(step_size=hists[0].step_size)
+	for h in hists:
+		merged.merge(h)
+	return merged
+
+
+class PitchHistogram:
+
+	def __init__(self, step_size=7.5, first_bin=0, counts=None, sources=None):
+		"""------------------------------------------------------------------------
+		The unnormalized histogram of the pitch tracks of a mode, i.e. a partial
+		mode model. The pitch tracks are counted one by one on the canonical bin
+		grid (see histogram_counts() of ModeFunctions) and summed, so the memory
+		doesn't depend on the number or the length of the pitch tracks. The
+		model distribution is generated from the sum once, by to_pd().
+
+		Since the counts are kept unnormalized, new recordings can be added to an
+		existing histogram and the histograms trained on separate processes can
+		be merged, without reprocessing the recordings.
+		---------------------------------------------------------------------------
+		step_size : The step size of the bins
+		first_bin : The index of the first bin, i.e. the first bin is at
+		            first_bin * step_size cents.
+		counts    : The number of samples in each bin, starting from first_bin
+		sources   : List of the sources, i.e. the recordings counted so far
+		------------------------------------------------------------------------"""
+		self.step_size = step_size
+		self.first_bin = first_bin
+		self.counts = np.zeros(1, dtype=np.int64) if counts is None else np.asarray(counts, dtype=np.int64)
+		self.sources = [] if sources is None else list(sources)
+
+	def add_counts(self, first_bin, counts):
+		"""-------------------------------------------------------------------------
+		Adds the counts that start from the given bin to the histogram. The range
+		of the histogram is extended if necessary.
+		-------------------------------------------------------------------------"""
+		new_first = min(self.first_bin, first_bin)
+		new_last = max(self.first_bin + len(self.counts), first_bin + len(counts))
+
+		if new_first != self.first_bin or new_last != self.first_bin + len(self.counts):
+			extended = np.zeros(new_last - new_first, dtype=np.int64)
+			extended[self.first_bin - new_first:self.first_bin - new_first + len(self.counts)] = self.counts
+			self.first_bin, self.counts = new_first, extended
+
+		self.counts[first_bin - self.first_bin:first_bin - self.first_bin + len(counts)] += counts
+
+	def add(self, cent_track, source=''):
+		"""-------------------------------------------------------------------------
+		Counts a pitch track and adds it to the histogram.
+		----------------------------------------------------------------------------
+		cent_track : 1-D array of frequency values in cents, w.r.t. the tonic
+		source     : The source information (i.e. recording name/id)
+		-------------------------------------------------------------------------"""
+		first_bin, counts = mF.histogram_counts(cent_track, step_size=self.step_size)
+		self.add_counts(first_bin, counts)
+		self.sources.append(source)
+
+	def merge(self, other):
+		"""-------------------------------------------------------------------------
+		Adds the counts of another histogram to this one.
+		-------------------------------------------------------------------------"""
+		if other.step_size != self.step_size:
+			raise ValueError('The histograms have different step sizes')
+		self.add_counts(other.first_bin, other.counts)
+		self.sources += other.sources
+
+	def to_pd(self, ref_freq=440, smooth_factor=7.5, segment='all'):
+		"""-------------------------------------------------------------------------
+		Generates the model pitch distribution from the accumulated counts. The
+		result is the same as the distribution of a single pitch track, which is
+		the concatenation of all the counted pitch tracks.
+		----------------------------------------------------------------------------
+		ref_freq      : The reference frequency to be recorded in the distribution
+		smooth_factor : Std. deviation of the gaussian kernel. See generate_pd()
+		segment       : The segmentation info to be recorded in the distribution
+		-------------------------------------------------------------------------"""
+		return mF.histogram_to_pd(self.first_bin, self.counts, ref_freq=ref_freq, smooth_factor=smooth_factor,
+		                          step_size=self.step_size, source=self.sources, segment=segment)
+
+	def to_pcd(self, ref_freq=440, smooth_factor=7.5, segment='all'):
+		"""-------------------------------------------------------------------------
+		Generates the model pitch class distribution from the accumulated counts
+		directly, by wrapping the counts to a single octave before the circular
+		kernel density estimation. See histogram_to_pcd() of ModeFunctions. The
+		parameters are the same as to_pd().
+		-------------------------------------------------------------------------"""
+		return mF.histogram_to_pcd(self.first_bin, self.counts, ref_freq=ref_freq, smooth_factor=smooth_factor,
+		                           step_size=self.step_size, source=self.sources, segment=segment)
+
+	def save(self, fname, save_dir='./'):
+		"""-------------------------------------------------------------------------
+		Saves the PitchHistogram object to a JSON file.
+		----------------------------------------------------------------------------
+		fname    : The name of the JSON file to be created.
+		save_dir : Pathway of where the JSON would saved
+		-------------------------------------------------------------------------"""
+		hist_json = {'step_size': self.step_size, 'first_bin': int(self.first_bin),
+		             'counts': self.counts.tolist(), 'sources': self.sources}
+		with open(os.path.join(save_dir, fname), 'w') as f:
+			json.dump(hist_json, f, indent=2)
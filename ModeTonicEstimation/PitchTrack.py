@@ -0,0 +1,230 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+import array
+import struct
+import os
+
+# The binary sidecar of a pitch track is stored next to the text file, as
+# "<name>.pitch.bin". It starts with a fixed size header that records the
+# size and the modification time of the text file it is converted from, so
+# a stale sidecar is detected and regenerated. The parsed values follow the
+# header as a raw little-endian float64 array, which is memory-mapped on load.
+CACHE_EXT = '.bin'
+CACHE_MAGIC = b'MTEPT'
+CACHE_VERSION = 1
+CACHE_DTYPE = np.dtype('<f8')
+HEADER_SIZE = 64
+
+# magic, version, source size, source mtime, number of rows, number of columns
+_HEADER = struct.Struct('<5sB2xqdqq')
+
+# The types of the file path sources, i.e. str and unicode in Python 2
+_PATH_TYPES = (str, type(u''))
+
+
+def cache_path(fname):
+	"""-------------------------------------------------------------------------
+	Returns the path of the binary sidecar of the given pitch track file.
+	----------------------------------------------------------------------------
+	fname : Path of the pitch track text file
+	-------------------------------------------------------------------------"""
+	return fname + CACHE_EXT
+
+
+def _source_stamp(fname):
+	st = os.stat(fname)
+	return st.st_size, st.st_mtime
+
+
+def _read_header(cache_fname):
+	with open(cache_fname, 'rb') as f:
+		header = f.read(_HEADER.size)
+	if len(header) != _HEADER.size:
+		return None
+
+	magic, version, src_size, src_mtime, n_rows, n_cols = _HEADER.unpack(header)
+	if magic != CACHE_MAGIC or version != CACHE_VERSION:
+		return None
+	return src_size, src_mtime, n_rows, n_cols
+
+
+def is_cache_valid(fname):
+	"""-------------------------------------------------------------------------
+	Checks whether the binary sidecar of a pitch track exists and is converted
+	from the current version of the text file, i.e. its recorded size and
+	modification time match the ones of the text file.
+	----------------------------------------------------------------------------
+	fname : Path of the pitch track text file
+	-------------------------------------------------------------------------"""
+	try:
+		header = _read_header(cache_path(fname))
+	except (IOError, OSError):
+		return False
+
+	return header is not None and header[:2] == _source_stamp(fname)
+
+
+def convert(fname):
+	"""-------------------------------------------------------------------------
+	Parses the pitch track text file and writes its binary sidecar. The sidecar
+	is first written to a temporary file and then renamed, so concurrent
+	readers never see a half written sidecar. Returns the parsed array.
+	----------------------------------------------------------------------------
+	fname : Path of the pitch track text file
+	-------------------------------------------------------------------------"""
+	# The stamp is taken before parsing; if the file changes in between, the
+	# sidecar is simply considered stale on the next access.
+	src_size, src_mtime = _source_stamp(fname)
+	track = np.loadtxt(fname, dtype=CACHE_DTYPE, ndmin=1)
+
+	n_rows = track.shape[0]
+	n_cols = track.shape[1] if track.ndim > 1 else 0
+	header = _HEADER.pack(CACHE_MAGIC, CACHE_VERSION, src_size, src_mtime, n_rows, n_cols)
+
+	cache_fname = cache_path(fname)
+	tmp_fname = '%s.%d.tmp' % (cache_fname, os.getpid())
+	with open(tmp_fname, 'wb') as f:
+		f.write(header.ljust(HEADER_SIZE, b'\0'))
+		f.write(np.ascontiguousarray(track).tobytes())
+
+	# os.rename doesn't overwrite an existing file on Windows
+	if os.name == 'nt' and os.path.exists(cache_fname):
+		os.remove(cache_fname)
+	os.rename(tmp_fname, cache_fname)
+
+	return track
+
+
+def load(fname, use_cache=True):
+	"""-------------------------------------------------------------------------
+	Loads the raw table of a pitch track file. If the binary sidecar is valid,
+	the table is memory-mapped from it (read-only); else the text file is parsed
+	and the sidecar is (re)generated for the later calls. If the sidecar can't
+	be written (e.g. read-only data folder) the parsed table is still returned.
+	----------------------------------------------------------------------------
+	fname     : Path of the pitch track text file
+	use_cache : If False, the text file is parsed directly, as np.loadtxt would
+	-------------------------------------------------------------------------"""
+	if not use_cache:
+		return np.loadtxt(fname, ndmin=1)
+
+	cache_fname = cache_path(fname)
+	try:
+		header = _read_header(cache_fname)
+	except (IOError, OSError):
+		header = None
+
+	if header is not None and header[:2] == _source_stamp(fname):
+		n_rows, n_cols = header[2:]
+		shape = (n_rows, n_cols) if n_cols else (n_rows,)
+
+		# np.memmap can't map zero bytes
+		if n_rows == 0:
+			return np.zeros(shape, dtype=CACHE_DTYPE)
+		return np.memmap(cache_fname, dtype=CACHE_DTYPE, mode='r', offset=HEADER_SIZE, shape=shape)
+
+	try:
+		return convert(fname)
+	except (IOError, OSError):
+		return np.loadtxt(fname, ndmin=1)
+
+
+def is_path(source):
+	"""-------------------------------------------------------------------------
+	Checks whether a pitch track source is a file path, rather than the track
+	itself.
+	-------------------------------------------------------------------------"""
+	return isinstance(source, _PATH_TYPES)
+
+
+def as_track(source, use_cache=True):
+	"""-------------------------------------------------------------------------
+	Returns the raw table of a pitch track, given either as a file or in memory.
+	The in-memory tracks can be NumPy arrays, any object that supports the
+	buffer protocol (e.g. array.array or memoryview) or lists. They aren't
+	copied if their values are already float64; else they are converted once.
+	----------------------------------------------------------------------------
+	source    : Path of the pitch track text file, or the track itself as a 1-D
+	            array of frequencies or a 2-D table (time, pitch, ...)
+	use_cache : Whether the binary sidecar is used for the files. See load().
+	-------------------------------------------------------------------------"""
+	if is_path(source):
+		return load(source, use_cache=use_cache)
+
+	# array.array doesn't support memoryview in Python 2; its typecode is a
+	# valid NumPy type code
+	if isinstance(source, array.array):
+		source = np.frombuffer(source, dtype=source.typecode)
+	elif not isinstance(source, np.ndarray):
+		try:  # buffer protocol; the memoryview keeps the format and the shape
+			source = np.asarray(memoryview(source))
+		except TypeError:
+			pass
+
+	track = np.asarray(source, dtype=float)
+	if track.ndim not in (1, 2):
+		raise ValueError('The pitch track should be a 1-D array or a 2-D table')
+	return track
+
+
+def load_pitch(source, use_cache=True):
+	"""-------------------------------------------------------------------------
+	Loads the frequency values of a pitch track. The track can either be a
+	single column of frequencies or a table where the first column is time, the
+	second is pitch and the rest is labels etc. It can be given as a file or
+	in memory; see as_track(). The pitch column of a table is returned as a
+	view, without a copy.
+	----------------------------------------------------------------------------
+	source    : Path of the pitch track text file, or the track itself
+	use_cache : Whether the binary sidecar is used. See load().
+	-------------------------------------------------------------------------"""
+	track = as_track(source, use_cache=use_cache)
+	return track[:, 1] if track.ndim > 1 else track
+
+
+def source_name(source, default=''):
+	"""-------------------------------------------------------------------------
+	Returns the name of a pitch track source to be recorded in the models, i.e.
+	the path of the file. The in-memory tracks don't have a name, so default is
+	returned for them.
+	-------------------------------------------------------------------------"""
+	return source if is_path(source) else default
+
+
+def convert_corpus(data_dir, extension='.pitch', force=False):
+	"""-------------------------------------------------------------------------
+	Walks a data folder (e.g. demo/data with a sub-folder per mode) and writes
+	the binary sidecars of all the pitch track files in it. Already up-to-date
+	sidecars are skipped unless force is True. Returns the list of converted
+	files.
+	----------------------------------------------------------------------------
+	data_dir  : Root folder of the corpus
+	extension : Extension of the pitch track files
+	force     : Whether the valid sidecars should be regenerated too
+	-------------------------------------------------------------------------"""
+	converted = []
+	for (path, dirs, files) in os.walk(data_dir):
+		for f in sorted(files):
+			if not f.endswith(extension):
+				continue
+
+			fname = os.path.join(path, f)
+			if force or not is_cache_valid(fname):
+				convert(fname)
+				converted.append(fname)
+	return converted
+
+
+if __name__ == '__main__':
+	# argparse is only needed by the command line, not by the importers
+	import argparse
+
+	parser = argparse.ArgumentParser(description='Converts the pitch track files of a corpus to '
+	                                             'binary sidecars for fast loading.')
+	parser.add_argument('data_dir', help='root folder of the corpus, e.g. demo/data')
+	parser.add_argument('--extension', default='.pitch', help='extension of the pitch track files')
+	parser.add_argument('--force', action='store_true', help='regenerate the up-to-date sidecars too')
+	args = parser.parse_args()
+
+	converted_files = convert_corpus(args.data_dir, extension=args.extension, force=args.force)
+	print('Converted %d pitch track(s) in %s' % (len(converted_files), args.data_dir))
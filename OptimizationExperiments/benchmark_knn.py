@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+import argparse
+import json
+import time
+import sys
+import os
+import numpy as np
+
+# Measures the recall and the speedup of the approximate ('ivf') nearest
+# neighbor search of Chordia against the brute force search, on a synthetic
+# corpus. The chunk models of the demo recordings are replicated --scale
+# times, each copy mixed, shifted and perturbed, to emulate a training corpus
+# that is much larger than the demo. The first recording of each mode is held
+# out; its chunks, shifted to their peaks as in chunk_estimate(), are the
+# queries. recall@k is the fraction of the actual k nearest (tonic candidate,
+# model) pairs of a chunk that the approximate search finds.
+#
+# With --check-scan, the blocked scan of the models (neighbor_search='scan')
+# is first checked to rank the same entries, with the same distances, as the
+# whole distance matrix, for every distance method and several memory budgets.
+# The script fails if any of them differs.
+#
+#   python OptimizationExperiments/benchmark_knn.py --scale 50 --k 10 --probes 1 4 16 --dims 8 16
+#   python OptimizationExperiments/benchmark_knn.py --scale 10 --check-scan
+
+ROOT_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+DATA_DIR = os.path.join(ROOT_DIR, 'demo', 'data')
+sys.path.insert(0, ROOT_DIR)
+
+from ModeTonicEstimation.Chordia import Chordia
+from ModeTonicEstimation import ModeFunctions as mF
+from ModeTonicEstimation import InvertedFile as iF
+from ModeTonicEstimation import PitchTrack as pT
+
+
+def demo_chunks(chordia):
+	# Returns the chunk PCDs of the training recordings as a matrix and the
+	# chunk distributions of the held-out recordings
+	with open(os.path.join(DATA_DIR, 'annotations.json')) as f:
+		tonics = dict((a['mbid'], a['tonic']) for a in json.load(f))
+	modes = sorted(d for d in os.listdir(DATA_DIR) if os.path.isdir(os.path.join(DATA_DIR, d)))
+
+	models, queries = [], []
+	for mode in modes:
+		files = sorted(os.path.join(DATA_DIR, mode, f) for f in os.listdir(os.path.join(DATA_DIR, mode))
+		               if f.endswith('.pitch'))
+		for i, fname in enumerate(files):
+			tonic = tonics[os.path.basename(fname)[:-len('.pitch')]]
+			dists = chordia.chunk_dists(pT.load_pitch(fname), tonic, metric='pcd')
+			if i == 0:
+				queries += dists
+			else:
+				models += [d.vals for d in dists]
+	return np.array(models), queries
+
+
+def scale_corpus(models, scale, seed=0):
+	# Each copy of a model is mixed with up to 40% of another model of the
+	# corpus, shifted by up to two bins and multiplied by a noise of 10% per
+	# bin, then normalized
+	rng = np.random.RandomState(seed)
+	copies = [models]
+	for s in range(scale - 1):
+		weights = 0.4 * rng.rand(len(models), 1)
+		copy = (1 - weights) * models + weights * models[rng.randint(len(models), size=len(models))]
+		copy = np.array([np.roll(m, sh) for m, sh in zip(copy, rng.randint(-2, 3, size=len(models)))])
+		copy *= 1 + 0.1 * rng.randn(*copy.shape).clip(-3, 3)
+		copies.append(copy / copy.sum(axis=1)[:, np.newaxis])
+	return np.vstack(copies)
+
+
+def query_trials(dist):
+	# The shifted candidates of a chunk, as in chunk_estimate()
+	dist = dist.shift(int(np.argmin(dist.vals)))
+	peak_idxs, peak_vals = dist.detect_peaks()
+	return mF.shifted_vals(dist, peak_idxs)
+
+
+# The distance methods and the memory budgets (bytes) checked by --check-scan
+SCAN_METHODS = ['bhat', 'intersection', 'corr', 'manhattan', 'euclidean', 'l3']
+SCAN_BUDGETS = [2 ** 12, 2 ** 16, 2 ** 20, mF.SCAN_MEMORY_BUDGET]
+
+
+def check_scan(trials_list, models, k):
+	# Returns the number of (query, method, budget, orientation) cases where
+	# the blocked scan differs from ranking the whole distance matrix
+	mismatches = 0
+	for method in SCAN_METHODS:
+		for trials in trials_list:
+			dist_mat = mF.distance_matrix(trials, models, method=method)
+			for transpose in [False, True]:
+				expected = mF.top_k(dist_mat.T if transpose else dist_mat, k)
+				for budget in SCAN_BUDGETS:
+					found = mF.scan_top_k(trials, models, k, method=method, transpose=transpose,
+					                      memory_budget=budget)
+					mismatches += found.tobytes() != expected.tobytes()
+	return mismatches
+
+
+def pair_set(dist_mat, k):
+	ranked = mF.top_k(dist_mat, k)
+	return set(zip(ranked['row'].tolist(), ranked['col'].tolist()))
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description='Benchmarks the recall and the speedup of the approximate '
+	                                             'nearest neighbor search of Chordia on a synthetic corpus.')
+	parser.add_argument('--scale', type=int, default=50, help='number of copies of the demo chunk models')
+	parser.add_argument('--k', type=int, default=10, help='number of nearest neighbors per chunk')
+	parser.add_argument('--method', default='euclidean', help='distance method')
+	parser.add_argument('--probes', type=int, nargs='+', default=[1, 2, 4, 8, 16], help='numbers of probed lists')
+	parser.add_argument('--dims', type=int, nargs='+', default=[8, 16, 32], help='projection dimensions')
+	parser.add_argument('--check-scan', action='store_true',
+	                    help='check that the blocked scan ranks the same entries as the whole distance matrix')
+	args = parser.parse_args()
+
+	chordia = Chordia(chunk_size=30, overlap=0.5)
+	base, queries = demo_chunks(chordia)
+	models = scale_corpus(base, args.scale)
+	trials_list = [query_trials(d) for d in queries]
+	print('%d models (%d demo chunk models x %d), %d query chunks, k = %d, %s' %
+	      (len(models), len(base), args.scale, len(queries), args.k, args.method))
+
+	if args.check_scan:
+		mismatches = check_scan(trials_list, models, args.k)
+		print('blocked scan: %d mismatches in %d cases' %
+		      (mismatches, len(SCAN_METHODS) * len(trials_list) * 2 * len(SCAN_BUDGETS)))
+		if mismatches:
+			sys.exit(1)
+
+	t0 = time.time()
+	exact = [pair_set(mF.distance_matrix(trials, models, method=args.method), args.k) for trials in trials_list]
+	brute_time = (time.time() - t0) / len(queries)
+	print('brute force: %.2f ms per chunk' % (1000 * brute_time))
+
+	print('%5s %7s %10s %10s %9s %8s' % ('dim', 'probes', 'build (s)', 'recall@k', 'ms/chunk', 'speedup'))
+	for dim in args.dims:
+		t0 = time.time()
+		index = iF.build(models, dim=dim)
+		build_time = time.time() - t0
+		for num_probes in args.probes:
+			t0 = time.time()
+			found = [pair_set(iF.knn_distance_matrix(trials, models, index, args.k, method=args.method,
+			                                         num_probes=num_probes), args.k) for trials in trials_list]
+			query_time = (time.time() - t0) / len(queries)
+			recall = np.mean([len(e & f) / float(len(e)) for e, f in zip(exact, found)])
+			print('%5d %7d %10.2f %10.3f %9.2f %8.1f' % (dim, num_probes, build_time, recall, 1000 * query_time,
+			                                              brute_time / query_time))
@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+import subprocess
+import argparse
+import json
+import sys
+import os
+
+# Measures the cold start of the package: the import time of the estimators
+# and the time to the first estimate on demo/data, each in a fresh process.
+# The heavy optional dependencies aren't allowed to be imported by the
+# estimators; the run fails if they are, or if the given limits are exceeded.
+#
+#   python OptimizationExperiments/benchmark_startup.py --repeat 5 --max-import-ms 300
+
+ROOT_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+DATA_DIR = os.path.join(ROOT_DIR, 'demo', 'data')
+HEAVY_MODULES = ['scipy', 'essentia', 'matplotlib']
+
+IMPORT_SCRIPT = '''
+import sys, time, json
+t0 = time.time()
+import ModeTonicEstimation.Bozkurt, ModeTonicEstimation.Chordia
+t1 = time.time()
+heavy = [m for m in %(heavy)r if m in sys.modules]
+print(json.dumps({'import': t1 - t0, 'heavy': heavy}))
+'''
+
+# The first recording of each mode is estimated; the rest are used to train
+# the models in memory.
+ESTIMATE_SCRIPT = '''
+import sys, time, json, os
+t0 = time.time()
+from ModeTonicEstimation.Bozkurt import Bozkurt
+from ModeTonicEstimation.Chordia import Chordia
+from ModeTonicEstimation import PitchTrack as pT
+t1 = time.time()
+
+data_dir = %(data_dir)r
+with open(os.path.join(data_dir, 'annotations.json')) as f:
+	tonics = dict((a['mbid'], a['tonic']) for a in json.load(f))
+modes = sorted(d for d in os.listdir(data_dir) if os.path.isdir(os.path.join(data_dir, d)))
+files = dict((m, sorted(os.path.join(data_dir, m, f) for f in os.listdir(os.path.join(data_dir, m))
+                        if f.endswith('.pitch'))) for m in modes)
+tracks = dict((m, [pT.load_pitch(f) for f in files[m]]) for m in modes)
+tonic_lists = dict((m, [tonics[os.path.basename(f)[:-len('.pitch')]] for f in files[m]]) for m in modes)
+t2 = time.time()
+
+bozkurt = Bozkurt()
+models = dict((m, bozkurt.train(m, tracks[m][1:], tonic_lists[m][1:])) for m in modes)
+t3 = time.time()
+bozkurt.estimate(tracks[modes[0]][0], mode_in=models, rank=1)
+t4 = time.time()
+
+res = {'import': t1 - t0, 'load': t2 - t1, 'bozkurt_train': t3 - t2, 'bozkurt_estimate': t4 - t3,
+       'first_estimate': t4 - t0}
+print(json.dumps(res))
+'''
+
+
+def run(script):
+	env = dict(os.environ)
+	env['PYTHONPATH'] = os.pathsep.join([ROOT_DIR] + ([env['PYTHONPATH']] if env.get('PYTHONPATH') else []))
+	out = subprocess.check_output([sys.executable, '-c', script], env=env, cwd=ROOT_DIR)
+	return json.loads(out.decode('utf-8').strip().splitlines()[-1])
+
+
+def median(vals):
+	vals = sorted(vals)
+	return vals[len(vals) // 2] if len(vals) % 2 else 0.5 * (vals[len(vals) // 2 - 1] + vals[len(vals) // 2])
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description='Benchmarks the import time and the time to the first '
+	                                             'estimate of the package, in fresh processes.')
+	parser.add_argument('--repeat', type=int, default=5, help='number of fresh processes per measurement')
+	parser.add_argument('--max-import-ms', type=float, default=None, help='fail if the median import is slower')
+	parser.add_argument('--max-estimate-ms', type=float, default=None,
+	                    help='fail if the median time to the first estimate is slower')
+	args = parser.parse_args()
+
+	import_runs = [run(IMPORT_SCRIPT % {'heavy': HEAVY_MODULES}) for r in range(args.repeat)]
+	estimate_runs = [run(ESTIMATE_SCRIPT % {'data_dir': DATA_DIR}) for r in range(args.repeat)]
+
+	import_ms = 1000 * median([r['import'] for r in import_runs])
+	print('import (Bozkurt, Chordia): %.1f ms' % import_ms)
+	for key in ['import', 'load', 'bozkurt_train', 'bozkurt_estimate', 'first_estimate']:
+		print('%-16s: %.1f ms' % (key, 1000 * median([r[key] for r in estimate_runs])))
+
+	failures = []
+	heavy = sorted(set(m for r in import_runs for m in r['heavy']))
+	if heavy:
+		failures.append('heavy modules imported up front: ' + ', '.join(heavy))
+	if args.max_import_ms is not None and import_ms > args.max_import_ms:
+		failures.append('import %.1f ms > %.1f ms' % (import_ms, args.max_import_ms))
+	estimate_ms = 1000 * median([r['first_estimate'] for r in estimate_runs])
+	if args.max_estimate_ms is not None and estimate_ms > args.max_estimate_ms:
+		failures.append('first estimate %.1f ms > %.1f ms' % (estimate_ms, args.max_estimate_ms))
+
+	for f in failures:
+		print('FAIL: ' + f)
+	sys.exit(1 if failures else 0)
@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+import argparse
+import tempfile
+import shutil
+import json
+import sys
+import os
+
+# Checks that the batched nearest neighbor search of Chordia (batched=True in
+# estimate(), see batch_neighbors()) finds the same neighbors, in the same
+# order and with the same distances, as calling chunk_estimate() for each
+# chunk (see chunk_neighbors()). The models are trained on demo/data,
+# leaving out the first recording of each mode; the held-out recordings are
+# estimated jointly, with the annotated mode (tonic only) and with the
+# annotated tonic (mode only), for every distance method and k. The results
+# of estimate() are compared as well. The script fails if any of them differs.
+#
+#   python OptimizationExperiments/check_batched.py --k 1 3 5 10
+
+ROOT_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+DATA_DIR = os.path.join(ROOT_DIR, 'demo', 'data')
+sys.path.insert(0, ROOT_DIR)
+
+from ModeTonicEstimation.Chordia import Chordia
+from ModeTonicEstimation import PitchTrack as pT
+
+METHODS = ['bhat', 'intersection', 'corr', 'manhattan', 'euclidean', 'l3']
+
+
+def demo_split():
+	# Returns the modes, the training (files, tonics) of each mode and the
+	# held-out (mode, file, tonic) triples
+	with open(os.path.join(DATA_DIR, 'annotations.json')) as f:
+		tonics = dict((a['mbid'], a['tonic']) for a in json.load(f))
+	modes = sorted(d for d in os.listdir(DATA_DIR) if os.path.isdir(os.path.join(DATA_DIR, d)))
+
+	training, held_out = dict(), []
+	for mode in modes:
+		files = sorted(os.path.join(DATA_DIR, mode, f) for f in os.listdir(os.path.join(DATA_DIR, mode))
+		               if f.endswith('.pitch'))
+		file_tonics = [tonics[os.path.basename(f)[:-len('.pitch')]] for f in files]
+		training[mode] = (files[1:], file_tonics[1:])
+		held_out.append((mode, files[0], file_tonics[0]))
+	return modes, training, held_out
+
+
+def check_recording(chordia, model_dir, modes, mode, fname, tonic, k_params):
+	# Returns the number of (estimation, method, k) cases where the batched
+	# search differs from the search chunk by chunk
+	pitch_track = pT.load_pitch(fname)
+	cases = {'joint': dict(mode_names=modes, est_tonic=True, est_mode=True),
+	         'tonic': dict(mode_name=mode, est_tonic=True, est_mode=False),
+	         'mode': dict(mode_names=modes, est_tonic=False, est_mode=True)}
+
+	mismatches = 0
+	for case, kwargs in sorted(cases.items()):
+		ref_freq = 440 if kwargs['est_tonic'] else tonic
+		chunk_dists = chordia.chunk_dists(pitch_track, ref_freq, metric='pcd', source='input')
+		candidate_set = chordia.load_model_set(modes, dist_dir=model_dir) if 'mode_names' in kwargs else None
+		annotated_set = chordia.load_model_set([mode], dist_dir=model_dir) if 'mode_name' in kwargs else None
+
+		for k in k_params:
+			batched = chordia.batch_neighbors(chunk_dists, k, candidate_set=candidate_set,
+			                                  annotated_set=annotated_set, est_tonic=kwargs['est_tonic'],
+			                                  est_mode=kwargs['est_mode'], distance_method=METHODS,
+			                                  ref_freq=ref_freq)
+			per_chunk = chordia.chunk_neighbors(chunk_dists, k, mode_dir=model_dir, candidate_set=candidate_set,
+			                                    annotated_set=annotated_set, est_tonic=kwargs['est_tonic'],
+			                                    est_mode=kwargs['est_mode'], distance_method=METHODS,
+			                                    ref_freq=ref_freq)
+			for method in METHODS:
+				if batched[method] != per_chunk[method]:
+					print('%s %s, %s, k = %d: the neighbors differ' % (os.path.basename(fname), case, method, k))
+					mismatches += 1
+
+		# estimate() votes the same neighbors on both paths
+		est_kwargs = dict(kwargs)
+		est_kwargs.pop('est_tonic')
+		tonic_freq = None if kwargs['est_tonic'] else tonic
+		for method in METHODS:
+			results = [chordia.estimate(pitch_track, mode_dir=model_dir, tonic_freq=tonic_freq,
+			                            distance_method=method, k_param=k_params, batched=batched, **est_kwargs)
+			           for batched in [True, False]]
+			if results[0] != results[1]:
+				print('%s %s, %s: the estimates differ' % (os.path.basename(fname), case, method))
+				mismatches += 1
+	return mismatches
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description='Checks that the batched nearest neighbor search of Chordia '
+	                                             'matches the search chunk by chunk on demo/data.')
+	parser.add_argument('--k', type=int, nargs='+', default=[1, 3, 5, 10], help='numbers of nearest neighbors')
+	args = parser.parse_args()
+
+	chordia = Chordia(chunk_size=30, overlap=0.5)
+	modes, training, held_out = demo_split()
+
+	model_dir = tempfile.mkdtemp()
+	try:
+		for mode in modes:
+			chordia.train(mode, training[mode][0], training[mode][1], metric='pcd', save_dir=model_dir,
+			              file_format='binary')
+
+		mismatches = sum(check_recording(chordia, model_dir, modes, mode, fname, tonic, args.k)
+		                 for mode, fname, tonic in held_out)
+	finally:
+		shutil.rmtree(model_dir)
+
+	print('batched search: %d mismatches in %d cases' %
+	      (mismatches, len(held_out) * 3 * len(METHODS) * (len(args.k) + 1)))
+	if mismatches:
+		sys.exit(1)